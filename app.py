@@ -10,27 +10,30 @@ from dash.dependencies import Input, Output, State
 from datetime import datetime as dt
 import re
 import io
-import bifrostapi
+import math
 
 from components.import_data import *
 
 from components import html_components as hc
 from components import mongo_interface
+from components import invalidation
+from components import session_store
+from components import map_data
+from components import figure_cache
+from components import callback_metrics
+from components import tracing
+from components import table_query
+from components import jobs
+from components.projections import get_projection
 from bifrost import bifrost_mongo_interface
 from bifrost.sample_report import SAMPLE_PAGESIZE, sample_report, children_sample_list_report, samples_next_page
 from bifrost.aggregate_report import aggregate_report, update_aggregate_fig, aggregate_species_dropdown
 import components.global_vars as global_vars
 from dash.exceptions import PreventUpdate
 
-import react_phylo
 import pandas as pd
-import plotly.graph_objects as go
 import keys
 
-os.chdir('/Users/stefanocardinale/Documents/SSI/DATABASES/')
-
-data = pd.read_csv('map_testing_data.csv', sep=";")
-
 def samples_list(active, collection_name=None):
     links = [
         {
@@ -107,13 +110,29 @@ app = dash.Dash(__name__,
 )
 #app.scripts.config.serve_locally = False
 
+server = app.server  # for gunicorn, see Procfile
 app.title = "BeONE"
 app.config["suppress_callback_exceptions"] = True
+# Trace the callbacks registered from here on.
+tracing.instrument(app)
 cache = Cache(app.server, config={
     'CACHE_TYPE': 'filesystem',
-    'CACHE_DIR': keys.cache_location
+    'CACHE_DIR': os.path.expanduser(keys.cache_location)
 })
-cache_timeout = 60
+
+
+def load_react_phylo():
+    # Imported on first use to keep startup fast. It must still happen
+    # before the first page is served, so that Dash includes its scripts.
+    import react_phylo
+    return react_phylo
+
+
+@app.server.before_first_request
+def start_worker():
+    # Per worker process, after gunicorn has forked.
+    invalidation.start()
+    load_react_phylo()
 
 app.css.append_css(
     {"external_url": "https://fonts.googleapis.com/css?family=Lato"})
@@ -122,9 +141,11 @@ app.layout = html.Div(
     id="app-container",
     children=[
         dcc.Location(id="url", refresh=False),
-        dcc.Store(id="sample-store", data=[], storage_type='session'),
-        dcc.Store(id="analysis-store", data=[], storage_type='session'),
-        dcc.Store(id="survey-store", data=[], storage_type='session'),
+        # Handles of server-side selections, see components.session_store
+        dcc.Store(id="sample-store", data=None, storage_type='session'),
+        dcc.Store(id="analysis-store", data=None, storage_type='session'),
+        dcc.Store(id="isolates-selection", data=None),
+        dcc.Store(id="survey-store", data=None, storage_type='session'),
         dcc.Store(id="param-store", data={}),
         dcc.Store(id="selected-run", data=None),
         dcc.Store(id="selected-species", data=None),
@@ -172,17 +193,100 @@ app.layout = html.Div(
 )
 
 
+ISOLATES_COLUMNS = [c["id"] for c in global_vars.QC_COLUMNS]
+
+
+def isolates_where(start_date, end_date, filter_query):
+    "Match condition of the isolates table for the dates and its filter row"
+    return table_query.combine(
+        table_query.date_condition("sample_sheet.SequenceRunDate",
+                                   parse_date(start_date),
+                                   parse_date(end_date)),
+        table_query.filter_condition(filter_query, ISOLATES_COLUMNS))
+
+
+@app.callback(
+    [Output('isolates-selection', 'data')],
+    [Input('select-all-button', 'n_clicks'),
+     Input('datatable-ssi_stamper', 'selected_row_ids'),
+     Input('datatable-ssi_stamper', 'filter_query'),
+     Input('date-picker-select', 'start_date'),
+     Input('date-picker-select', 'end_date'),
+     Input('sample-store', 'data')],
+    [State('datatable-ssi_stamper', 'derived_viewport_row_ids'),
+     State('isolates-selection', 'data')]
+)
+def update_isolates_selection(n_clicks, selected_row_ids, filter_query,
+                              start_date, end_date, sample_store,
+                              page_ids, selection):
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+    if "select-all-button.n_clicks" in triggered:
+        if not n_clicks:
+            raise PreventUpdate
+        # Toggles between all and none of the rows matching the filters.
+        if selection and selection["all"] and not selection["ids"]:
+            return [table_query.empty_selection()]
+        return [table_query.select_all()]
+    if "datatable-ssi_stamper.selected_row_ids" in triggered:
+        updated = table_query.update_page_selection(
+            selection, page_ids, selected_row_ids)
+        if updated == selection:
+            # Also stops the loop with update_isolates_page, which sets
+            # the selected rows of each page it loads.
+            raise PreventUpdate
+        return [updated]
+    # The selection only holds for the filters it was made with.
+    if selection == table_query.empty_selection():
+        raise PreventUpdate
+    return [table_query.empty_selection()]
+
+
 @app.callback(
-    [Output('datatable-ssi_stamper', "selected_rows")],
-    [Input('select-all-button', 'n_clicks')],
-    [State('datatable-ssi_stamper', "data")]
+    [Output('datatable-ssi_stamper', 'data'),
+     Output('datatable-ssi_stamper', 'selected_rows'),
+     Output('isolates-count', 'children')],
+    [Input('datatable-ssi_stamper', 'page_current'),
+     Input('datatable-ssi_stamper', 'page_size'),
+     Input('datatable-ssi_stamper', 'sort_by'),
+     Input('datatable-ssi_stamper', 'filter_query'),
+     Input('date-picker-select', 'start_date'),
+     Input('date-picker-select', 'end_date'),
+     Input('sample-store', 'data'),
+     Input('isolates-selection', 'data')]
 )
-def select_all(n_clicks, data):
+def update_isolates_page(page_current, page_size, sort_by, filter_query,
+                         start_date, end_date, sample_store, selection):
+    sample_ids = session_store.get_sample_ids(sample_store)
+    if len(sample_ids) == 0:
+        return [[], [], "0 samples"]
+    page_current = page_current or 0
+    where = isolates_where(start_date, end_date, filter_query)
+    count = count_filtered(sample_ids=sample_ids, where=where)
+    page = filter_all(
+        sample_ids=sample_ids, where=where,
+        sort=table_query.sort_spec(sort_by, ISOLATES_COLUMNS),
+        pagination={"page_size": page_size, "current_page": page_current},
+        projection=get_projection("isolates"))
+    if "_id" in page:
+        page["_id"] = page["_id"].astype(str)
+        # The DataTable keys selected_row_ids on the "id" of the rows.
+        page["id"] = page["_id"]
+    data = page.to_dict("records")
+    selected_rows = [i for i, row in enumerate(data)
+                     if table_query.is_selected(selection, row.get("id"))]
+    label = "{} samples, {} selected. Page {} of {}.".format(
+        count, table_query.selection_count(selection, count),
+        page_current + 1, max(math.ceil(count / page_size), 1))
+    return [data, selected_rows, label]
 
-    if n_clicks == 0:
-        return [[]]
-    else:
-        return [[i for i in range(len(data))]]
+
+@app.callback(
+    [Output('db-list', 'options')],
+    [Input('radiobuttons1', 'value')]
+)
+def update_db_dropdown(db_source):
+    # Filled after the page loads, so building the layout needs no database.
+    return [hc.dropdown_db_options()]
 
 
 @app.callback(
@@ -205,26 +309,26 @@ def update_runs_dropdown(datab):
     [Input('run-selector', 'n_clicks'),
      Input('specie-selector', 'n_clicks'),
      Input('run-list', 'value'),
-     Input('species-list', 'value')]
+     Input('species-list', 'value')],
+    [State('sample-store', 'data')]
 )
-def upload_runs(n_clicks, n_clicks2, selected_run, selected_specie):
+def upload_runs(n_clicks, n_clicks2, selected_run, selected_specie, sample_store):
 
     if n_clicks == 0 and n_clicks2 == 0:
         species_options = get_species_list()
 
         print("The selected run is: {}".format(selected_run))
         print("Species options are: {}".format(species_options))
-        return ['', [], [], species_options]
+        # No handle is an empty selection, nothing needs to be stored.
+        return ['', [], None, species_options]
 
     elif n_clicks == 0 and n_clicks2 != 0:
-        species_options = get_species_list()
-        samples = filter_all(species=[selected_specie], projection={'_id': 1, 'name': 1})
+        species_options, samples = get_species_options_and_samples(
+            species=[selected_specie], projection=get_projection("sample_store"))
         # samples = hc.generate_table(samples)
-        if "_id" in samples:
-            samples["_id"] = samples["_id"].astype(str)
-
         print("The samples are: {}".format(samples))
-        samples = samples.to_dict("rows")
+        samples = session_store.save_sample_ids(
+            sample_store, samples.get("_id", []))
 
         selected_specie = ["{}".format(selected_specie)]
         print("The selected run is: {}".format(selected_run))
@@ -233,13 +337,11 @@ def upload_runs(n_clicks, n_clicks2, selected_run, selected_specie):
         return ['', selected_specie, samples, species_options]
 
     elif n_clicks != 0 and n_clicks2 == 0:
-        species_options = get_species_list(selected_run)
-        samples = filter_all(run_names=selected_run, projection={'_id': 1, 'name': 1})
+        species_options, samples = get_species_options_and_samples(
+            run_names=selected_run, projection=get_projection("sample_store"))
         #samples = hc.generate_table(samples)
-        if "_id" in samples:
-            samples["_id"] = samples["_id"].astype(str)
-
-        samples = samples.to_dict("rows")
+        samples = session_store.save_sample_ids(
+            sample_store, samples.get("_id", []))
 
         print("The samples are: {}".format(samples))
         print("The species list is: {}".format(species_options))
@@ -247,14 +349,13 @@ def upload_runs(n_clicks, n_clicks2, selected_run, selected_specie):
         return [selected_run, [], samples, species_options]
 
     elif n_clicks != 0 and n_clicks2 != 0:
-        species_options = get_species_list(selected_run)
-        samples = filter_all(species=[selected_specie], run_names=selected_run, projection={'_id': 1, 'name': 1})
+        species_options, samples = get_species_options_and_samples(
+            run_names=selected_run, species=[selected_specie],
+            projection=get_projection("sample_store"))
         #samples = hc.generate_table(samples)
 
-        if "_id" in samples:
-            samples["_id"] = samples["_id"].astype(str)
-
-        samples = samples.to_dict("rows")
+        samples = session_store.save_sample_ids(
+            sample_store, samples.get("_id", []))
 
         selected_specie = ["{}".format(selected_specie)]
 
@@ -263,40 +364,52 @@ def upload_runs(n_clicks, n_clicks2, selected_run, selected_specie):
 
 @app.callback(
     [Output('analysis-store', 'data')],
-    [Input('upload-samples', 'n_clicks'),
-     Input('datatable-ssi_stamper', 'derived_virtual_data'),
-     Input('datatable-ssi_stamper', 'derived_virtual_selected_rows')]
+    [Input('upload-samples', 'n_clicks')],
+    [State('isolates-selection', 'data'),
+     State('datatable-ssi_stamper', 'filter_query'),
+     State('date-picker-select', 'start_date'),
+     State('date-picker-select', 'end_date'),
+     State('sample-store', 'data'),
+     State('analysis-store', 'data')]
 )
-def update_selected_samples(n_clicks, rows, selected_rows):
+def update_selected_samples(n_clicks, selection, filter_query, start_date,
+                            end_date, sample_store, analysis_store):
     print("update_selected_samples")
 
-    if n_clicks == 0:
+    if not n_clicks or selection is None:
         raise PreventUpdate
 
+    if selection["all"]:
+        samples = filter_all(
+            sample_ids=session_store.get_sample_ids(sample_store),
+            where=isolates_where(start_date, end_date, filter_query),
+            projection=get_projection("sample_store"), cached=False)
+        excluded = set(selection["ids"])
+        sample_ids = [str(i) for i in samples.get("_id", [])
+                      if str(i) not in excluded]
     else:
-        data = pd.DataFrame(rows)
-        data = data.take(selected_rows)
-        samples = data.to_dict('rows')
+        sample_ids = selection["ids"]
 
-    print("the number of selected samples is: {}".format(len(samples)))
+    print("the number of selected samples is: {}".format(len(sample_ids)))
 
-    return [samples]
+    return [session_store.save_sample_ids(analysis_store, sample_ids)]
 
 @app.callback(
     [Output('survey-store', 'data'),
      Output('save-survey', 'n_clicks'),
      Output('load-button', 'n_clicks')],
     [Input('metadata-table', 'derived_virtual_data'),
-     Input('metadata-table', 'derived_virtual_selected_rows')]
+     Input('metadata-table', 'derived_virtual_selected_rows')],
+    [State('survey-store', 'data')]
 )
-def store_survey(rows, selected_rows):
+def store_survey(rows, selected_rows, survey_store):
     print("store_survey")
 
     data = pd.DataFrame(rows)
     data = data.take(selected_rows)
     survey = data.to_dict('rows')
 
-    return [survey, 0, 0]
+    return [session_store.save_records(survey_store, survey), 0, 0]
 
 @app.callback(
     [Output('metadata-table', 'data'),
@@ -349,60 +462,54 @@ def load_survey(n_clicks, n_clicks2, selected_survey, content, filename):
 
             return df, columns
 
-@app.callback(
-    [Output('tab-content', 'children')],
-    [Input('date-picker-select', 'start_date'),
-     Input('date-picker-select', 'end_date'),
-     Input('control-tabs', 'value'),
-     Input('run-selector', 'n_clicks'),
-     Input('run-list', 'value'),
-     Input('sample-store', 'data'),
-     Input('analysis-store', 'data')],
-     [State("url", "pathname")]
-)
-def render_content(start_date, end_date, tab, n_clicks, selected_run, selected_samples, project_samples, pathname):
-    print('render_content')
-    if start_date is not None:
-        start_date = dt.strptime(re.split('T| ', start_date)[0], '%Y-%m-%d')
-        #start_date_string = start_date.strftime('%Y-%m-%d')
-        print(start_date)
-    if end_date is not None:
-        end_date = dt.strptime(re.split('T| ', end_date)[0], '%Y-%m-%d')
-        end_date_string = end_date.strftime('%Y-%m-%d')
-        #print(start_date)
-
+def get_section(pathname):
     if pathname is None or pathname == "/":
         pathname = "/"
     path = pathname.split("/")
 
     if path[1] == "collection":
         # collection_view = True
-        if len(path) > 2:  # /collection/collectionname
-            collection_name = path[2]
-            if len(path) > 3:  # /collection/collectionname/section
-                section = path[3]
-            else:  # /collection/collectionname
-                section = ""
-        else:  # /collection
+        if len(path) > 3:  # /collection/collectionname/section
+            section = path[3]
+        else:  # /collection or /collection/collectionname
             section = ""
     else:  # /section
         section = path[1]
+    return section
+
+
+def parse_date(date):
+    if date is None:
+        return None
+    return dt.strptime(re.split('T| ', date)[0], '%Y-%m-%d')
+
+
+def section_container(name):
+    """
+    Placeholder for a view filled by its own callback, so each section only
+    recomputes on the inputs it uses. The store triggers that callback when
+    the placeholder is rendered.
+    """
+    return html.Div([
+        dcc.Store(id="{}-mounted".format(name), data=True),
+        html.Div(id="{}-view".format(name)),
+    ])
+
+
+@app.callback(
+    [Output('tab-content', 'children')],
+    [Input('control-tabs', 'value')],
+    [State("url", "pathname")]
+)
+def render_content(tab, pathname):
+    section = get_section(pathname)
 
     if tab == 'survey-tab':
         return hc.html_tab_surveys(section)
 
-
     elif tab == 'analyses-tab':
         if section == "":
-            if project_samples is None:
-                raise PreventUpdate
-            else:
-                samples = project_samples
-                print("the number of project samples is {}".format(len(samples)))
-                print(project_samples)
-                columns_names = global_vars.COLUMNS
-
-                return hc.html_tab_analyses(samples, columns_names)
+            return [section_container("analyses")]
         elif section == "sample-report":
             view = html.Div([
                     html.Div([
@@ -410,7 +517,7 @@ def render_content(start_date, end_date, tab, n_clicks, selected_run, selected_s
                             dbc.Button('Upload Newick File', n_clicks=0, size='sm')])
                     ], style={'padding-bottom': '5px'}),
                     html.Div(id='output-data-upload'),
-                    react_phylo.Phylo(
+                    load_react_phylo().Phylo(
                     id='output',
                     data='',
                     NewickString='',
@@ -426,42 +533,56 @@ def render_content(start_date, end_date, tab, n_clicks, selected_run, selected_s
     elif tab == 'isolates-tab':
 
         if section == "":
-            if n_clicks == 0 or selected_run == []:
-                if selected_samples is not None:
-                    columns_names = global_vars.QC_COLUMNS
-                    samples = selected_samples
-                else:
-                    samples = []
-                    columns_names = global_vars.QC_COLUMNS
-            else:
-                columns_names = global_vars.QC_COLUMNS
-                samples = selected_samples
-
-            print("the number of samples is: {}".format(len(samples)))
-            view = hc.html_tab_bifrost(samples, start_date, end_date, columns_names)
-
+            view = section_container("isolates")
         elif section == "sample-report":
+            view = section_container("sample-report")
+        elif section == "aggregate":
+            # The plots are filled by their own callbacks from sample-store.
+            view = aggregate_report([])
+        else:
+           # samples_panel = "d-none"
+            view = "Not found"
 
-            ids = [sample['_id'] for sample in selected_samples]
-
-            query = filter_all(sample_ids=ids, projection={'properties': 1})
-
-            if "_id" in query:
-                query["_id"] = query["_id"].astype(str)
+        return [view]
 
-            data = query.to_dict("rows")
 
+@app.callback(
+    [Output('isolates-view', 'children')],
+    [Input('isolates-mounted', 'data')]
+)
+def render_isolates(mounted):
+    # The rows are loaded a page at a time by update_isolates_page.
+    return hc.html_tab_bifrost(global_vars.QC_COLUMNS)
 
-            view = sample_report(data)
 
+@app.callback(
+    [Output('sample-report-view', 'children')],
+    [Input('sample-report-mounted', 'data'),
+     Input('sample-store', 'data')]
+)
+def render_sample_report(mounted, sample_store):
+    ids = session_store.get_sample_ids(sample_store)
+    return [sample_report(count_filtered(sample_ids=ids))]
 
-        elif section == "aggregate":
-            view = aggregate_report(selected_samples)
-        else:
-           # samples_panel = "d-none"
-            view = "Not found"
 
-        return [view]
+@app.callback(
+    [Output('analyses-view', 'children')],
+    [Input('analyses-mounted', 'data'),
+     Input('analysis-store', 'data')]
+)
+def render_analyses(mounted, analysis_store):
+    if analysis_store is None:
+        raise PreventUpdate
+    print("the number of project samples is {}".format(
+        session_store.count(analysis_store)))
+    samples = session_store.get_frame(
+        analysis_store, "analyses",
+        lambda sample_ids: filter_all(sample_ids=sample_ids,
+                                      projection=get_projection("analyses"),
+                                      cached=False))
+    if "_id" in samples:
+        samples["_id"] = samples["_id"].astype(str)
+    return [hc.html_tab_analyses(samples.to_dict("rows"), global_vars.COLUMNS)]
 
 @app.callback(
     [Output('run-selector','n_clicks'),
@@ -480,47 +601,42 @@ def update(reset):
     [State('control-tabs', 'value')],
 )
 def update_url(pathname, tab):
-
-    if pathname is None or pathname == "/":
-        pathname = "/"
-    path = pathname.split("/")
-
-    samples_nav = "nav-item"
-    resequence_nav = "nav-item"
-
-    if path[1] == "collection":
-        #collection_view = True
-        if len(path) > 2: #/collection/collectionname
-            collection_name = path[2]
-            if len(path) > 3:  # /collection/collectionname/section
-                section = path[3]
-            else:  # /collection/collectionname
-                section = ""
-        else:  # /collection
-            section = ""
-    else:  # /section
-        section = path[1]
+    section = get_section(pathname)
 
     tab == '{}'.format(tab)
     return [samples_list(section), tab]
 
 
 @app.callback(
-    Output("sample-report", "children"),
+    [Output("sample-report", "children"),
+     Output("page-cursors", "data")],
     [Input("page-n", "children"),
-     Input("sample-store", "data")]
+     Input("sample-store", "data")],
+    [State("page-cursors", "data")]
 )
-def fill_sample_report(page_n, sample_store):
+def fill_sample_report(page_n, sample_store, page_cursors):
     page_n = int(page_n)
-    sample_names = list(
-        map(lambda x: x["name"], sample_store))
-    if len(sample_names) == 0:
-        return None
-
+    sample_ids = session_store.get_sample_ids(sample_store)
+    if len(sample_ids) == 0:
+        return [None, [None]]
+
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+    if page_cursors is None or "sample-store.data" in triggered:
+        page_cursors = [None]
+        page_n = 0
+
+    if page_n < len(page_cursors):
+        pagination = {"page_size": SAMPLE_PAGESIZE,
+                      "after": page_cursors[page_n]}
+    else:
+        pagination = {"page_size": SAMPLE_PAGESIZE, "current_page": page_n}
     data_table = filter_all(
-        sample_names=sample_names,
-        pagination={"page_size": SAMPLE_PAGESIZE, "current_page": page_n})
-    max_page = len(sample_store) // SAMPLE_PAGESIZE
+        sample_ids=sample_ids,
+        pagination=pagination,
+        projection=get_projection("sample_card"))
+    if page_n < len(page_cursors) and len(data_table):
+        page_cursors = page_cursors[:page_n + 1] + [get_page_cursor(data_table)]
+    max_page = count_filtered(sample_ids=sample_ids) // SAMPLE_PAGESIZE
     # We need to have fake radio buttons with the same ids to account for times
     # when not all SAMPLE_PAGESIZE samples are shown and are not taking the ids required by the callback
     html_fake_radio_buttons = html.Div([dcc.RadioItems(
@@ -530,7 +646,7 @@ def fill_sample_report(page_n, sample_store):
         value='noaction',
         id="sample-radio-{}".format(n_sample)
     ) for n_sample in range(len(data_table), SAMPLE_PAGESIZE)], style={"display": "none"})
-    return [
+    return [[
         html.H4("Page {} of {}".format(page_n + 1, max_page + 1)),
         html.Div(children_sample_list_report(data_table)),
         html_fake_radio_buttons,
@@ -540,7 +656,7 @@ def fill_sample_report(page_n, sample_store):
             id='qc-confirm',
             message='Are you sure you want to send sample feedback?',
         )
-    ]
+    ], page_cursors]
 
 @app.callback(
     [Output("plot-species", "value"),
@@ -550,18 +666,67 @@ def fill_sample_report(page_n, sample_store):
     [State("plot-species", "value")]
 )
 def aggregate_species_dropdown_f(sample_store, plot_species, selected_species):
-    return aggregate_species_dropdown(sample_store, plot_species, selected_species)
+    return aggregate_species_dropdown(session_store.get_sample_ids(sample_store),
+                                      plot_species, selected_species)
+
+def submit_job(name, function, abandon=True):
+    """
+    Submit a background job for the current user. Returns the data of the
+    job store its progress callback polls.
+    """
+    try:
+        return {"id": jobs.submit(name, function, abandon=abandon)}
+    except jobs.JobLimitExceeded as e:
+        return {"error": str(e)}
+
+
+def poll_job(job_store):
+    """
+    Return (job, status text, whether to stop polling) for the data of a
+    job store.
+    """
+    if job_store is None:
+        raise PreventUpdate
+    if "error" in job_store:
+        return None, job_store["error"], True
+    job = jobs.status(job_store["id"])
+    stop = job is None or job["status"] not in jobs.ACTIVE
+    return job, jobs.describe(job), stop
+
 
 @app.callback(
-    [Output("summary-plot", "figure"),
-     Output("mlst-plot", "figure")],
+    [Output("aggregate-job", "data")],
     [Input("plot-species", "value")],
     [State("sample-store", "data"),
     State("plot-species-source", "value")]
 )
-@cache.memoize(timeout=cache_timeout)  # in seconds
-def update_aggregate_fig_f(selected_species, samples, plot_species_source):
-    return update_aggregate_fig(selected_species, samples, plot_species_source)
+def update_aggregate_fig_f(selected_species, sample_store, plot_species_source):
+    sample_ids = session_store.get_sample_ids(sample_store)
+
+    def draw(job):
+        return figure_cache.cached_figures(
+            "aggregate", sample_ids,
+            lambda: update_aggregate_fig(selected_species, sample_ids,
+                                         plot_species_source,
+                                         progress=job.progress),
+            species=selected_species, species_source=plot_species_source)
+    return [submit_job("aggregate", draw)]
+
+
+@app.callback(
+    [Output("summary-plot", "figure"),
+     Output("mlst-plot", "figure"),
+     Output("aggregate-job-status", "children"),
+     Output("aggregate-job-interval", "disabled")],
+    [Input("aggregate-job", "data"),
+     Input("aggregate-job-interval", "n_intervals")]
+)
+def aggregate_job_progress(job_store, n_intervals):
+    job, text, stop = poll_job(job_store)
+    if job is not None and job["status"] == "done":
+        summary_fig, mlst_fig = job["result"]
+        return [summary_fig, mlst_fig, text, stop]
+    return [dash.no_update, dash.no_update, text, stop]
 
 
 @app.callback(
@@ -609,7 +774,10 @@ def display_output(contents):
     Output('datatable-interact-map', 'figure'),
     [Input('datatable-interact-location', 'derived_virtual_selected_rows')]
 )
+@callback_metrics.phase("figure")
 def update_figures(derived_virtual_selected_rows):
+    import plotly.graph_objects as go
+
     # When the table is first rendered, `derived_virtual_data` and
     # `derived_virtual_selected_rows` will be `None`. This is due to an
     # idiosyncracy in Dash (unsupplied properties are always None and Dash
@@ -621,26 +789,7 @@ def update_figures(derived_virtual_selected_rows):
     # the component.
     if derived_virtual_selected_rows is None:
         derived_virtual_selected_rows = []
-    tmp = data
-    tmp = tmp.set_index(['Hospital'])
-
-    hospitals = tmp.groupby('Hospital')
-    # cases = []
-    # for k in hospitals.groups:
-    #     cases.append(len(hospitals.groups[k]))
-    print(hospitals)
-
-    dff = [
-        {
-            "Hospital": "{}".format(k),
-            "cases": len(hospitals.groups[k]),
-            'lat': tmp.loc[k]['lat'].values[0],
-            'lon': tmp.loc[k]['lon'].values[0]
-        } for k in hospitals.groups
-    ]
-
-    print(dff)
-    dfs = pd.DataFrame(dff)
+    dfs = map_data.get_hospital_cases()
 
     mapbox_access_token = "pk.eyJ1Ijoic3RlZmFub2NhcmRpbmFsZSIsImEiOiJjazg3aWUwengwZmg1M2VwcnJzc3pnNmNkIn0.W_t9-PNkeag5yie239nI4Q"
 
@@ -698,25 +847,47 @@ def update_figures(derived_virtual_selected_rows):
     return fig2
 
 @app.callback(
-    [Output('confirm', 'displayed'),
+    [Output('survey-job', 'data'),
      Output('upload-survey-button', 'n_clicks')],
     [Input('save-survey', 'n_clicks'),
      Input('survey-store', 'data')]
 )
-def output_survey_toDB(n_clicks, cases):
+def output_survey_toDB(n_clicks, survey_store):
     print("Output_survey_toDB")
     if n_clicks == 0:
-        return False, 0
+        return dash.no_update, 0
 
     else:
-        print(cases)
+        cases = session_store.get_records(survey_store)
         print("The n. of cases to store is: {}".format(len(cases)))
-        df = {'cases': cases}
-        print(df)
 
-        hc.save_survey(df)
+        # Saving goes on if the user leaves the page.
+        return submit_job(
+            "survey", lambda job: save_survey(cases, progress=job.progress),
+            abandon=False), 0
 
-        return True, 0
+@app.callback(
+    [Output('survey-save-progress', 'children'),
+     Output('survey-progress-interval', 'disabled'),
+     Output('confirm', 'displayed')],
+    [Input('survey-job', 'data'),
+     Input('survey-progress-interval', 'n_intervals')]
+)
+def survey_save_progress(job_store, n_intervals):
+    job, text, stop = poll_job(job_store)
+    if job is not None and job["status"] == "done":
+        return ["Saved {:.0f} cases".format(job["total"] or 0), True, True]
+    if job is not None and job["status"] == "running" and job["total"]:
+        text = "Saved {:.0f} of {:.0f} cases".format(job["done"] or 0,
+                                                     job["total"])
+    return [text, stop, False]
+
+jobs.init_app(app.server)
+
+# Time every callback registered above, and serve the numbers on /metrics.
+tracing.init_app(app.server)
+callback_metrics.instrument(app)
+callback_metrics.add_metrics_route(app.server)
 
 # Run the server
 if __name__ == "__main__":
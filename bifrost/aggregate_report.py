@@ -1,12 +1,12 @@
 from datetime import datetime
 import dash_core_components as dcc
 import dash_html_components as html
-import plotly.graph_objs as go
-from plotly import tools
 import pandas as pd
 import numpy as np
 import bifrost.bifrost_import_data as import_data
 import components.global_vars as global_vars
+from components.projections import get_projection
+from components.callback_metrics import phase
 
 def aggregate_report(data):
 
@@ -42,6 +42,12 @@ def aggregate_report(data):
                         ],
                         className=""
                     ),
+                    # The figures are drawn by a background job, polled
+                    # with the interval until they are ready.
+                    dcc.Store(id="aggregate-job"),
+                    dcc.Interval(id="aggregate-job-interval", interval=1000,
+                                 disabled=True),
+                    html.Div(id="aggregate-job-status"),
 
                     dcc.Graph(id="summary-plot"),
                 ], className="card-body")
@@ -66,13 +72,7 @@ def aggregate_report(data):
 
 #Callbacks
 
-def aggregate_species_dropdown(sample_store, plot_species, selected_species):
-    sample_ids = [s["_id"] for s in sample_store]
-
-    plot_df = import_data.filter_all(
-        sample_ids=sample_ids,
-        projection={"properties": 1})
-
+def aggregate_species_dropdown(sample_ids, plot_species, selected_species):
     species_col = "properties.detected_species"
 
     if plot_species == "provided":
@@ -80,11 +80,16 @@ def aggregate_species_dropdown(sample_store, plot_species, selected_species):
     elif plot_species == "detected":
         species_col = "properties.detected_species"
 
-    if species_col not in plot_df:
-        plot_df[species_col] = np.nan
-    plot_df.loc[pd.isnull(plot_df[species_col]), species_col] = "Not classified"
-    species_list = plot_df[species_col].unique()
-    species_list = ["All species",] + list(species_list)
+    species_list = ["All species"]
+    for plot_df in import_data.filter_all_chunks(
+            sample_ids=sample_ids,
+            projection=get_projection("aggregate_species")):
+        if species_col not in plot_df:
+            plot_df[species_col] = np.nan
+        plot_df.loc[pd.isnull(plot_df[species_col]), species_col] = "Not classified"
+        for species in plot_df[species_col].unique():
+            if species not in species_list:
+                species_list.append(species)
     if selected_species == "Not classified" or selected_species is None or selected_species not in species_list:
         if species_list[0] == "Not classified" and len(species_list) > 1:
             selected_species = species_list[1]
@@ -97,9 +102,15 @@ def aggregate_species_dropdown(sample_store, plot_species, selected_species):
         } for species in species_list]
     return [selected_species, species_list_options]
 
-def update_aggregate_fig(selected_species, sample_store, plot_species_source):
+@phase("figure")
+def update_aggregate_fig(selected_species, sample_ids, plot_species_source,
+                         progress=None):
+    # plotly is only needed to draw, so it is not imported at startup.
+    import plotly.graph_objs as go
+    from plotly import tools
+
     print("update_aggregate_fig")
-    if len(sample_store) == 0:
+    if len(sample_ids) == 0:
         return {"data": []}, {"data": []}
     plot_values = global_vars.plot_values
     traces = []
@@ -111,54 +122,45 @@ def update_aggregate_fig(selected_species, sample_store, plot_species_source):
     elif plot_species_source == "detected":
         species_col = "properties.species_detection.summary.detected_species"
 
-    sample_ids = [s["_id"] for s in sample_store]
-    plot_df = import_data.filter_all(
-        sample_ids=sample_ids)
-
-    print("The plot data are: {}".format(plot_df))
-    if "properties.sample_info.summary.provided_species" not in plot_df:
-        plot_df["properties.sample_info.summary.provided_species"] = np.nan
-
-    plot_df.loc[pd.isnull(plot_df[species_col]),
-                species_col] = "Not classified"
-
-    #Some columns need to have some text extracted
-    for col in global_vars.value_from_test:
-        if col in plot_df.columns:
-            new = plot_df[col].str.split(":", expand=True)
-            loc = plot_df.columns.get_loc(col)
-            plot_df.insert(loc + 1, col + ".value", new[2])
-    sunburst_fig = generate_sunburst(plot_df)
-
-
-    #Convert to string so the id can be shown in the plot.
-    plot_df["_id"] = plot_df["_id"].astype(str)
+    # The chunks are tallied as they arrive, keeping only the points of
+    # the box plots, so the cohort is never held in one DataFrame.
+    totals = new_totals()
+    loaded = 0
+    for chunk in import_data.filter_all_chunks(
+            sample_ids=sample_ids,
+            projection=get_projection("aggregate")):
+        with phase("pandas"):
+            add_chunk(totals, chunk, species_col, selected_species)
+        loaded += len(chunk)
+        if progress is not None:
+            progress(loaded, len(sample_ids))
+    if totals["samples"] == 0:
+        return {"data": []}, {"data": []}
+    sunburst_fig = generate_sunburst(totals)
 
-    if species_col in plot_df.columns and (selected_species in plot_df[species_col].unique() or
-                                           selected_species == "All species"):
+    if (selected_species in totals["species"] or
+            selected_species == "All species"):
+        names = concat_points(totals["names"])
+        ids = concat_points(totals["ids"])
         for plot_value in plot_values:
             plot_id = plot_value["id"]
-            if selected_species == "All species":
-                species_df = plot_df
-            else:
-                species_df = plot_df[plot_df[species_col] == selected_species]
-            species_df[plot_id] = pd.to_numeric(
-                species_df[plot_id], errors="coerce")
-            if (plot_id in species_df.columns):
+            if plot_id in totals["columns"]:
+                values = concat_points(totals["values"][plot_id])
+                present = values[~np.isnan(values)]
+                data_min = float(present.min()) if len(present) else None
+                data_max = float(present.max()) if len(present) else None
                 data_range = plot_value["limits"][1] - plot_value["limits"][0]
-                low_limit = min(
-                    float(species_df[plot_id].min()), plot_value["limits"][0])
-                if low_limit == float(species_df[plot_id].min()):
-                    low_limit -= data_range * 0.1
-                high_limit = max(
-                    float(species_df[plot_id].max()), plot_value["limits"][1])
-                if high_limit == float(species_df[plot_id].max()):
-                    high_limit += data_range*0.1
+                low_limit = plot_value["limits"][0]
+                if data_min is not None and data_min <= low_limit:
+                    low_limit = data_min - data_range * 0.1
+                high_limit = plot_value["limits"][1]
+                if data_max is not None and data_max >= high_limit:
+                    high_limit = data_max + data_range * 0.1
                 trace_ranges.append([low_limit, high_limit])
                 traces.append(
                     go.Box(
-                        x=species_df.loc[:, plot_id],
-                        text=species_df["name"],
+                        x=values,
+                        text=names,
                         marker=dict(
                             size=4
                         ),
@@ -166,11 +168,10 @@ def update_aggregate_fig(selected_species, sample_store, plot_species_source):
                         boxpoints="all",
                         jitter=0.3,
                         pointpos=-1.6,
-                        selectedpoints=list(
-                            range(len(species_df.index))),
+                        selectedpoints=list(range(len(values))),
                         name=plot_value["name"],
                         showlegend=False,
-                        customdata=species_df["_id"]
+                        customdata=ids
                     )
                 )
     fig = tools.make_subplots(rows=7, cols=1, print_grid=False)
@@ -333,38 +334,113 @@ def update_aggregate_fig(selected_species, sample_store, plot_species_source):
 
     return fig, sunburst_fig
 
-def generate_sunburst(plot_df):
-    species_col = "properties.species"
-    mlst_col = "properties.mlst.summary.strain"
-    if not (species_col in plot_df.columns and mlst_col in plot_df.columns):
+SUNBURST_SPECIES = "properties.species"
+SUNBURST_MLST = "properties.mlst.summary.strain"
+
+
+def new_totals():
+    """
+    Running totals of update_aggregate_fig over the chunks of samples.
+    """
+    return {
+        "samples": 0,
+        # Columns seen in any chunk
+        "columns": set(),
+        # Values of species_col
+        "species": set(),
+        # Sunburst counts, species -> MLST strain -> samples
+        "mlst": {},
+        # Box plot points of the selected species, one array per chunk
+        "names": [],
+        "ids": [],
+        "values": {plot_value["id"]: [] for plot_value in global_vars.plot_values},
+    }
+
+
+def mlst_string(strain):
+    if isinstance(strain, (list, tuple)):
+        return ", ".join(map(str, strain))
+    if strain is None or pd.isna(strain):
+        return "None"
+    return str(strain)
+
+
+def add_chunk(totals, chunk, species_col, selected_species):
+    "Add a DataFrame of samples to the running totals"
+    n = len(chunk)
+    totals["samples"] += n
+    totals["columns"].update(chunk.columns)
+
+    # Some columns need to have some text extracted
+    for col in global_vars.value_from_test:
+        if col in chunk.columns and chunk[col].dtype == object:
+            new = chunk[col].str.split(":", expand=True)
+            if 2 in new.columns:
+                chunk[col + ".value"] = new[2]
+                totals["columns"].add(col + ".value")
+
+    if species_col in chunk.columns:
+        species = chunk[species_col].where(pd.notnull(chunk[species_col]),
+                                           "Not classified")
+    else:
+        species = pd.Series("Not classified", index=chunk.index)
+    totals["species"].update(species.unique())
+
+    if SUNBURST_SPECIES in chunk.columns:
+        if SUNBURST_MLST in chunk.columns:
+            strains = chunk[SUNBURST_MLST].map(mlst_string)
+        else:
+            strains = pd.Series("None", index=chunk.index)
+        tally = pd.DataFrame({"species": chunk[SUNBURST_SPECIES],
+                              "strain": strains})
+        for (sample_species, strain), count in tally.groupby(
+                ["species", "strain"], sort=False).size().items():
+            by_strain = totals["mlst"].setdefault(sample_species, {})
+            by_strain[strain] = by_strain.get(strain, 0) + int(count)
+
+    if selected_species == "All species":
+        rows = chunk
+    else:
+        rows = chunk[(species == selected_species).values]
+    if len(rows) == 0:
+        return
+    totals["names"].append(rows["name"].values if "name" in rows.columns
+                           else np.full(len(rows), None, dtype=object))
+    totals["ids"].append(rows["_id"].astype(str).values)
+    for plot_id, values in totals["values"].items():
+        if plot_id in rows.columns:
+            values.append(pd.to_numeric(rows[plot_id], errors="coerce")
+                          .values.astype(np.float64))
+        else:
+            values.append(np.full(len(rows), np.nan))
+
+
+def concat_points(arrays):
+    if len(arrays) == 0:
+        return np.array([])
+    return np.concatenate(arrays)
+
+
+def generate_sunburst(totals):
+    import plotly.graph_objs as go
+
+    if not {SUNBURST_SPECIES, SUNBURST_MLST} <= totals["columns"]:
         return go.Figure()
-    
-    unique_species = plot_df[species_col].unique()
+
     labels = ["samples"]
     parents = [""]
     ids = ["samples"]
-    values = [len(plot_df["_id"])]
-    for row in plot_df.loc[plot_df[mlst_col].isnull(), mlst_col].index:
-        plot_df.at[row, mlst_col] = [None]
-    def joinmlst(l):
-        return ', '.join(map(str, l))
-
-    plot_df["properties.mlst.summary.strainstr"] = plot_df[mlst_col].apply(joinmlst)
-    for species in unique_species:
-        species_df = plot_df[plot_df[species_col] == species]
+    values = [totals["samples"]]
+    for species, by_strain in totals["mlst"].items():
         ids.append(short_species(species))
         labels.append(short_species(species))
         parents.append("samples")
-        values.append(len(species_df))
-        if "properties.mlst.summary.strainstr" in species_df.columns:
-            unique_mlst = species_df["properties.mlst.summary.strainstr"].unique(
-            )
-            for mlst in unique_mlst:
-                ids.append("{} - {}".format(species, mlst))
-                labels.append(mlst)
-                parents.append(short_species(species))
-                values.append(str(
-                    len(species_df[species_df["properties.mlst.summary.strainstr"] == mlst])))
+        values.append(sum(by_strain.values()))
+        for mlst, count in by_strain.items():
+            ids.append("{} - {}".format(species, mlst))
+            labels.append(mlst)
+            parents.append(short_species(species))
+            values.append(count)
     trace = go.Sunburst(
         ids=ids,
         labels=labels,
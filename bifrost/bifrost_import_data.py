@@ -6,6 +6,10 @@ import bifrost.bifrost_mongo_interface as mongo_interface
 from pandas.io.json import json_normalize
 from bson.objectid import ObjectId
 import components.global_vars as global_vars
+import components.pagination as paging
+import components.flatten as flatten
+from components.callback_metrics import phase
+from components.tracing import traced
 import keys
 from bson.json_util import dumps, loads
 
@@ -49,11 +53,15 @@ def filter_name(species=None, group=None, qc_list=None, run_name=None):
     return list(result)
 
 ##NOTE SPLIT/SHORTEN THIS FUNCTION
+@traced
 def filter_all(species=None, species_source=None, group=None,
                qc_list=None, run_names=None, sample_ids=None,
                sample_names=None,
                pagination=None,
-               projection=None):
+               projection=None,
+               full_normalize=False,
+               where=None,
+               sort=None):
     if sample_ids is None:
         query_result = mongo_interface.filter(
             run_names=run_names, species=species,
@@ -61,12 +69,60 @@ def filter_all(species=None, species_source=None, group=None,
             qc_list=qc_list,
             sample_names=sample_names,
             pagination=pagination,
-            projection=projection)
+            projection=projection,
+            where=where, sort=sort)
     else:
         query_result = mongo_interface.filter(
             samples=sample_ids, pagination=pagination,
-            projection=projection)
-    return pd.io.json.json_normalize(query_result)
+            projection=projection, where=where, sort=sort)
+    with phase("pandas"):
+        if full_normalize:
+            return pd.io.json.json_normalize(query_result)
+        if paging.is_keyset(pagination):
+            projection = paging.keyset_projection(projection)
+        return flatten.normalize(query_result, projection)
+
+@traced
+def count_filtered(species=None, species_source=None, group=None,
+                   qc_list=None, run_names=None, sample_ids=None,
+                   sample_names=None, where=None):
+    """
+    Number of samples filter_all would return without pagination.
+    """
+    if sample_ids is None:
+        return mongo_interface.count_filtered(
+            run_names=run_names, species=species,
+            species_source=species_source, group=group,
+            qc_list=qc_list,
+            sample_names=sample_names, where=where)
+    return mongo_interface.count_filtered(samples=sample_ids, where=where)
+
+def filter_all_chunks(species=None, species_source=None, group=None,
+                      qc_list=None, run_names=None, sample_ids=None,
+                      sample_names=None,
+                      projection=None,
+                      batch_size=mongo_interface.FILTER_BATCH_SIZE):
+    """
+    Streaming filter_all: yields one DataFrame per batch of up to batch_size
+    samples, so arbitrarily large selections are processed in bounded memory.
+    """
+    if sample_ids is None:
+        batches = mongo_interface.filter_batches(
+            run_names=run_names, species=species,
+            species_source=species_source, group=group,
+            qc_list=qc_list,
+            sample_names=sample_names,
+            projection=projection,
+            batch_size=batch_size)
+    else:
+        batches = mongo_interface.filter_batches(
+            samples=sample_ids, projection=projection,
+            batch_size=batch_size)
+    for batch in batches:
+        with phase("pandas"):
+            frame = flatten.normalize(batch, projection)
+        yield frame
+
 
 
 def get_assemblies_paths(samples):
@@ -80,6 +136,9 @@ def get_sample_component_status(samples):
 def get_species_QC_values(ncbi_species):
     return mongo_interface.get_species_QC_values(ncbi_species)
 
+def get_species_QC_values_many(species_list):
+    return mongo_interface.get_species_QC_values_many(species_list)
+
 def get_sample_QC_status(run):
     return mongo_interface.get_sample_QC_status(run)
 
@@ -87,12 +146,17 @@ def get_sample_QC_status(run):
 def get_last_runs(run=None, n=12, runtype=None):
     return mongo_interface.get_last_runs(run, n, runtype)
 
-def create_feedback_s_c(user, sample, value):
-    if user == "":
-        raise ValueError("Missing user value")
+def get_feedback_component():
     component = get_component(name="user_feedback", version="1.0")
     if component is None:
         component = mongo_interface.save_component(global_vars.feedback_component)
+    return component
+
+def create_feedback_s_c(user, sample, value, component=None):
+    if user == "":
+        raise ValueError("Missing user value")
+    if component is None:
+        component = get_feedback_component()
     d = datetime.utcnow()
     now = d.replace(microsecond=math.floor(d.microsecond/1000)*1000)
 
@@ -152,9 +216,10 @@ def add_user_feedback_to_properties(sample, s_c):
     stamper["component"] = s_c["properties"]["component"]
     summary = stamper.get("summary", {})
 
-    old_value = summary.get("stamp").get("value")
+    old_value = summary.get("stamp", {}).get("value")
 
     summary["stamp"] = s_c["properties"]["summary"]["stamp"]
+    stamper["summary"] = summary
     sample["properties"] = sample.get("properties", {})
     sample["properties"]["stamper"] = stamper
     return sample, old_value
@@ -171,18 +236,74 @@ def add_user_feedback(user, sample_id, value):
     mongo_interface.save_sample(sample)
     return (sample["name"], old_value)
 
+def add_batch_user_feedback(feedback_pairs, user):
+    """
+    Submits user feedback to many samples with one read of the samples,
+    one of their runs and two bulk writes. Returns one outcome dict per
+    feedback pair with the sample name, old and new value, run names and
+    a status of "ok" or "error" (with "error" set to the reason).
+    """
+    sample_ids = [ObjectId(sample_id) for sample_id, value in feedback_pairs]
+    samples = {s["_id"]: s for s in mongo_interface.get_samples(
+        sample_ids, projection={"name": 1, "properties.stamper": 1})}
+    sample_runs = {}
+    for run in mongo_interface.get_sample_runs(sample_ids):
+        for s in run.get("samples", []):
+            sample_runs.setdefault(s["_id"], []).append(run["name"])
+
+    component = get_feedback_component()
+    outcomes = []
+    sample_components = []
+    stampers = []
+    pending = []
+    for sample_id, (_, value) in zip(sample_ids, feedback_pairs):
+        outcome = {
+            "sample_id": str(sample_id),
+            "name": None,
+            "old_value": None,
+            "value": value,
+            "run_names": sample_runs.get(sample_id, []),
+            "status": "ok",
+            "error": None
+        }
+        outcomes.append(outcome)
+        sample = samples.get(sample_id)
+        if sample is None:
+            outcome["status"] = "error"
+            outcome["error"] = "Sample not found"
+            continue
+        outcome["name"] = sample["name"]
+        try:
+            s_c = create_feedback_s_c(user, sample, value, component)
+        except ValueError as e:
+            outcome["status"] = "error"
+            outcome["error"] = str(e)
+            continue
+        sample, outcome["old_value"] = add_user_feedback_to_properties(sample, s_c)
+        sample_components.append(s_c)
+        stampers.append(sample["properties"]["stamper"])
+        pending.append(outcome)
+
+    for i in mongo_interface.save_feedback_batch(sample_components, stampers):
+        pending[i]["status"] = "error"
+        pending[i]["error"] = "Write failed"
+    return outcomes
+
 def add_batch_user_feedback_and_mail(feedback_pairs, user):
     """
     Main function called to send sample QC feedback
     """
+    outcomes = add_batch_user_feedback(feedback_pairs, user)
     email_pairs = []
-    for sample_id, value in feedback_pairs:
-        name, old_value = add_user_feedback(user, sample_id, value)
-        runs = mongo_interface.get_sample_runs([ObjectId(sample_id)])
-        run_names = [run["name"] for run in runs]
-        if "fail:core facility" in (old_value, value):
-            email_pairs.append(name, old_value, value, run_names)
+    for outcome in outcomes:
+        if outcome["status"] != "ok":
+            continue
+        old_value = str(outcome["old_value"])
+        if "fail:core facility" in (old_value, outcome["value"]):
+            email_pairs.append((outcome["name"], old_value,
+                                outcome["value"], outcome["run_names"]))
     send_mail(email_pairs, user)
+    return outcomes
 
 
 def get_component(name=None, version=None):
@@ -3,14 +3,17 @@ import os
 from datetime import datetime
 import math
 import re
+import time
+import threading
 import pymongo
 import keys  # .gitgnored file
 from bson.objectid import ObjectId
 from bson.son import SON
-import atexit
-import math
-
-CONNECTION = None
+import components.mongo_connection as mongo_connection
+import components.invalidation as invalidation
+import components.name_search as name_search
+import components.pagination as paging
+import components.species_summary as species_summary
 
 PAGESIZE = 10
 
@@ -22,27 +25,13 @@ def date_now():
     d = datetime.utcnow()
     return d.replace(microsecond=math.floor(d.microsecond/1000)*1000)
 
-CONNECTION = None
-
 
 def close_connection():
-    global CONNECTION
-    if CONNECTION is not None:
-        CONNECTION.close()
-
-atexit.register(close_connection)
+    mongo_connection.close_connection()
 
 def get_connection():
-    global CONNECTION
-    if CONNECTION is not None:
-        return CONNECTION
-    else:
-        mongo_db_key = os.getenv("LOCAL_DB_KEY", None)
-        if mongo_db_key is None:
-            exit("LOCAL_DB_KEY env variable is not set.")
-        "Return mongodb connection"
-        CONNECTION = pymongo.MongoClient(mongo_db_key)
-        return CONNECTION
+    "Return the shared pooled mongodb connection"
+    return mongo_connection.get_connection()
 
 def check_run_name(name):
     connection = get_connection()
@@ -103,14 +92,36 @@ def get_group_list(run_name=None):
     return groups
 
 
+def species_pipeline(spe_field, sample_ids=None):
+    """
+    Aggregation counting samples per species, optionally within sample_ids.
+    """
+    pipeline = [
+        {
+            "$group": {
+                "_id": "$" + spe_field,
+                "count": {"$sum": 1}
+            }
+        },
+        {
+            "$sort": {"_id": 1}
+        }
+    ]
+    if sample_ids is not None:
+        pipeline.insert(0, {"$match": {"_id": {"$in": sample_ids}}})
+    return pipeline
+
 def get_species_list(species_source, run_name=None):
     connection = get_connection()
-    db = connection.get_database()
+    db = connection[mongo_connection.DB_NAME]
     if species_source == "provided":
         spe_field = "properties.sample_info.summary.provided_species"
     else:
         spe_field = "properties.species_detection.summary.detected_species"
-    if run_name is not None:
+    if species_summary.is_current(db, spe_field):
+        species = species_summary.get_species_counts(
+            db, spe_field, None if run_name is None else [run_name])
+    elif run_name is not None:
         run = db.runs.find_one(
             {"name": run_name},
             {
@@ -123,34 +134,10 @@ def get_species_list(species_source, run_name=None):
         else:
             run_samples = run["samples"]
         sample_ids = [s["_id"] for s in run_samples]
-        species = list(db.samples.aggregate([
-            {
-                "$match": {
-                    "_id": {"$in": sample_ids}
-                }
-            },
-            {
-                "$group": {
-                    "_id": "$" + spe_field,
-                    "count": {"$sum": 1}
-                }
-            },
-            {
-                "$sort": {"_id": 1}
-            }
-        ]))
+        species = list(db.samples.aggregate(
+            species_pipeline(spe_field, sample_ids)))
     else:
-        species = list(db.samples.aggregate([
-            {
-                "$group": {
-                    "_id": "$" + spe_field,
-                    "count": {"$sum": 1}
-                }
-            },
-            {
-                "$sort": {"_id": 1}
-            }
-        ]))
+        species = list(db.samples.aggregate(species_pipeline(spe_field)))
     return species
 
 
@@ -175,30 +162,27 @@ def filter_qc(qc_list):
     return {"$match": {"$and": qc_query}}
 
 
-def filter(run_names=None,
-           species=None, species_source="species", group=None,
-           qc_list=None, samples=None, pagination=None,
-           sample_names=None,
-           projection=None):
+def filter_query(db, run_names=None,
+                 species=None, species_source="species", group=None,
+                 qc_list=None, samples=None,
+                 sample_names=None, after=None, where=None):
+    """
+    Build the samples match query used by filter(). after is a keyset page
+    token (see components.pagination) and where an extra match condition,
+    such as a translated table filter (see components.table_query).
+    samples=[] matches no sample, while None does not restrict the ids.
+    """
     if species_source == "provided":
         spe_field = "properties.provided_species"
     elif species_source == "detected":
         spe_field = "properties.detected_species"
     else:
         spe_field = "properties.species"
-    connection = get_connection()
-    db = connection['bifrost_upgrade_test']
     query = []
     sample_set = set()
     if sample_names is not None and len(sample_names) != 0:
-        sample_names_query = []
-        for s_n in sample_names:
-            if s_n.startswith("/") and s_n.endswith("/"):
-                sample_names_query.append(re.compile(s_n[1:-1]))
-            else:
-                sample_names_query.append(s_n)
-        query.append({"name": {"$in": sample_names_query}})
-    if samples is not None and len(samples) != 0:
+        query.append(name_search.names_query(db, sample_names))
+    if samples is not None:
         sample_set = {ObjectId(id) for id in samples}
         query.append({"_id": {"$in": list(sample_set)}})
     if run_names is not None and len(run_names) != 0:
@@ -214,8 +198,8 @@ def filter(run_names=None,
         else:
             run_sample_set = {s["_id"] for run in runs for s in run['samples']}
 
-        if len(sample_set):
-            inter = run_sample_set.intersect(sample_set)
+        if samples is not None:
+            inter = run_sample_set.intersection(sample_set)
             query.append({"_id": {"$in": list(inter)}})
         else:
             query.append({"_id": {"$in": list(run_sample_set)}})
@@ -245,16 +229,11 @@ def filter(run_names=None,
             query.append(
                 {"properties.sample_info.summary.group": {"$in": group}})
 
-    if pagination is not None:
-        p_limit = pagination['page_size']
-        p_skip = pagination['page_size'] * pagination['current_page']
-    else:
-        p_limit = 1000
-        p_skip = 0
-
-    skip_limit_steps = [
-        {"$skip": p_skip}, {"$limit": p_limit}
-    ]
+    after_query = paging.keyset_query(after)
+    if after_query is not None:
+        query.append(after_query)
+    if where is not None:
+        query.append(where)
 
     qc_query = filter_qc(qc_list)
 
@@ -268,27 +247,284 @@ def filter(run_names=None,
             match_query = {"$and": query}
         else:
             match_query = {"$and": query + qc_query["$match"]["$and"]}
+    return match_query
+
+
+FILTER_BATCH_SIZE = 1000
+
+
+def filter(run_names=None,
+           species=None, species_source="species", group=None,
+           qc_list=None, samples=None, pagination=None,
+           sample_names=None,
+           projection=None, where=None, sort=None):
+    """
+    sort is a pymongo sort for skip/limit pages, paging.SORT by default.
+    Keyset pages are always in paging.SORT order.
+    """
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    after = None
+    if pagination is not None:
+        p_limit = pagination['page_size']
+        if paging.is_keyset(pagination):
+            p_skip = 0
+            after = pagination['after']
+            projection = paging.keyset_projection(projection)
+        else:
+            p_skip = pagination['page_size'] * pagination['current_page']
+    else:
+        p_limit = 0
+        p_skip = 0
+
+    match_query = filter_query(
+        db, run_names=run_names, species=species,
+        species_source=species_source, group=group, qc_list=qc_list,
+        samples=samples, sample_names=sample_names, after=after,
+        where=where)
+    if sort is None or after is not None:
+        sort = paging.SORT
     query_result = list(db.samples.find(
-        match_query, projection).sort([('name', pymongo.ASCENDING)]).skip(p_skip).limit(p_limit))
+        match_query, projection).sort(sort).skip(p_skip).limit(p_limit))
 
     return query_result
 
-def get_species_QC_values(ncbi_species):
+
+def count_filtered(run_names=None,
+                   species=None, species_source="species", group=None,
+                   qc_list=None, samples=None,
+                   sample_names=None, where=None):
+    """
+    Number of samples filter() returns without pagination, counted on the
+    server.
+    """
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    match_query = filter_query(
+        db, run_names=run_names, species=species,
+        species_source=species_source, group=group, qc_list=qc_list,
+        samples=samples, sample_names=sample_names, where=where)
+    return db.samples.count_documents(match_query)
+
+
+def filter_batches(run_names=None,
+                   species=None, species_source="species", group=None,
+                   qc_list=None, samples=None,
+                   sample_names=None,
+                   projection=None, batch_size=FILTER_BATCH_SIZE):
+    """
+    Generator version of filter() without pagination: yields lists of up to
+    batch_size samples, fetched from one cursor batch by batch.
+    """
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    match_query = filter_query(
+        db, run_names=run_names, species=species,
+        species_source=species_source, group=group, qc_list=qc_list,
+        samples=samples, sample_names=sample_names)
+    cursor = db.samples.find(
+        match_query, projection, batch_size=batch_size).sort(paging.SORT)
+    batch = []
+    try:
+        for sample in cursor:
+            batch.append(sample)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if len(batch):
+            yield batch
+    finally:
+        cursor.close()
+
+# Species QC thresholds are a small, rarely edited table, so it is kept in
+# memory and reloaded every SPECIES_QC_TTL seconds or when invalidated.
+SPECIES_QC_TTL = int(os.getenv("SPECIES_QC_TTL", 600))
+SPECIES_QC_KEYS = ("ncbi_species", "organism", "group")
+
+_SPECIES_QC = None
+_SPECIES_QC_LOCK = threading.Lock()
+_SPECIES_QC_VERSION = 0
+
+
+def invalidate_species_QC_table():
+    "Force a reload of the species QC table on next use"
+    global _SPECIES_QC_VERSION
+    _SPECIES_QC_VERSION += 1
+
+
+def load_species_QC_table():
+    """
+    Read bifrost_species.species into one lookup per key. As with find_one,
+    the first document (natural order) wins for duplicated keys.
+    """
     connection = get_connection()
     db = connection.get_database('bifrost_species')
-    species = db.species.find_one({"ncbi_species": ncbi_species}, {
-                        "min_length": 1, "max_length": 1})
-    if species is not None:
-        return species
-    species = db.species.find_one({"organism": ncbi_species}, {
-        "min_length": 1, "max_length": 1})
-    if species is not None:
-        return species
-    species = db.species.find_one({"group": ncbi_species}, {
-        "min_length": 1, "max_length": 1})
+    table = {key: {} for key in SPECIES_QC_KEYS}
+    projection = {"min_length": 1, "max_length": 1}
+    projection.update({key: 1 for key in SPECIES_QC_KEYS})
+    for species in db.species.find({}, projection):
+        values = {"_id": species["_id"],
+                  "min_length": species.get("min_length"),
+                  "max_length": species.get("max_length")}
+        for key in SPECIES_QC_KEYS:
+            name = species.get(key)
+            if name is not None and name not in table[key]:
+                table[key][name] = values
+    return table
+
+
+def get_species_QC_table():
+    global _SPECIES_QC
+    current = _SPECIES_QC
+    if (current is not None and current["version"] == _SPECIES_QC_VERSION
+            and time.time() - current["loaded_at"] < SPECIES_QC_TTL):
+        return current["table"]
+    with _SPECIES_QC_LOCK:
+        current = _SPECIES_QC
+        if (current is None or current["version"] != _SPECIES_QC_VERSION
+                or time.time() - current["loaded_at"] >= SPECIES_QC_TTL):
+            version = _SPECIES_QC_VERSION
+            current = {"table": load_species_QC_table(),
+                       "loaded_at": time.time(),
+                       "version": version}
+            _SPECIES_QC = current
+    return current["table"]
+
+
+def lookup_species_QC_values(table, ncbi_species):
+    for key in SPECIES_QC_KEYS:
+        species = table[key].get(ncbi_species)
+        if species is not None:
+            return dict(species)
+    species = table["organism"].get("default")
     if species is not None:
-        return species
-    species = db.species.find_one({"organism": "default"}, {
-        "min_length": 1, "max_length": 1})
-    return species
+        return dict(species)
+    return None
+
+
+def get_species_QC_values(ncbi_species):
+    return lookup_species_QC_values(get_species_QC_table(), ncbi_species)
+
+
+def get_species_QC_values_many(species_list):
+    """
+    Return {species: QC values} for every species in species_list.
+    """
+    table = get_species_QC_table()
+    return {species: lookup_species_QC_values(table, species)
+            for species in species_list}
+
+
+def get_sample(sample_id):
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    return db.samples.find_one({"_id": sample_id})
 
+
+def get_samples(sample_ids, projection=None):
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    return list(db.samples.find({"_id": {"$in": sample_ids}}, projection))
+
+
+def get_sample_runs(sample_ids):
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    return list(db.runs.find({"samples._id": {"$in": sample_ids}},
+                             {"name": 1, "samples._id": 1}))
+
+
+def save_sample(sample):
+    """
+    Replace (or insert) a sample and keep the species summary in step.
+    """
+    connection = get_connection()
+    db = connection[mongo_connection.DB_NAME]
+    sample["metadata"] = sample.get("metadata", {})
+    sample["metadata"]["updated_at"] = date_now()
+    name_search.set_trigrams(sample)
+    if "_id" in sample:
+        old_sample = db.samples.find_one_and_replace(
+            {"_id": sample["_id"]}, sample, upsert=True)
+    else:
+        old_sample = None
+        sample["metadata"]["created_at"] = sample["metadata"]["updated_at"]
+        sample["_id"] = db.samples.insert_one(sample).inserted_id
+    run_names = [run["name"] for run in get_sample_runs([sample["_id"]])]
+    species_summary.update_species_summary(db, old_sample, sample, run_names)
+    name_search.update_name_trigrams(db, old_sample, sample)
+    invalidation.publish("samples", "replace", [sample["_id"]])
+    return sample
+
+
+def get_component(name=None, version=None):
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    query = {}
+    if name is not None:
+        query["name"] = name
+    if version is not None:
+        query["version"] = version
+    return db.components.find_one(query, sort=[("_id", pymongo.DESCENDING)])
+
+
+def save_component(component):
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    component = dict(component)
+    component["_id"] = db.components.insert_one(component).inserted_id
+    return component
+
+
+def save_sample_component(sample_component):
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    if "_id" in sample_component:
+        db.sample_components.replace_one(
+            {"_id": sample_component["_id"]}, sample_component, upsert=True)
+    else:
+        sample_component["_id"] = db.sample_components.insert_one(
+            sample_component).inserted_id
+    invalidation.publish("sample_components", "replace",
+                         [sample_component["_id"]])
+    return sample_component
+
+
+def failed_write_indexes(bulk_error):
+    return {error["index"] for error in bulk_error.details.get("writeErrors", [])}
+
+
+def save_feedback_batch(sample_components, stampers):
+    """
+    Insert the feedback sample_components and set properties.stamper on
+    their samples with two unordered bulk writes. sample_components and
+    stampers are parallel lists. Returns the set of positions that failed.
+    """
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    failed = set()
+    if len(sample_components) == 0:
+        return failed
+    try:
+        db.sample_components.bulk_write(
+            [pymongo.InsertOne(s_c) for s_c in sample_components],
+            ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        failed |= failed_write_indexes(e)
+    now = date_now()
+    updates = [(i, pymongo.UpdateOne(
+                    {"_id": s_c["sample"]["_id"]},
+                    {"$set": {"properties.stamper": stamper,
+                              "metadata.updated_at": now}}))
+               for i, (s_c, stamper) in enumerate(zip(sample_components, stampers))
+               if i not in failed]
+    if len(updates):
+        try:
+            db.samples.bulk_write([u for i, u in updates], ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            failed |= {updates[n][0] for n in failed_write_indexes(e)}
+    invalidation.publish(
+        "samples", "update",
+        [s_c["sample"]["_id"] for i, s_c in enumerate(sample_components)
+         if i not in failed])
+    return failed
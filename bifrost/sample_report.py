@@ -1,7 +1,9 @@
 import dash_html_components as html
+import dash_core_components as dcc
 from bifrost.images import list_of_images
 from bifrost.table import html_table, html_td_percentage
 import components.global_vars as global_vars
+from components.tracing import traced
 import bifrost.admin as admin
 import dash_bootstrap_components as dbc
 import pandas as pd
@@ -18,14 +20,15 @@ def get(dict_o, field, default=None):
     else:
         return r
 
-def sample_report(data):
-
-    sample_n = len(data)
+@traced
+def sample_report(sample_n):
 
     return [
         html.Span("0", style={"display": "none"}, id="page-n"),
         html.Span(str(sample_n // SAMPLE_PAGESIZE),
                   style={"display": "none"}, id="max-page"),
+        # Keyset page tokens, page_cursors[n] is where page n starts.
+        dcc.Store(id="page-cursors", data=[None]),
         dbc.Row(
             [
                 dbc.Col(
@@ -428,6 +431,7 @@ def html_sample_tables(sample_data, **kwargs):
     ])
 
 
+@traced
 def children_sample_list_report(dataframe):
     report = []
     row_index = 0
@@ -0,0 +1,192 @@
+"""
+Asyncio (Motor) variant of the mongo interface, with the same function
+surface as components.mongo_interface / bifrost.bifrost_mongo_interface.
+
+Dash callbacks are synchronous, so the coroutines run on one background
+event loop per worker process. Use gather() to run independent queries of
+a callback concurrently:
+
+    species_options, samples = async_mongo_interface.gather(
+        async_mongo_interface.get_species_list(run_names),
+        async_mongo_interface.filter(run_names=run_names))
+"""
+import os
+import asyncio
+import threading
+from bson.objectid import ObjectId
+
+import components.mongo_connection as mongo_connection
+from components.command_stats import CALLER
+import components.mongo_interface as mongo_interface
+import components.pagination as paging
+import components.species_summary as species_summary
+
+_LOOP = None
+_LOOP_PID = None
+_LOOP_LOCK = threading.Lock()
+
+
+def get_loop():
+    """
+    Return the background event loop of this process, starting it on first
+    use (and again after a fork, as the thread does not survive it).
+    """
+    global _LOOP, _LOOP_PID, _LOOP_LOCK
+    if _LOOP_PID != os.getpid():
+        _LOOP = None
+        _LOOP_PID = os.getpid()
+        _LOOP_LOCK = threading.Lock()
+    if _LOOP is not None:
+        return _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever,
+                                      name="mongo-async-loop", daemon=True)
+            thread.start()
+            _LOOP = loop
+    return _LOOP
+
+
+async def _attributed(coroutine):
+    # Each task has its own context, so the commands of the coroutine are
+    # attributed to it in components.command_stats.
+    CALLER.set("{}.{}".format(coroutine.cr_frame.f_globals["__name__"],
+                              coroutine.cr_code.co_name))
+    return await coroutine
+
+
+def run(coroutine):
+    "Run a coroutine on the background loop and wait for its result"
+    return asyncio.run_coroutine_threadsafe(
+        _attributed(coroutine), get_loop()).result()
+
+
+async def _gather(coroutines):
+    return await asyncio.gather(*[_attributed(c) for c in coroutines])
+
+
+def gather(*coroutines):
+    "Run coroutines concurrently and return their results in order"
+    return run(_gather(coroutines))
+
+
+def get_db(name=mongo_connection.DB_NAME):
+    return mongo_connection.get_async_connection()[name]
+
+
+async def get_run_sample_ids(db, run_names):
+    runs = await db.runs.find(
+        *mongo_interface.run_samples_query(run_names)).to_list(None)
+    return {s["_id"] for run in runs for s in run.get("samples", [])}
+
+
+async def get_run_list():
+    db = get_db()
+    return await db.runs.find(*mongo_interface.RUN_LIST).sort(
+        mongo_interface.NEWEST_FIRST).to_list(None)
+
+
+async def species_summary_current(db, spe_field):
+    "species_summary.is_current() on Motor"
+    if spe_field not in species_summary.SPECIES_FIELDS:
+        return False
+    current, generation = species_summary.cached_current(db.name)
+    if current is None:
+        newest = [await db[collection].find_one(
+                      *species_summary.NEWEST, sort=species_summary.NEWEST_SORT)
+                  for collection in ("samples", "runs")]
+        current = species_summary.state_is_current(
+            await db[species_summary.COLLECTION].find_one(species_summary.STATE),
+            newest)
+        species_summary.remember_current(db.name, generation, current)
+    return current
+
+
+async def get_species_list(run_name=None):
+    db = get_db()
+    spe_field = "properties.detected_species"
+    if (species_summary.covers(run_name)
+            and await species_summary_current(db, spe_field)):
+        species = species_summary.merge_counts(
+            await db[species_summary.COLLECTION].find(
+                species_summary.counts_query(spe_field, run_name),
+                species_summary.COUNTS_PROJECTION).to_list(None))
+    elif run_name is not None:
+        sample_ids = list(await get_run_sample_ids(db, run_name))
+        species = await db.samples.aggregate(
+            mongo_interface.species_pipeline(spe_field, sample_ids)).to_list(None)
+    else:
+        species = await db.samples.aggregate(
+            mongo_interface.species_pipeline(spe_field)).to_list(None)
+
+    return [{"label": "{}".format(i['_id']),
+             "value": "{}".format(i['_id'])} for i in species]
+
+
+async def filter(run_names=None,
+                 species=None, species_source="species", group=None,
+                 qc_list=None, samples=None, pagination=None,
+                 sample_names=None,
+                 projection=None):
+    db = get_db()
+    if run_names is not None and len(run_names) != 0:
+        # Resolve runs here so filter_query() needs no (sync) db access.
+        sample_set = await get_run_sample_ids(db, run_names)
+        if samples is not None:
+            sample_set &= {ObjectId(id) for id in samples}
+        if len(sample_set) == 0:
+            return []
+        samples = list(sample_set)
+
+    after = None
+    if pagination is not None:
+        p_limit = pagination['page_size']
+        if paging.is_keyset(pagination):
+            p_skip = 0
+            after = pagination['after']
+            projection = paging.keyset_projection(projection)
+        else:
+            p_skip = pagination['page_size'] * pagination['current_page']
+    else:
+        p_limit = 0
+        p_skip = 0
+
+    match_query = mongo_interface.filter_query(
+        None, species=species, species_source=species_source, group=group,
+        qc_list=qc_list, samples=samples, sample_names=sample_names,
+        after=after)
+    return await db.samples.find(match_query, projection).sort(
+        paging.SORT).skip(p_skip).limit(p_limit).to_list(None)
+
+
+async def get_species_QC_values(ncbi_species):
+    """
+    The four lookups of the sync version run concurrently; the first match
+    in ncbi_species, organism, group, default order wins.
+    """
+    db = mongo_connection.get_async_connection().get_database('bifrost_species')
+    projection = {"min_length": 1, "max_length": 1}
+    results = await asyncio.gather(
+        db.species.find_one({"ncbi_species": ncbi_species}, projection),
+        db.species.find_one({"organism": ncbi_species}, projection),
+        db.species.find_one({"group": ncbi_species}, projection),
+        db.species.find_one({"organism": "default"}, projection))
+    for species in results:
+        if species is not None:
+            return species
+    return None
+
+
+async def get_survey(selected_survey):
+    db = get_db()
+    surveys = await db.surveys.find(
+        {"_id": ObjectId(selected_survey)}).to_list(None)
+    for survey in surveys:
+        if "case_keys" in survey:
+            found = await db.cases.find(
+                {"case_key": {"$in": survey["case_keys"]}},
+                {"_id": 0}).to_list(None)
+            survey["cases"] = mongo_interface.survey_cases(
+                survey["case_keys"], found)
+    return surveys
@@ -0,0 +1,314 @@
+"""
+Per-callback performance metrics, served in the Prometheus text format on
+/metrics.
+
+instrument(app) wraps every registered Dash callback to record its calls,
+errors, wall time, request and response bytes, and the time spent in
+mongo commands, in pandas and in building figures. Background jobs are
+measured the same way, as "job <name>". The pandas and figure
+time is measured by phase() blocks in the data and report code; mongo
+time comes from components.command_stats.
+
+Metrics are summed in memory and added to a sqlite file (METRICS_PATH)
+every METRICS_FLUSH_INTERVAL seconds by a background thread, so callbacks
+don't wait on it and a scrape of any worker reports the totals of all the
+workers of the host.
+"""
+import os
+import time
+import atexit
+import logging
+import sqlite3
+import tempfile
+import threading
+import contextlib
+import flask
+from dash.exceptions import PreventUpdate
+
+from components.command_stats import COMMAND_STATS
+import components.result_cache as result_cache
+import components.figure_cache as figure_cache
+import components.tracing as tracing
+
+METRICS_PATH = os.getenv(
+    "METRICS_PATH", os.path.join(tempfile.gettempdir(), "beone_metrics.sqlite"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+
+# Upper bounds of the callback duration buckets, in seconds.
+BUCKETS_S = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PHASES = ("mongo", "pandas", "figure")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    callback TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (callback, name)
+);
+"""
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+_connections = threading.local()
+
+# {(callback, name): value} not written yet, and the process they belong
+# to, as a fork copies them.
+_pending = {}
+_pending_pid = None
+_pending_lock = threading.Lock()
+_flusher = None
+
+
+def _connection():
+    connection = getattr(_connections, "connection", None)
+    if connection is None or _connections.pid != os.getpid():
+        connection = sqlite3.connect(METRICS_PATH, timeout=30,
+                                     isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+        _connections.connection = connection
+        _connections.pid = os.getpid()
+    return connection
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Count the time of the block, less the mongo commands and the nested
+    phases in it, as phase name of the running callback, and trace it as
+    a span. A no-op outside instrumented callbacks and traces.
+    """
+    with tracing.span(name):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            yield
+        else:
+            with _timed(name, stack):
+                yield
+
+
+@contextlib.contextmanager
+def _timed(name, stack):
+    frame = {"start": time.perf_counter(),
+             "mongo_start": COMMAND_STATS.thread_time_ms(),
+             "children": 0.0, "children_mongo": 0.0}
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        total = time.perf_counter() - frame["start"]
+        mongo = (COMMAND_STATS.thread_time_ms() - frame["mongo_start"]) / 1000.0
+        own = total - frame["children"] - (mongo - frame["children_mongo"])
+        _local.phases[name] = _local.phases.get(name, 0.0) + own
+        if stack:
+            stack[-1]["children"] += total
+            stack[-1]["children_mongo"] += mongo
+
+
+def record(callback, values):
+    "Add values to the metrics of callback, to be written by flush()"
+    global _pending, _pending_pid, _flusher
+    with _pending_lock:
+        if _pending_pid != os.getpid():
+            _pending = {}
+            _pending_pid = os.getpid()
+            _flusher = threading.Thread(target=_flush_loop,
+                                        name="metrics-flusher", daemon=True)
+            _flusher.start()
+        for name, value in values.items():
+            key = (callback, name)
+            _pending[key] = _pending.get(key, 0) + value
+
+
+def flush():
+    "Add the metrics recorded by this process to METRICS_PATH"
+    global _pending
+    with _pending_lock:
+        if _pending_pid != os.getpid() or not _pending:
+            return
+        pending, _pending = _pending, {}
+    connection = _connection()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT INTO metrics VALUES (?, ?, ?) "
+                "ON CONFLICT (callback, name) DO UPDATE SET value = value + ?",
+                [(callback, name, value, value)
+                 for (callback, name), value in pending.items()])
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+    except sqlite3.Error:
+        # Keep them for the next flush.
+        with _pending_lock:
+            for key, value in pending.items():
+                _pending[key] = _pending.get(key, 0) + value
+        raise
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except sqlite3.Error:
+            log.exception("Could not write the callback metrics")
+
+
+atexit.register(flush)
+
+
+def measure(name, function, prevented=(PreventUpdate,)):
+    """
+    Wrap a callback function, as stored in Dash's callback_map. Exceptions
+    of the prevented types are counted as prevented rather than errors.
+    """
+    def instrumented(*args, **kwargs):
+        _local.stack = []
+        _local.phases = {}
+        mongo_start = COMMAND_STATS.thread_time_ms()
+        start = time.perf_counter()
+        values = {"calls": 1}
+        response = None
+        try:
+            response = function(*args, **kwargs)
+            return response
+        except prevented:
+            values["prevented"] = 1
+            raise
+        except Exception:
+            values["errors"] = 1
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            values["duration_sum"] = duration
+            for bound in BUCKETS_S:
+                if duration <= bound:
+                    values["duration_le_{}".format(bound)] = 1
+                    break
+            values["phase_mongo"] = (
+                COMMAND_STATS.thread_time_ms() - mongo_start) / 1000.0
+            for phase_name, seconds in _local.phases.items():
+                values["phase_" + phase_name] = seconds
+            if flask.has_request_context():
+                values["request_bytes"] = flask.request.content_length or 0
+            if isinstance(response, (str, bytes)):
+                values["response_bytes"] = len(response)
+            _local.stack = None
+            record(name, values)
+
+    instrumented.__name__ = getattr(function, "__name__", name)
+    instrumented.__wrapped__ = function
+    instrumented.measured = True
+    return instrumented
+
+
+def instrument(app):
+    """
+    Wrap every callback registered on app so far. Call it after the last
+    @app.callback.
+    """
+    for entry in app.callback_map.values():
+        function = entry["callback"]
+        if getattr(function, "measured", False):
+            continue
+        entry["callback"] = measure(
+            getattr(function, "__name__", "callback"), function)
+
+
+def read_metrics():
+    """
+    Return {callback: {name: value}} summed over all workers, as of their
+    last flush.
+    """
+    try:
+        flush()
+    except sqlite3.Error:
+        log.exception("Could not write the callback metrics")
+    metrics = {}
+    for callback, name, value in _connection().execute(
+            "SELECT callback, name, value FROM metrics"):
+        metrics.setdefault(callback, {})[name] = value
+    return metrics
+
+
+def _line(metric, labels, value):
+    label_text = ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in labels)
+    return "{}{{{}}} {}".format(metric, label_text, repr(float(value)))
+
+
+def prometheus_text():
+    lines = []
+    metrics = read_metrics()
+
+    def family(metric, kind, help_text):
+        lines.append("# HELP {} {}".format(metric, help_text))
+        lines.append("# TYPE {} {}".format(metric, kind))
+
+    for metric, name, help_text in [
+            ("beone_callback_calls_total", "calls", "Dash callback calls."),
+            ("beone_callback_errors_total", "errors",
+             "Dash callbacks that raised an error."),
+            ("beone_callback_prevented_total", "prevented",
+             "Dash callbacks that raised PreventUpdate."),
+            ("beone_callback_request_bytes_total", "request_bytes",
+             "Bytes of the callback requests."),
+            ("beone_callback_response_bytes_total", "response_bytes",
+             "Bytes of the callback responses.")]:
+        family(metric, "counter", help_text)
+        for callback in sorted(metrics):
+            lines.append(_line(metric, [("callback", callback)],
+                               metrics[callback].get(name, 0)))
+
+    family("beone_callback_duration_seconds", "histogram",
+           "Wall time of the Dash callbacks.")
+    for callback in sorted(metrics):
+        values = metrics[callback]
+        cumulative = 0
+        for bound in BUCKETS_S:
+            cumulative += values.get("duration_le_{}".format(bound), 0)
+            lines.append(_line("beone_callback_duration_seconds_bucket",
+                               [("callback", callback), ("le", bound)],
+                               cumulative))
+        lines.append(_line("beone_callback_duration_seconds_bucket",
+                           [("callback", callback), ("le", "+Inf")],
+                           values.get("calls", 0)))
+        lines.append(_line("beone_callback_duration_seconds_sum",
+                           [("callback", callback)],
+                           values.get("duration_sum", 0)))
+        lines.append(_line("beone_callback_duration_seconds_count",
+                           [("callback", callback)], values.get("calls", 0)))
+
+    family("beone_callback_phase_seconds_total", "counter",
+           "Time the Dash callbacks spent in mongo, pandas and figures.")
+    for callback in sorted(metrics):
+        for phase_name in PHASES:
+            lines.append(_line("beone_callback_phase_seconds_total",
+                               [("callback", callback), ("phase", phase_name)],
+                               metrics[callback].get("phase_" + phase_name, 0)))
+
+    for cache_name, description, get_stats in [
+            ("result", "filter_all result", result_cache.get_stats),
+            ("figure", "figure", figure_cache.get_stats)]:
+        cache_stats = get_stats()
+        for name in ("hits", "misses", "evictions"):
+            metric = "beone_{}_cache_{}_total".format(cache_name, name)
+            family(metric, "counter", "{} cache {}.".format(description, name))
+            lines.append("{} {}".format(metric, repr(float(cache_stats[name]))))
+        metric = "beone_{}_cache_bytes".format(cache_name)
+        family(metric, "gauge", "Bytes held by the {} cache.".format(
+            description))
+        lines.append("{} {}".format(metric, repr(float(cache_stats["bytes"]))))
+    return "\n".join(lines) + "\n"
+
+
+def add_metrics_route(server, path="/metrics"):
+    def metrics():
+        return flask.Response(prometheus_text(),
+                              mimetype="text/plain; version=0.0.4")
+    server.add_url_rule(path, "metrics", metrics)
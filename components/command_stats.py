@@ -0,0 +1,161 @@
+"""
+Command monitoring for the shared mongo clients.
+
+Every command is timed and attributed to the interface function that sent
+it (the innermost caller in components/ or bifrost/, or for Motor the
+coroutine given to components.async_mongo_interface). Latencies go into
+per (function, command) histograms, and commands slower than
+MONGO_SLOW_QUERY_MS are written to the "beone.slow_queries" log.
+
+MONGO_RECORD_REPLY_SIZE=1 also records the BSON size of the replies,
+which costs encoding every reply again.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import contextvars
+import bson
+from pymongo import monitoring
+
+SLOW_QUERY_MS = float(os.getenv("MONGO_SLOW_QUERY_MS", 100))
+RECORD_REPLY_SIZE = os.getenv("MONGO_RECORD_REPLY_SIZE", "0") == "1"
+
+# Upper bounds of the latency buckets, in milliseconds.
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+              float("inf"))
+
+SOURCE_PACKAGES = ("components", "bifrost")
+IGNORED_MODULES = ("components.mongo_connection", "components.command_stats")
+
+slow_log = logging.getLogger("beone.slow_queries")
+
+# Function a Motor command is sent for. Motor sends commands from its own
+# threads, whose stack holds no repo frame, but carries context variables
+# there.
+CALLER = contextvars.ContextVar("mongo_caller", default=None)
+
+
+def calling_function():
+    """
+    Return "module.function" of the innermost repo frame on the stack,
+    or else of the CALLER context variable.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if (module.split(".")[0] in SOURCE_PACKAGES
+                and module not in IGNORED_MODULES):
+            return "{}.{}".format(module, frame.f_code.co_name)
+        frame = frame.f_back
+    return CALLER.get() or "unknown"
+
+
+def reply_documents(reply):
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+        if batch is not None:
+            return len(batch)
+    n = reply.get("n")
+    return n if isinstance(n, int) else 0
+
+
+def new_histogram():
+    return {
+        "count": 0,
+        "failures": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+        "documents": 0,
+        "reply_bytes": 0,
+        "buckets": [0] * len(BUCKETS_MS),
+    }
+
+
+class CommandStats(monitoring.CommandListener):
+
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS):
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = threading.local()
+        self.histograms = {}
+
+    def started(self, event):
+        # Called in the thread issuing the command, so the stack still
+        # holds the interface function.
+        self._pending[(event.connection_id, event.request_id)] = (
+            calling_function(), event.command)
+
+    def _finish(self, event, reply=None):
+        function, command = self._pending.pop(
+            (event.connection_id, event.request_id), ("unknown", {}))
+        duration_ms = event.duration_micros / 1000.0
+        self._thread.total_ms = self.thread_time_ms() + duration_ms
+        documents = 0
+        reply_bytes = 0
+        if reply is not None:
+            documents = reply_documents(reply)
+            if RECORD_REPLY_SIZE:
+                reply_bytes = len(bson.encode(reply))
+        key = (function, event.command_name)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = new_histogram()
+            histogram["count"] += 1
+            histogram["total_ms"] += duration_ms
+            histogram["max_ms"] = max(histogram["max_ms"], duration_ms)
+            histogram["documents"] += documents
+            histogram["reply_bytes"] += reply_bytes
+            if reply is None:
+                histogram["failures"] += 1
+            for i, bound in enumerate(BUCKETS_MS):
+                if duration_ms <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+        if duration_ms >= self.slow_query_ms:
+            slow_log.warning(
+                "%.1fms %s %s.%s from %s: %d documents, %d bytes, %.500s",
+                duration_ms, event.command_name, event.database_name,
+                command.get(event.command_name, ""), function, documents,
+                reply_bytes, {k: v for k, v in command.items()
+                              if k in ("filter", "pipeline", "sort", "limit",
+                                       "skip", "projection", "query")})
+
+    def succeeded(self, event):
+        self._finish(event, event.reply)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def thread_time_ms(self):
+        """
+        Total time of the commands finished in this thread. Motor commands
+        finish in other threads and are not counted.
+        """
+        return getattr(self._thread, "total_ms", 0.0)
+
+    def reset(self):
+        with self._lock:
+            self._pending = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        """
+        Return {(function, command): histogram} with the bucket bounds and
+        the average latency added.
+        """
+        with self._lock:
+            stats = {}
+            for key, histogram in self.histograms.items():
+                histogram = dict(histogram, buckets=list(histogram["buckets"]))
+                histogram["bucket_bounds_ms"] = BUCKETS_MS
+                histogram["avg_ms"] = histogram["total_ms"] / histogram["count"]
+                stats[key] = histogram
+            return stats
+
+
+COMMAND_STATS = CommandStats()
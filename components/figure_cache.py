@@ -0,0 +1,60 @@
+"""
+Cache of rendered figures, shared by the workers of a host.
+
+Figures are stored once as plotly JSON in a components.result_cache file
+(FIGURE_CACHE_PATH) bounded to FIGURE_CACHE_MAX_BYTES by LRU eviction.
+Keys are a digest of the sorted sample ids, the figure options and the
+data version, which is bumped on sample invalidation events instead of
+expiring entries after a timeout.
+"""
+import os
+import json
+import tempfile
+import threading
+from plotly.utils import PlotlyJSONEncoder
+
+import components.invalidation as invalidation
+import components.result_cache as result_cache
+
+FIGURE_CACHE_PATH = os.getenv(
+    "FIGURE_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "beone_figure_cache.sqlite"))
+FIGURE_CACHE_MAX_BYTES = int(os.getenv("FIGURE_CACHE_MAX_BYTES", 64 * 2**20))
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                cache = result_cache.ResultCache(
+                    FIGURE_CACHE_PATH, FIGURE_CACHE_MAX_BYTES, ttl=None)
+                invalidation.subscribe(cache.bump_version, ["samples"])
+                _CACHE = cache
+    return _CACHE
+
+
+def figure_key(name, sample_ids, version, **options):
+    return result_cache.make_key(
+        name, sample_ids=sample_ids, version=version, **options)
+
+
+def cached_figures(name, sample_ids, build, **options):
+    """
+    Return the figures build() draws for sample_ids and options, as plotly
+    JSON dicts, drawing them only on a cache miss.
+    """
+    cache = get_cache()
+    key = figure_key(name, sample_ids, cache.get_version(), **options)
+    figures_json = cache.get(key)
+    if figures_json is result_cache.MISSING:
+        figures_json = json.dumps(build(), cls=PlotlyJSONEncoder)
+        cache.set(key, figures_json)
+    return json.loads(figures_json)
+
+
+def get_stats():
+    return get_cache().get_stats()
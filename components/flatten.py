@@ -0,0 +1,131 @@
+"""
+Fast flattening of sample documents into a DataFrame, compiled once per set
+of dotted paths (usually the keys of a components.projections projection).
+
+Produces the same columns as json_normalize for the requested paths: leaf
+values become one column per path, dict values are flattened into dotted
+sub-columns and lists are kept as objects. Numeric columns are built as
+typed NumPy arrays.
+"""
+import functools
+import numpy as np
+import pandas as pd
+
+MISSING = object()
+
+
+def projection_paths(projection):
+    """
+    Return the dotted paths of an inclusion projection, or None if the
+    projection cannot be flattened from (None or an exclusion projection).
+    """
+    if projection is None:
+        return None
+    if isinstance(projection, dict):
+        if any(not v for k, v in projection.items() if k != "_id"):
+            return None
+        paths = [k for k, v in projection.items() if k != "_id"]
+        include_id = projection.get("_id", 1)
+    else:
+        paths = [k for k in projection if k != "_id"]
+        include_id = True
+    if len(paths) == 0:
+        return None
+    if include_id:
+        paths.insert(0, "_id")
+    return tuple(paths)
+
+
+def _flatten_into(columns, prefix, subtree, row):
+    for key, value in subtree.items():
+        name = prefix + "." + key
+        if isinstance(value, dict):
+            _flatten_into(columns, name, value, row)
+            continue
+        column = columns.get(name)
+        if column is None:
+            column = columns[name] = [MISSING] * row
+        elif len(column) < row:
+            column.extend([MISSING] * (row - len(column)))
+        column.append(value)
+
+
+def _to_array(values):
+    present = 0
+    numeric = True
+    all_int = True
+    for v in values:
+        if v is MISSING or v is None:
+            continue
+        present += 1
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            numeric = False
+            break
+        if not isinstance(v, int):
+            all_int = False
+    if numeric and present:
+        if all_int and present == len(values):
+            return np.array(values, dtype=np.int64)
+        return np.array([np.nan if v is MISSING or v is None else v
+                         for v in values], dtype=np.float64)
+    array = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        array[i] = np.nan if v is MISSING else v
+    return array
+
+
+@functools.lru_cache(maxsize=64)
+def compile_flattener(paths):
+    """
+    Return a function flattening a list of documents into a DataFrame with
+    the columns found under paths (a tuple of dotted paths).
+    """
+    specs = [(path, tuple(path.split("."))) for path in paths]
+
+    def flattener(docs):
+        # One column per path, always appended to, plus the sub-columns of
+        # paths holding dicts, which are padded as they appear.
+        leaves = [[] for _ in specs]
+        nested = {}
+        n = 0
+        for doc in docs:
+            for (name, keys), leaf in zip(specs, leaves):
+                value = doc
+                try:
+                    for key in keys:
+                        value = value[key]
+                except (KeyError, TypeError, IndexError):
+                    value = MISSING
+                if isinstance(value, dict):
+                    _flatten_into(nested, name, value, n)
+                    value = MISSING
+                leaf.append(value)
+            n += 1
+        columns = {}
+        for (name, keys), leaf in zip(specs, leaves):
+            if any(v is not MISSING for v in leaf):
+                columns[name] = leaf
+        for name, column in nested.items():
+            if len(column) < n:
+                column.extend([MISSING] * (n - len(column)))
+            columns[name] = column
+        return pd.DataFrame(
+            {name: _to_array(values) for name, values in columns.items()},
+            index=pd.RangeIndex(n))
+
+    return flattener
+
+
+def flatten(docs, paths):
+    return compile_flattener(tuple(paths))(docs)
+
+
+def normalize(docs, projection=None):
+    """
+    Flatten docs using the paths of projection when possible, otherwise
+    with the full json_normalize.
+    """
+    paths = projection_paths(projection)
+    if paths is None:
+        return pd.io.json.json_normalize(docs)
+    return flatten(docs, paths)
@@ -125,6 +125,30 @@ plot_values = [
 value_from_test = ["properties.stamper.summary.test__denovo_assembly__genome_size_difference_1x_10x",
                    "properties.stamper.summary.test__species_detection__main_species_level"]
 
+# Every species field samples can be grouped/plotted by
+SPECIES_FIELDS = [
+    "properties.species",
+    "properties.detected_species",
+    "properties.provided_species",
+    "properties.species_detection.summary.detected_species",
+    "properties.sample_info.summary.provided_species",
+]
+
+# Fields read by the sample cards of the sample report (bifrost/sample_report.py)
+SAMPLE_CARD_FIELDS = [
+    "name",
+    "reads",
+    "sample_sheet",
+    "report",
+    "properties.species",
+    "properties.sample_sheet.sample_name",
+    "properties.species_detection.summary",
+    "properties.denovo_assembly.summary",
+    "properties.ssi_stamper.summary",
+    "properties.stamper.summary",
+    "properties.mlst.summary.strain",
+]
+
 ROUND_COLUMNS = ["properties.species_detection.summary.percent_unclassified",
                  "properties.denovo_assembly.summary.bin_coverage_at_1x"]
 
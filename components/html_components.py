@@ -1,6 +1,5 @@
 from datetime import datetime as dt
 import os
-import bifrostapi
 import pymongo
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
@@ -10,11 +9,16 @@ import numpy as np
 import pandas as pd
 
 import components.global_vars as global_vars
+import components.mongo_connection as mongo_connection
+import components.map_data as map_data
 import bifrost.bifrost_import_data as import_data
 from components.import_data import get_db_list, get_species_list, filter_all, get_survey_list
+from components.import_data import save_survey as import_survey
 
 
 COLUMNS = global_vars.COLUMNS
+# Rows per page of the tables paged on the server.
+TABLE_PAGESIZE = int(os.getenv("TABLE_PAGESIZE", 50))
 
 def samples_list(active, collection_name=None):
     links = [
@@ -142,7 +146,8 @@ def html_topbar():
                                    ),
                     dcc.Dropdown(
                         id="db-list",
-                        options=dropdown_db_options(),
+                        # Filled by the update_db_dropdown callback
+                        options=[],
                         value=None
                     )
                 ], className='pretty_container two columns', style={'border': '1px DarkGrey solid',
@@ -177,7 +182,8 @@ def html_topbar():
                             className="text-primary"),
                     dcc.Dropdown(
                         id="species-list",
-                        options=get_species_list(),
+                        # Filled by the upload_runs callback
+                        options=[],
                         value=None
                     ),
                 ], className='pretty_container two columns',
@@ -295,23 +301,11 @@ def html_div_filter():
         )
     ])
 
-def html_tab_bifrost(samples, start_date, end_date, column_names):
-
-    ids = [sample['_id'] for sample in samples]
-
-    query = filter_all(sample_ids=ids, projection={'sample_sheet': 1})
-
-
-    if "_id" in query:
-        query["_id"] = query["_id"].astype(str)
-    #print(dt.strptime(query['sample_sheet.SequenceRunDate'][0], '%Y-%m-%d'))
-    query['sample_sheet.SequenceRunDate'] = pd.to_datetime(query['sample_sheet.SequenceRunDate'], errors='coerce')
-    query = query[query['sample_sheet.SequenceRunDate'].between(start_date, end_date)]
-
-    data = query.to_dict("rows")
-
-    print("The isolate data are: {}".format(query['sample_sheet.SequenceRunDate']))
-    #print(samples)
+def html_tab_bifrost(column_names):
+    """
+    The isolates table. Its rows are fetched a page at a time by the
+    update_isolates_page callback.
+    """
     view = html.Div([
 
         html.Div([
@@ -333,9 +327,10 @@ def html_tab_bifrost(samples, start_date, end_date, column_names):
         ], className='col-auto mr-auto', style={'display': 'inline-block',
                                                 'padding-bottom': '5px',
                                                 'padding-left': '5px'}),
+        html.Span(id='isolates-count', style={'padding-left': '5px'}),
 
         #html.Div([], id="placeholder0"),
-        table_main(data, column_names),
+        table_main([], column_names, page_size=TABLE_PAGESIZE),
     ], className='pretty_container eleven columns', style={'border':'1px DarkGrey solid',
                                                            'padding-bottom':'5px',
                                                            'padding-left':'5px',
@@ -392,6 +387,10 @@ def html_tab_surveys(section):
                     message='You have saved the survey',
                 ),
             ]),
+            html.Div(id='survey-save-progress'),
+            dcc.Store(id='survey-job'),
+            dcc.Interval(id='survey-progress-interval', interval=1000,
+                         disabled=True),
             metadata_table(),
         ], className='pretty_container eleven columns', style={'border': '1px DarkGrey solid',
                                                                'padding-bottom': '5px',
@@ -422,7 +421,7 @@ def html_tab_analyses(samples, column_names):
                                                              'padding-left': '5px',
                                                              'position': 'relative',
                                                              'zIndex': 999}),
-        table_main(samples, column_names)
+        table_main(samples, column_names, table_id="datatable-analyses")
     ], className='pretty_container eleven columns', style={'border': '1px DarkGrey solid',
                                                            'padding-bottom': '5px',
                                                            'padding-left': '5px'})
@@ -540,16 +539,28 @@ def generate_table(tests_df):
 
     return tests_df
 
-def table_main(data, column_names):
+def table_main(data, column_names, table_id="datatable-ssi_stamper",
+               page_size=None):
+    """
+    Without page_size the table holds every row in data and filters in the
+    browser. With it, data is left to a callback that pages, filters and
+    sorts on the server (see components.table_query).
+    """
     print("table_main")
     print(data)
     # if columns is None:
     #     columns = global_vars.COLUMNS
+    if page_size is None:
+        paging = dict(filter_action='native', page_action='none')
+    else:
+        paging = dict(filter_action='custom', filter_query='',
+                      sort_action='custom', sort_mode='multi', sort_by=[],
+                      page_action='custom', page_current=0,
+                      page_size=page_size)
 
     table = dash_table.DataTable(
             data=data,
             row_selectable='multi',
-            filter_action='native',
             style_table={
                 'maxHeight': '900px',
                 'overflowY': 'scroll',
@@ -587,8 +598,8 @@ def table_main(data, column_names):
             #     'page_size': TABLE_PAGESIZE
             # },
             virtualization=False,
-            page_action='none',
-            id="datatable-ssi_stamper")
+            id=table_id,
+            **paging)
     return table
 
 def metadata_table():
@@ -640,30 +651,8 @@ def metadata_table():
     return table
 
 def geomap():
-    os.chdir('/Users/stefanocardinale/Documents/SSI/DATABASES/')
-
-    df = pd.read_csv('map_testing_data.csv', sep=";")
-
-    tmp = df
-    tmp = tmp.set_index(['Hospital'])
-
-    hospitals = tmp.groupby('Hospital')
-    # cases = []
-    # for k in hospitals.groups:
-    #     cases.append(len(hospitals.groups[k]))
-    print(hospitals)
-
-    dff = [
-        {
-            "Hospital": "{}".format(k),
-            "cases": len(hospitals.groups[k]),
-            'lat': tmp.loc[k]['lat'].values[0],
-            'lon': tmp.loc[k]['lon'].values[0]
-        } for k in hospitals.groups
-    ]
-
-    print(dff)
-    dfs = pd.DataFrame(dff)
+    map_source = map_data.get_map_data()
+    dfs = map_source["hospitals"]
 
     view = html.Div(
         id='dcc-map',
@@ -687,7 +676,7 @@ def geomap():
                          dash_table.DataTable(
                              id='datatable-interact-location',
                              # Don't show coordinates
-                             columns=[{"name": i, "id": i} for i in df.columns[3:4]],
+                             columns=[{"name": i, "id": i} for i in map_source["columns"]],
                              # But still store coordinates in the table for interactivity
                              data=dfs.to_dict("rows"),
                              row_selectable="multi",
@@ -717,27 +706,4 @@ def geomap():
     return view
 
 def save_survey(data_dict):
-    bifrostapi.connect(mongoURI='mongodb://localhost:27017/bifrost_upgrade_test', connection_name="local")
-
-    connection = bifrostapi.get_connection("local")
-    db = connection['bifrost_upgrade_test']
-    surveys = db['surveys']
-    cases = db['cases']
-    print(data_dict['cases'])
-
-    surveys.find_one_and_update(
-        filter=data_dict,
-        update={"$setOnInsert": data_dict},
-        # return new doc if one is upserted
-        return_document=pymongo.ReturnDocument.AFTER,
-        upsert=True  # insert the document if it does not exist
-    )
-
-    for i in range(len(data_dict['cases'])):
-        cases.find_one_and_update(
-            filter=data_dict['cases'][i],
-            update={"$setOnInsert": data_dict['cases'][i]},
-            # return new doc if one is upserted
-            return_document=pymongo.ReturnDocument.AFTER,
-            upsert=True  # insert the document if it does not exist
-        )
+    return import_survey(data_dict['cases'])
@@ -2,6 +2,12 @@ import math
 import pandas as pd
 from datetime import datetime
 import components.mongo_interface as mongo_interface
+import components.pagination as paging
+import components.flatten as flatten
+import components.result_cache as result_cache
+from components.callback_metrics import phase
+from components.tracing import traced
+import components.async_mongo_interface as async_mongo_interface
 from pandas.io.json import json_normalize
 from bson.objectid import ObjectId
 
@@ -26,6 +32,15 @@ def get_survey_list():
 def get_survey(selected_survey):
     return mongo_interface.get_survey(selected_survey)
 
+def save_survey(cases, progress=None):
+    return mongo_interface.save_survey(cases, progress=progress)
+
+def get_survey_progress(survey_key):
+    return mongo_interface.get_survey_progress(survey_key)
+
+def get_survey_key(cases):
+    return mongo_interface.survey_key(cases)
+
 def get_filtered_samples(specie):
     return mongo_interface.get_filtered_samples(specie)
 
@@ -36,11 +51,55 @@ def save_to_project(data_dict):
     else:
         mongo_interface.save_to_project(data_dict[0])
 
+@traced
 def filter_all(species=None, species_source=None, group=None,
                qc_list=None, run_names=None, sample_ids=None,
                sample_names=None,
                pagination=None,
-               projection=None):
+               projection=None,
+               full_normalize=False,
+               where=None,
+               sort=None,
+               cached=True):
+    """
+    pagination is either {"page_size", "current_page"} (skip/limit) or
+    {"page_size", "after"} for keyset paging, where "after" is the token
+    returned by get_page_cursor for the previous page (None for the first).
+    where is an extra match condition and sort a pymongo sort for
+    skip/limit pages (see components.table_query).
+
+    Results are flattened with the paths of projection; pass
+    full_normalize=True (or no projection) to json_normalize every field.
+    They are cached in components.result_cache, keyed on the arguments,
+    unless cached is False.
+    """
+    if not cached:
+        return _filter_all(species, species_source, group, qc_list,
+                           run_names, sample_ids, sample_names,
+                           pagination, projection, full_normalize,
+                           where, sort)
+    cache = result_cache.get_cache()
+    key = result_cache.make_key(
+        "filter_all", species=species, species_source=species_source,
+        group=group, qc_list=qc_list, run_names=run_names,
+        sample_ids=sample_ids, sample_names=sample_names,
+        pagination=pagination, projection=projection,
+        full_normalize=full_normalize, where=where,
+        # The order of the sort keys matters, unlike that of the lists
+        # make_key normalizes.
+        sort=repr(sort))
+    data_table = cache.get(key)
+    if data_table is result_cache.MISSING:
+        data_table = _filter_all(species, species_source, group, qc_list,
+                                 run_names, sample_ids, sample_names,
+                                 pagination, projection, full_normalize,
+                                 where, sort)
+        cache.set(key, data_table)
+    return data_table
+
+def _filter_all(species, species_source, group, qc_list, run_names,
+                sample_ids, sample_names, pagination, projection,
+                full_normalize, where=None, sort=None):
     if sample_ids is None:
         query_result = mongo_interface.filter(
             run_names=run_names, species=species,
@@ -48,9 +107,91 @@ def filter_all(species=None, species_source=None, group=None,
             qc_list=qc_list,
             sample_names=sample_names,
             pagination=pagination,
-            projection=projection)
+            projection=projection,
+            where=where, sort=sort)
     else:
         query_result = mongo_interface.filter(
             samples=sample_ids, pagination=pagination,
-            projection=projection)
-    return pd.io.json.json_normalize(query_result)
+            projection=projection, where=where, sort=sort)
+    with phase("pandas"):
+        if full_normalize:
+            return pd.io.json.json_normalize(query_result)
+        if paging.is_keyset(pagination):
+            projection = paging.keyset_projection(projection)
+        return flatten.normalize(query_result, projection)
+
+@traced
+def count_filtered(species=None, species_source=None, group=None,
+                   qc_list=None, run_names=None, sample_ids=None,
+                   sample_names=None, where=None):
+    """
+    Number of samples filter_all would return without pagination.
+    """
+    cache = result_cache.get_cache()
+    key = result_cache.make_key(
+        "count_filtered", species=species, species_source=species_source,
+        group=group, qc_list=qc_list, run_names=run_names,
+        sample_ids=sample_ids, sample_names=sample_names, where=where)
+    count = cache.get(key)
+    if count is result_cache.MISSING:
+        if sample_ids is None:
+            count = mongo_interface.count_filtered(
+                run_names=run_names, species=species,
+                species_source=species_source, group=group,
+                qc_list=qc_list,
+                sample_names=sample_names, where=where)
+        else:
+            count = mongo_interface.count_filtered(samples=sample_ids,
+                                                   where=where)
+        cache.set(key, count)
+    return count
+
+def filter_all_chunks(species=None, species_source=None, group=None,
+                      qc_list=None, run_names=None, sample_ids=None,
+                      sample_names=None,
+                      projection=None,
+                      batch_size=mongo_interface.FILTER_BATCH_SIZE):
+    """
+    Streaming filter_all: yields one DataFrame per batch of up to batch_size
+    samples, so arbitrarily large selections are processed in bounded memory.
+    """
+    if sample_ids is None:
+        batches = mongo_interface.filter_batches(
+            run_names=run_names, species=species,
+            species_source=species_source, group=group,
+            qc_list=qc_list,
+            sample_names=sample_names,
+            projection=projection,
+            batch_size=batch_size)
+    else:
+        batches = mongo_interface.filter_batches(
+            samples=sample_ids, projection=projection,
+            batch_size=batch_size)
+    for batch in batches:
+        with phase("pandas"):
+            frame = flatten.normalize(batch, projection)
+        yield frame
+
+
+@traced
+def get_species_options_and_samples(run_names=None, species=None,
+                                    projection=None):
+    """
+    Fetch the species dropdown options and the filtered samples
+    concurrently. Returns (species_options, samples DataFrame).
+    """
+    species_options, query_result = async_mongo_interface.gather(
+        async_mongo_interface.get_species_list(run_names),
+        async_mongo_interface.filter(run_names=run_names, species=species,
+                                     projection=projection))
+    with phase("pandas"):
+        samples = flatten.normalize(query_result, projection)
+    return species_options, samples
+
+def get_page_cursor(data_table):
+    """
+    Return the token of the page following data_table, or None when empty.
+    """
+    if len(data_table) == 0:
+        return None
+    return paging.encode_cursor(data_table.iloc[-1])
@@ -0,0 +1,235 @@
+"""
+Index declarations for the collections the interface modules query, plus a
+query-plan checker.
+
+    python -m components.indexes ensure   # create missing indexes
+    python -m components.indexes check    # fail if a query shape COLLSCANs
+"""
+import sys
+import pymongo
+from bson.objectid import ObjectId
+
+import components.mongo_connection as mongo_connection
+import components.mongo_interface as mongo_interface
+import components.name_search as name_search
+import components.pagination as paging
+import components.session_store as session_store
+import components.species_summary as species_summary
+import bifrost.bifrost_mongo_interface as bifrost_mongo_interface
+
+ASC = pymongo.ASCENDING
+DESC = pymongo.DESCENDING
+
+# collection name -> list of index keys
+INDEXES = {
+    "runs": [
+        [("name", ASC)],
+        [("metadata.created_at", DESC)],
+        [("samples._id", ASC)],
+        [("metadata.updated_at", ASC)],
+    ],
+    "samples": [
+        [("name", ASC), ("_id", ASC)],
+        [("properties.species", ASC)],
+        [("properties.detected_species", ASC)],
+        [("properties.provided_species", ASC)],
+        [("properties.species_detection.summary.detected_species", ASC)],
+        [("properties.sample_info.summary.provided_species", ASC)],
+        [("properties.sample_info.summary.group", ASC)],
+        [("properties.stamper.summary.stamp.value", ASC)],
+        [("properties.datafiles.summary.paired_reads", ASC)],
+        [("sample_sheet.SequenceRunDate", ASC)],
+        [("name_trigrams", ASC)],
+        [("metadata.updated_at", ASC)],
+    ],
+    "sample_components": [
+        [("sample.name", ASC)],
+        [("sample._id", ASC)],
+        [("metadata.updated_at", ASC)],
+    ],
+    "surveys": [
+        [("metadata.created_at", DESC)],
+        [("survey_key", ASC)],
+        [("metadata.updated_at", ASC)],
+    ],
+    "cases": [
+        [("case_key", ASC)],
+    ],
+    "species_summary": [
+        [("field", ASC), ("run", ASC), ("species", ASC)],
+    ],
+    session_store.COLLECTION: [
+        [("session", ASC), ("version", ASC), ("chunk", ASC)],
+    ],
+}
+
+# Content hash keys, sparse so documents saved before they existed are
+# allowed to lack them.
+UNIQUE_INDEXES = {
+    "surveys": [[("survey_key", ASC)]],
+    "cases": [[("case_key", ASC)]],
+}
+
+# collection name -> (index keys, expireAfterSeconds)
+TTL_INDEXES = {
+    session_store.COLLECTION: ([("updated_at", ASC)], session_store.SESSION_TTL),
+}
+
+
+def ensure_indexes(db=None):
+    """
+    Create the declared indexes (no-op for the ones that already exist) and
+    return the created index names per collection.
+    """
+    if db is None:
+        db = mongo_connection.get_db()
+    created = {}
+    for collection, indexes in INDEXES.items():
+        unique = UNIQUE_INDEXES.get(collection, [])
+        created[collection] = db[collection].create_indexes(
+            [pymongo.IndexModel(keys, unique=keys in unique, sparse=keys in unique)
+             for keys in indexes])
+    for collection, (keys, seconds) in TTL_INDEXES.items():
+        created.setdefault(collection, []).extend(
+            db[collection].create_indexes(
+                [pymongo.IndexModel(keys, expireAfterSeconds=seconds)]))
+    return created
+
+
+def filter_shapes():
+    """
+    Every branch filter_query() can produce, with placeholder values.
+    """
+    oid = ObjectId()
+    after = paging.encode_cursor({"name": "", "_id": oid})
+    shapes = [
+        {},
+        {"sample_names": ["sample"]},
+        {"sample_names": ["/^sample/"]},
+        {"samples": [str(oid)]},
+        {"run_names": ["run"]},
+        {"group": ["group"]},
+        {"group": ["Not defined"]},
+        {"after": after},
+        {"species": ["species"], "after": after},
+    ]
+    for source in ("species", "provided", "detected"):
+        shapes.append({"species": ["species"], "species_source": source})
+        shapes.append({"species": ["Not classified"], "species_source": source})
+    for qc in ("OK", "Not checked", "core facility"):
+        shapes.append({"qc_list": [qc]})
+    return shapes
+
+
+def query_shapes(db):
+    """
+    Yield (description, explain document) for each hot query shape.
+    """
+    for module in (mongo_interface, bifrost_mongo_interface):
+        for kwargs in filter_shapes():
+            match_query = module.filter_query(db, **kwargs)
+            cursor = db.samples.find(match_query).sort(paging.SORT).limit(1000)
+            yield ("{}.filter({})".format(module.__name__, kwargs),
+                   cursor.explain())
+
+    spe_fields = ["properties.detected_species",
+                  "properties.sample_info.summary.provided_species",
+                  "properties.species_detection.summary.detected_species"]
+    for spe_field in spe_fields:
+        pipeline = mongo_interface.species_pipeline(spe_field, [ObjectId()])
+        yield ("get_species_list({}, run_name)".format(spe_field),
+               db.command("aggregate", "samples", pipeline=pipeline,
+                          explain=True))
+
+    yield ("get_species_list summary",
+           db[species_summary.COLLECTION].find(
+               species_summary.counts_query(spe_fields[0], ["run"]),
+               species_summary.COUNTS_PROJECTION).explain())
+
+    for text in ("sa", "sample"):
+        yield ("name_search.search({!r})".format(text),
+               db.samples.find(name_search.search_query(db, text),
+                               {"name": 1}).sort("name", ASC).limit(20)
+               .explain())
+    yield ("get_species_list runs lookup",
+           db.runs.find(*mongo_interface.run_samples_query(["run"])).explain())
+    yield ("get_run_list",
+           db.runs.find(*mongo_interface.RUN_LIST).sort(
+               mongo_interface.NEWEST_FIRST).explain())
+    yield ("get_survey_list",
+           db.surveys.find(*mongo_interface.SURVEY_LIST).sort(
+               mongo_interface.NEWEST_FIRST).explain())
+    yield ("get_sample_component",
+           db.sample_components.find(
+               *mongo_interface.sample_components_query(["sample"])).explain())
+
+
+def plan_stages(plan):
+    """
+    Return every "stage" name found anywhere in a (sub)plan.
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def winning_plans(explain):
+    """
+    Return the winning plans of an explain document. Aggregations nest one
+    per $cursor stage; rejected plans are ignored.
+    """
+    plans = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "winningPlan":
+                plans.append(value)
+            elif key != "rejectedPlans":
+                plans.extend(winning_plans(value))
+    elif isinstance(explain, list):
+        for value in explain:
+            plans.extend(winning_plans(value))
+    return plans
+
+
+def check_query_plans(db=None):
+    """
+    Explain every query shape and return the descriptions of the ones whose
+    winning plan contains a COLLSCAN.
+    """
+    if db is None:
+        db = mongo_connection.get_db()
+    failures = []
+    for description, explain in query_shapes(db):
+        stages = plan_stages(winning_plans(explain))
+        if "COLLSCAN" in stages:
+            failures.append(description)
+    return failures
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "check"
+    if command == "ensure":
+        for collection, names in ensure_indexes().items():
+            print("{}: {}".format(collection, ", ".join(names)))
+        return 0
+    elif command == "check":
+        failures = check_query_plans()
+        for description in failures:
+            print("COLLSCAN: {}".format(description))
+        if failures:
+            return 1
+        print("All query shapes use an index.")
+        return 0
+    print("Usage: python -m components.indexes [ensure|check]")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
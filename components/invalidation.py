@@ -0,0 +1,189 @@
+"""
+Invalidation events for caches over samples, runs, sample_components and
+surveys.
+
+A background thread per process watches the collections with a change
+stream. On a standalone mongod (no replica set, so no change streams) it
+polls metadata.updated_at instead; deletes are not seen in that mode.
+Caches register with subscribe() and receive events like
+
+    {"collection": "samples", "operation": "update",
+     "ids": [ObjectId(...)], "time": datetime}
+
+Writes made by this process are also published directly with publish().
+"""
+import os
+import logging
+import threading
+from datetime import datetime
+import pymongo
+from pymongo.errors import OperationFailure, PyMongoError
+
+import components.mongo_connection as mongo_connection
+
+WATCHED_COLLECTIONS = ("samples", "runs", "sample_components", "surveys")
+POLL_INTERVAL = float(os.getenv("INVALIDATION_POLL_INTERVAL", 5))
+
+logger = logging.getLogger(__name__)
+
+_SUBSCRIBERS = []
+_SUBSCRIBERS_LOCK = threading.Lock()
+_WATCHER = None
+_WATCHER_PID = None
+
+
+def subscribe(callback, collections=WATCHED_COLLECTIONS):
+    """
+    Call callback(event) for every event on one of collections.
+    """
+    with _SUBSCRIBERS_LOCK:
+        _SUBSCRIBERS.append((callback, frozenset(collections)))
+
+
+def unsubscribe(callback):
+    with _SUBSCRIBERS_LOCK:
+        _SUBSCRIBERS[:] = [s for s in _SUBSCRIBERS if s[0] is not callback]
+
+
+def publish(collection, operation="update", ids=None):
+    event = {
+        "collection": collection,
+        "operation": operation,
+        "ids": ids,
+        "time": datetime.utcnow()
+    }
+    with _SUBSCRIBERS_LOCK:
+        subscribers = list(_SUBSCRIBERS)
+    for callback, collections in subscribers:
+        if collection in collections:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("Invalidation subscriber failed")
+    return event
+
+
+class Watcher(threading.Thread):
+
+    def __init__(self, db, poll_interval=POLL_INTERVAL):
+        super().__init__(name="invalidation-watcher", daemon=True)
+        self.db = db
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.resume_token = None
+        self.mode = None
+        # Polling position per collection: the newest metadata.updated_at
+        # seen and the ids seen written at that time.
+        self.last_seen = None
+        self.seen_ids = None
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.mode == "polling":
+                    self.poll_changes()
+                else:
+                    self.watch_changes()
+            except OperationFailure:
+                if self.mode != "polling":
+                    # Change streams need a replica set.
+                    self.mode = "polling"
+                    continue
+                logger.exception("Invalidation watcher error, retrying")
+                self.stopped.wait(self.poll_interval)
+            except PyMongoError:
+                logger.exception("Invalidation watcher error, retrying")
+                self.stopped.wait(self.poll_interval)
+
+    def watch_changes(self):
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": list(WATCHED_COLLECTIONS)}}}]
+        with self.db.watch(pipeline, max_await_time_ms=1000,
+                           resume_after=self.resume_token) as stream:
+            self.mode = "change_stream"
+            while not self.stopped.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    continue
+                self.resume_token = stream.resume_token
+                document_key = change.get("documentKey", {})
+                ids = [document_key["_id"]] if "_id" in document_key else None
+                publish(change["ns"]["coll"], change["operationType"], ids)
+
+    def last_updated(self, collection):
+        """
+        Return the newest metadata.updated_at of collection and the ids of
+        the documents written at that time.
+        """
+        last = self.db[collection].find_one(
+            {"metadata.updated_at": {"$exists": True}},
+            {"metadata.updated_at": 1},
+            sort=[("metadata.updated_at", pymongo.DESCENDING)])
+        if last is None:
+            return datetime.min, set()
+        updated_at = last["metadata"]["updated_at"]
+        return updated_at, {doc["_id"] for doc in self.db[collection].find(
+            {"metadata.updated_at": updated_at}, {"_id": 1})}
+
+    def poll_changes(self):
+        """
+        Publish the documents written since the last poll. The position is
+        kept across errors, so writes made while mongo was unreachable are
+        published once it is back.
+        """
+        self.mode = "polling"
+        if self.last_seen is None:
+            self.last_seen, self.seen_ids = {}, {}
+            for collection in WATCHED_COLLECTIONS:
+                self.last_seen[collection], self.seen_ids[collection] = \
+                    self.last_updated(collection)
+        while not self.stopped.wait(self.poll_interval):
+            for collection in WATCHED_COLLECTIONS:
+                self.poll_collection(collection)
+
+    def poll_collection(self, collection):
+        # $gte, as more writes can follow in the millisecond of last_seen;
+        # the ones already published are skipped by id.
+        last_seen = self.last_seen[collection]
+        seen_ids = self.seen_ids[collection]
+        changed = [doc for doc in self.db[collection].find(
+                       {"metadata.updated_at": {"$gte": last_seen}},
+                       {"metadata.updated_at": 1})
+                   if doc["metadata"]["updated_at"] != last_seen
+                   or doc["_id"] not in seen_ids]
+        if len(changed) == 0:
+            return
+        newest = max(doc["metadata"]["updated_at"] for doc in changed)
+        newest_ids = {doc["_id"] for doc in changed
+                      if doc["metadata"]["updated_at"] == newest}
+        if newest == last_seen:
+            newest_ids |= seen_ids
+        self.last_seen[collection] = newest
+        self.seen_ids[collection] = newest_ids
+        publish(collection, "update", [doc["_id"] for doc in changed])
+
+
+def start(db=None):
+    """
+    Start this process' watcher if it is not running yet. Safe to call from
+    every worker after forking.
+    """
+    global _WATCHER, _WATCHER_PID
+    if _WATCHER_PID == os.getpid() and _WATCHER is not None and _WATCHER.is_alive():
+        return _WATCHER
+    if db is None:
+        db = mongo_connection.get_db()
+    _WATCHER = Watcher(db)
+    _WATCHER_PID = os.getpid()
+    _WATCHER.start()
+    return _WATCHER
+
+
+def stop():
+    global _WATCHER
+    if _WATCHER is not None and _WATCHER_PID == os.getpid():
+        _WATCHER.stop()
+    _WATCHER = None
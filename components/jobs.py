@@ -0,0 +1,337 @@
+"""
+Background jobs for the callbacks too slow to run in the request thread.
+
+A callback submits a function with submit(), which returns a job id at
+once, and a dcc.Interval driven callback polls status() until the job is
+done and its result can be swapped in. Jobs run on a thread pool of
+JOB_WORKERS threads per worker process; their state and results are kept
+in a sqlite registry (JOBS_PATH) so any worker of the host can answer the
+polls.
+
+Each user (a browser, identified by the beone_user cookie) runs at most
+JOBS_PER_USER jobs at a time, and a new job replaces the user's running
+job of the same name if that one was submitted with abandon=True; jobs
+that must not stop halfway, like saving a survey, are never replaced and
+a second one is refused while they run. Jobs submitted with abandon=True
+are cancelled once nobody polled them for JOB_ABANDON_S seconds, e.g.
+after the user left the page. Cancellation is cooperative: it takes
+effect at the next job.progress() call of the function, and until then
+the job is "cancelling" and still counts towards JOBS_PER_USER, so that
+cancelled jobs cannot pile up on the threads.
+
+A job is traced and measured like a callback, as "job <name>": its trace
+continues the one of the request that submitted it, and its calls, wall
+time and mongo, pandas and figure time go to callback_metrics.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import flask
+from plotly.utils import PlotlyJSONEncoder
+
+import components.tracing as tracing
+import components.callback_metrics as callback_metrics
+
+JOBS_PATH = os.getenv(
+    "JOBS_PATH", os.path.join(tempfile.gettempdir(), "beone_jobs.sqlite"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOBS_PER_USER = int(os.getenv("JOBS_PER_USER", 2))
+JOB_ABANDON_S = float(os.getenv("JOB_ABANDON_S", 15))
+# Finished jobs and their results are dropped after this many seconds.
+JOB_TTL = float(os.getenv("JOB_TTL", 60 * 60))
+
+USER_COOKIE = "beone_user"
+ACTIVE = ("queued", "running")
+# Also the cancelled jobs whose function has not returned yet.
+EXECUTING = ACTIVE + ("cancelling",)
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    done REAL,
+    total REAL,
+    message TEXT,
+    result TEXT,
+    error TEXT,
+    abandon INTEGER NOT NULL,
+    pid INTEGER,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    polled REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, status);
+"""
+_COLUMNS = ("id", "owner", "name", "status", "done", "total", "message",
+            "error", "created", "updated")
+# New status of a cancelled job: running jobs are cancelling until their
+# function returns.
+_CANCELLED = "CASE status WHEN 'running' THEN 'cancelling' ELSE 'cancelled' END"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobLimitExceeded(Exception):
+    pass
+
+
+_connections = threading.local()
+
+
+def _connection():
+    connection = getattr(_connections, "connection", None)
+    if connection is None or _connections.pid != os.getpid():
+        connection = sqlite3.connect(JOBS_PATH, timeout=30,
+                                     isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+        _connections.connection = connection
+        _connections.pid = os.getpid()
+    return connection
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None or _executor[1] != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor[1] != os.getpid():
+                _executor = (ThreadPoolExecutor(
+                    max_workers=JOB_WORKERS, thread_name_prefix="job"),
+                    os.getpid())
+    return _executor[0]
+
+
+def current_owner():
+    """
+    Id of the user of the current request, from the beone_user cookie.
+    Outside a request jobs belong to "local".
+    """
+    if not flask.has_request_context():
+        return "local"
+    owner = flask.request.cookies.get(USER_COOKIE) or flask.g.get("new_user")
+    if owner is None:
+        owner = flask.g.new_user = uuid.uuid4().hex
+    return owner
+
+
+def init_app(server):
+    "Give every browser a beone_user cookie, to which its jobs belong"
+    @server.after_request
+    def set_user_cookie(response):
+        new_user = flask.g.get("new_user")
+        if new_user is not None:
+            response.set_cookie(USER_COOKIE, new_user, httponly=True,
+                                samesite="Lax")
+        return response
+
+
+class Job:
+    """
+    Handle passed to the function of a job.
+    """
+
+    def __init__(self, job_id):
+        self.id = job_id
+
+    def progress(self, done, total=None, message=None):
+        """
+        Record the progress of the job, and raise JobCancelled if it was
+        cancelled or abandoned meanwhile.
+        """
+        connection = _connection()
+        now = time.time()
+        connection.execute(
+            "UPDATE jobs SET done = ?, total = COALESCE(?, total), "
+            "message = COALESCE(?, message), updated = ? WHERE id = ?",
+            (done, total, message, now, self.id))
+        self.check()
+
+    def check(self):
+        "Raise JobCancelled if the job was cancelled or abandoned"
+        row = _connection().execute(
+            "SELECT status, abandon, polled FROM jobs WHERE id = ?",
+            (self.id,)).fetchone()
+        if row is None or row[0] in ("cancelled", "cancelling"):
+            raise JobCancelled(self.id)
+        if row[1] and time.time() - row[2] > JOB_ABANDON_S:
+            cancel(self.id, "abandoned")
+            raise JobCancelled(self.id)
+
+
+def _finish(job_id, status, result=None, error=None, message=None):
+    _connection().execute(
+        "UPDATE jobs SET status = ?, result = ?, error = ?, "
+        "message = COALESCE(?, message), updated = ? "
+        "WHERE id = ? AND status IN ('queued', 'running')",
+        (status, result, error, message, time.time(), job_id))
+
+
+def _run(job_id, name, function, parent):
+    job = Job(job_id)
+    label = "job " + name
+    measured = callback_metrics.measure(label, function,
+                                        prevented=(JobCancelled,))
+    try:
+        started = _connection().execute(
+            "UPDATE jobs SET status = 'running', updated = ? "
+            "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+        if started.rowcount == 0:
+            return
+        job.check()
+        with tracing.continue_trace(label, parent, job_id=job_id):
+            result = measured(job)
+        _finish(job_id, "done",
+                result=json.dumps(result, cls=PlotlyJSONEncoder))
+    except JobCancelled:
+        pass
+    except Exception as e:
+        log.exception("Job %s failed", job_id)
+        _finish(job_id, "failed", error="{}: {}".format(type(e).__name__, e))
+    finally:
+        _connection().execute(
+            "UPDATE jobs SET status = 'cancelled', updated = ? "
+            "WHERE id = ? AND status = 'cancelling'", (time.time(), job_id))
+
+
+def submit(name, function, owner=None, abandon=True):
+    """
+    Run function(job) in the background and return the job id. Its return
+    value, which must be JSON serializable, becomes the job result. Raises
+    JobLimitExceeded if the owner already runs JOBS_PER_USER other jobs, or
+    a job of the same name that cannot be abandoned.
+    """
+    if owner is None:
+        owner = current_owner()
+    connection = _connection()
+    now = time.time()
+    job_id = uuid.uuid4().hex
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute("DELETE FROM jobs WHERE updated < ? AND status "
+                           "NOT IN ('queued', 'running', 'cancelling')",
+                           (now - JOB_TTL,))
+        if connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE owner = ? AND name = ? "
+                "AND abandon = 0 AND status IN ('queued', 'running')",
+                (owner, name)).fetchone()[0]:
+            raise JobLimitExceeded(
+                "A {} job is already running, try again when it is "
+                "done".format(name))
+        connection.execute(
+            "UPDATE jobs SET status = " + _CANCELLED + ", "
+            "message = 'replaced', updated = ? WHERE owner = ? AND name = ? "
+            "AND abandon = 1 AND status IN ('queued', 'running')",
+            (now, owner, name))
+        active = 0
+        for row in connection.execute(
+                "SELECT id, status, pid FROM jobs WHERE owner = ? "
+                "AND status IN ('queued', 'running', 'cancelling')",
+                (owner,)).fetchall():
+            if not _reap(*row):
+                active += 1
+        if active >= JOBS_PER_USER:
+            raise JobLimitExceeded(
+                "{} jobs are already running, try again when one of them "
+                "is done".format(active))
+        connection.execute(
+            "INSERT INTO jobs (id, owner, name, status, abandon, pid, "
+            "created, updated, polled) VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, owner, name, int(abandon), os.getpid(), now, now, now))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    parent = tracing.current_span()
+    get_executor().submit(_run, job_id, name, function,
+                          parent and tracing.traceparent(parent))
+    return job_id
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _reap(job_id, job_status, pid):
+    """
+    Finish a job left behind by a worker process that exited, which queued
+    or ran it. Returns whether it did.
+    """
+    if not pid or _alive(pid):
+        return False
+    if job_status == "cancelling":
+        _connection().execute(
+            "UPDATE jobs SET status = 'cancelled', updated = ? "
+            "WHERE id = ? AND status = 'cancelling'", (time.time(), job_id))
+    else:
+        _finish(job_id, "failed", error="the worker running it exited")
+    return True
+
+
+def status(job_id, poll=True):
+    """
+    Return the job as a dict, with its "result" once it is done, or None
+    for an unknown job. poll=True marks the job as still wanted.
+    """
+    connection = _connection()
+    if poll:
+        connection.execute("UPDATE jobs SET polled = ? WHERE id = ?",
+                           (time.time(), job_id))
+    row = connection.execute(
+        "SELECT {}, result, pid FROM jobs WHERE id = ?".format(
+            ", ".join(_COLUMNS)), (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(zip(_COLUMNS, row[:len(_COLUMNS)]))
+    result, pid = row[len(_COLUMNS):]
+    if job["status"] in EXECUTING and _reap(job_id, job["status"], pid):
+        return status(job_id, poll=False)
+    if job["status"] == "done":
+        job["result"] = json.loads(result)
+    return job
+
+
+def cancel(job_id, message="cancelled"):
+    _connection().execute(
+        "UPDATE jobs SET status = " + _CANCELLED + ", message = ?, "
+        "updated = ? WHERE id = ? AND status IN ('queued', 'running')",
+        (message, time.time(), job_id))
+
+
+def describe(job):
+    "One line on the state of a job, for display"
+    if job is None:
+        return "The job was not found."
+    if job["status"] == "queued":
+        return "Waiting..."
+    if job["status"] == "running":
+        if job["total"]:
+            return "Working... {:.0f} of {:.0f}".format(
+                job["done"] or 0, job["total"])
+        return "Working..."
+    if job["status"] == "failed":
+        return "Failed: {}".format(job["error"])
+    if job["status"] in ("cancelled", "cancelling"):
+        return "Cancelled ({}).".format(job["message"] or "cancelled")
+    return ""
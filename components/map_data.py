@@ -0,0 +1,117 @@
+"""
+Hospital case counts and coordinates for the case map.
+
+The aggregation is computed once with a single groupby and cached until
+its source changes: the CSV file (MAP_DATA_PATH, checked by modification
+time and size) or, with MAP_DATA_SOURCE=cases, the cases collection
+(dropped on survey invalidation events).
+"""
+import os
+import threading
+import pandas as pd
+
+import components.mongo_connection as mongo_connection
+import components.invalidation as invalidation
+
+MAP_DATA_PATH = os.getenv(
+    "MAP_DATA_PATH",
+    "/Users/stefanocardinale/Documents/SSI/DATABASES/map_testing_data.csv")
+MAP_DATA_SOURCE = os.getenv("MAP_DATA_SOURCE", "csv")
+
+HOSPITAL_COLUMNS = ["Hospital", "cases", "lat", "lon"]
+
+_LOCK = threading.Lock()
+_CSV_CACHE = {}
+_CASES_CACHE = {}
+
+
+def hospital_cases(df):
+    """
+    Return one row per hospital with its number of cases and the
+    coordinates of its first case.
+    """
+    if len(df) == 0:
+        return pd.DataFrame(columns=HOSPITAL_COLUMNS)
+    hospitals = df.groupby("Hospital", sort=True)
+    dfs = pd.DataFrame({
+        "cases": hospitals.size(),
+        "lat": hospitals["lat"].first(),
+        "lon": hospitals["lon"].first(),
+    }).reset_index()
+    dfs["Hospital"] = dfs["Hospital"].astype(str)
+    return dfs[HOSPITAL_COLUMNS]
+
+
+def load_csv(path=MAP_DATA_PATH):
+    """
+    Return {"hospitals", "columns"} for the CSV at path, reading it again
+    only when the file changed.
+    """
+    stat = os.stat(path)
+    version = (stat.st_mtime, stat.st_size)
+    with _LOCK:
+        cached = _CSV_CACHE.get(path)
+        if cached is not None and cached["version"] == version:
+            return cached
+    df = pd.read_csv(path, sep=";")
+    cached = {
+        "version": version,
+        "hospitals": hospital_cases(df),
+        # The location table shows the same column as the source table.
+        "columns": list(df.columns[3:4]),
+    }
+    with _LOCK:
+        _CSV_CACHE[path] = cached
+    return cached
+
+
+def cases_pipeline():
+    return [
+        {"$group": {
+            "_id": "$Hospital",
+            "cases": {"$sum": 1},
+            "lat": {"$first": "$lat"},
+            "lon": {"$first": "$lon"},
+        }},
+        {"$match": {"_id": {"$ne": None}}},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+def load_cases(db=None):
+    """
+    Return {"hospitals", "columns"} aggregated from the cases collection.
+    """
+    with _LOCK:
+        cached = _CASES_CACHE.get("cases")
+    if cached is not None:
+        return cached
+    if db is None:
+        db = mongo_connection.get_db()
+    rows = list(db.cases.aggregate(cases_pipeline()))
+    dfs = pd.DataFrame(rows, columns=["_id", "cases", "lat", "lon"]).rename(
+        columns={"_id": "Hospital"})
+    dfs["Hospital"] = dfs["Hospital"].astype(str)
+    cached = {"hospitals": dfs[HOSPITAL_COLUMNS], "columns": ["Hospital"]}
+    with _LOCK:
+        _CASES_CACHE["cases"] = cached
+    return cached
+
+
+def invalidate_cases(event=None):
+    with _LOCK:
+        _CASES_CACHE.clear()
+
+
+invalidation.subscribe(invalidate_cases, ["surveys"])
+
+
+def get_map_data(source=MAP_DATA_SOURCE):
+    if source == "cases":
+        return load_cases()
+    return load_csv()
+
+
+def get_hospital_cases(source=MAP_DATA_SOURCE):
+    "Return a copy of the hospital aggregation, safe to modify"
+    return get_map_data(source)["hospitals"].copy()
@@ -0,0 +1,224 @@
+import os
+import time
+import atexit
+import threading
+import pymongo
+from pymongo import monitoring
+
+from components.command_stats import COMMAND_STATS
+from components.tracing import COMMAND_TRACER
+
+# Pool settings, overridable from the environment.
+MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000))
+
+DB_NAME = "bifrost_upgrade_test"
+
+_CLIENTS = {}
+_ASYNC_CLIENTS = {}
+_CLIENTS_PID = None
+_LOCK = threading.Lock()
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Collects per-pool (per server address) connection statistics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.pools = {}
+
+    def _pool(self, address):
+        key = "{}:{}".format(*address)
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = {
+                "created": 0,
+                "closed": 0,
+                "checked_out": 0,
+                "checkouts": 0,
+                "checkout_failures": 0,
+                "wait_time_total": 0.0,
+                "wait_time_max": 0.0,
+            }
+            self.pools[key] = pool
+        return pool
+
+    def pool_created(self, event):
+        with self._lock:
+            self._pool(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pool(event.address)["created"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._pool(event.address)["closed"] += 1
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._pool(event.address)["checkout_failures"] += 1
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        waited = 0.0 if started is None else time.perf_counter() - started
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["checked_out"] += 1
+            pool["checkouts"] += 1
+            pool["wait_time_total"] += waited
+            pool["wait_time_max"] = max(pool["wait_time_max"], waited)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._pool(event.address)["checked_out"] -= 1
+
+    def snapshot(self):
+        with self._lock:
+            stats = {}
+            for key, pool in self.pools.items():
+                pool = dict(pool)
+                if pool["checkouts"]:
+                    pool["wait_time_avg"] = pool["wait_time_total"] / pool["checkouts"]
+                else:
+                    pool["wait_time_avg"] = 0.0
+                stats[key] = pool
+            return stats
+
+
+POOL_STATS = PoolStats()
+
+
+def _reset_after_fork():
+    """
+    Drop clients inherited from the parent process. They must not be closed
+    or used here, as their sockets are shared with the parent.
+    """
+    global _CLIENTS, _ASYNC_CLIENTS, _CLIENTS_PID, _LOCK
+    _CLIENTS = {}
+    _ASYNC_CLIENTS = {}
+    _CLIENTS_PID = None
+    _LOCK = threading.Lock()
+    POOL_STATS.pools = {}
+    COMMAND_STATS.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_mongo_uri():
+    mongo_db_key = os.getenv("LOCAL_DB_KEY", None)
+    if mongo_db_key is None:
+        exit("LOCAL_DB_KEY env variable is not set.")
+    return mongo_db_key
+
+
+def get_connection(mongo_uri=None):
+    """
+    Return the process-wide pooled client for mongo_uri (LOCAL_DB_KEY by
+    default). The client is created lazily, so under gunicorn --preload each
+    worker builds its own pool after forking.
+    """
+    global _CLIENTS_PID
+    if mongo_uri is None:
+        mongo_uri = get_mongo_uri()
+    pid = os.getpid()
+    if _CLIENTS_PID != pid:
+        _reset_after_fork()
+        _CLIENTS_PID = pid
+    client = _CLIENTS.get(mongo_uri)
+    if client is not None:
+        return client
+    with _LOCK:
+        client = _CLIENTS.get(mongo_uri)
+        if client is None:
+            client = pymongo.MongoClient(
+                mongo_uri,
+                maxPoolSize=MAX_POOL_SIZE,
+                minPoolSize=MIN_POOL_SIZE,
+                waitQueueTimeoutMS=WAIT_QUEUE_TIMEOUT_MS,
+                event_listeners=[POOL_STATS, COMMAND_STATS, COMMAND_TRACER],
+                connect=False)
+            _CLIENTS[mongo_uri] = client
+    return client
+
+
+def get_async_connection(mongo_uri=None):
+    """
+    Return the process-wide Motor client for mongo_uri. Motor is only needed
+    by the async interface, so it is imported here. The client must only be
+    used from the event loop of components.async_mongo_interface.
+    """
+    global _CLIENTS_PID
+    import motor.motor_asyncio
+
+    if mongo_uri is None:
+        mongo_uri = get_mongo_uri()
+    pid = os.getpid()
+    if _CLIENTS_PID != pid:
+        _reset_after_fork()
+        _CLIENTS_PID = pid
+    client = _ASYNC_CLIENTS.get(mongo_uri)
+    if client is None:
+        client = motor.motor_asyncio.AsyncIOMotorClient(
+            mongo_uri,
+            maxPoolSize=MAX_POOL_SIZE,
+            minPoolSize=MIN_POOL_SIZE,
+            waitQueueTimeoutMS=WAIT_QUEUE_TIMEOUT_MS,
+            event_listeners=[POOL_STATS, COMMAND_STATS, COMMAND_TRACER])
+        _ASYNC_CLIENTS[mongo_uri] = client
+    return client
+
+
+def get_db(name=DB_NAME, mongo_uri=None):
+    return get_connection(mongo_uri)[name]
+
+
+def get_pool_stats():
+    """
+    Return connection pool statistics keyed by server address.
+    """
+    return POOL_STATS.snapshot()
+
+
+def get_command_stats():
+    """
+    Return latency histograms of the commands sent by this process, keyed
+    by (originating function, command name).
+    """
+    return COMMAND_STATS.snapshot()
+
+
+def close_connection():
+    global _CLIENTS, _ASYNC_CLIENTS
+    if _CLIENTS_PID != os.getpid():
+        return
+    for client in _CLIENTS.values():
+        client.close()
+    _CLIENTS = {}
+    for client in _ASYNC_CLIENTS.values():
+        client.close()
+    _ASYNC_CLIENTS = {}
+
+
+atexit.register(close_connection)
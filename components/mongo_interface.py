@@ -2,19 +2,20 @@ import pymongo
 import os
 from datetime import datetime
 import re
+import json
+import hashlib
 from bson.objectid import ObjectId
 from bson.son import SON
-import bifrostapi
+import components.mongo_connection as mongo_connection
+import components.invalidation as invalidation
+import components.name_search as name_search
+import components.pagination as paging
+import components.species_summary as species_summary
 
 
 def get_connection():
-
-    mongo_db_key = os.getenv("LOCAL_DB_KEY", None)
-    if mongo_db_key is None:
-        exit("LOCAL_DB_KEY env variable is not set.")
-    "Return mongodb connection"
-    connection = pymongo.MongoClient(mongo_db_key)
-    return connection
+    "Return the shared pooled mongodb connection"
+    return mongo_connection.get_connection()
 
 def get_db_list():
     connection = get_connection()
@@ -28,12 +29,29 @@ def get_db_list():
     print(db_options)
     return db_options
 
+# find() arguments of the list and lookup queries below, shared with the
+# query plan check of components.indexes.
+NEWEST_FIRST = [("metadata.created_at", pymongo.DESCENDING)]
+RUN_LIST = ({}, {"name": 1, "_id": 0, "samples": 1})
+SURVEY_LIST = ({}, {"_id": 1})
+
+
+def run_samples_query(run_names):
+    "find() arguments for the sample ids of the runs named run_names"
+    return {"name": {"$in": list(run_names)}}, {"_id": 0, "samples._id": 1}
+
+
+def sample_components_query(sample_names):
+    "find() arguments for the sample components of sample_names"
+    return ({"sample.name": {"$in": list(sample_names)}},
+            {"component": 1, "sample": 1, "summary": 1})
+
+
 def get_survey_list():
     connection = get_connection()
     db = connection['bifrost_upgrade_test']
     # Fastest.
-    surveys = list(db.surveys.find({},
-                        {"_id": 1}).sort([['metadata.created_at', pymongo.DESCENDING]]))
+    surveys = list(db.surveys.find(*SURVEY_LIST).sort(NEWEST_FIRST))
 
     survey_options = [
         {"label": "{}".format(i['_id']),
@@ -45,12 +63,28 @@ def get_run_list():
     connection = get_connection()
     db = connection['bifrost_upgrade_test']
     # Fastest.
-    runs = list(db.runs.find( {},#{"type": "routine"}, #Leave in routine
-                                {"name": 1,
-                                "_id": 0,
-                                "samples": 1}).sort([['metadata.created_at', pymongo.DESCENDING]]))
+    runs = list(db.runs.find(*RUN_LIST).sort(NEWEST_FIRST))
     return runs
 
+def species_pipeline(spe_field, sample_ids=None):
+    """
+    Aggregation counting samples per species, optionally within sample_ids.
+    """
+    pipeline = [
+        {
+            "$group": {
+                "_id": "$" + spe_field,
+                "count": {"$sum": 1}
+            }
+        },
+        {
+            "$sort": {"_id": 1}
+        }
+    ]
+    if sample_ids is not None:
+        pipeline.insert(0, {"$match": {"_id": {"$in": sample_ids}}})
+    return pipeline
+
 def get_species_list(run_name=None):
     connection = get_connection()
 
@@ -60,14 +94,12 @@ def get_species_list(run_name=None):
     # else:
 
     spe_field = "properties.detected_species"
-    if run_name is not None:
-        run = list(db.runs.find(
-            {"name": {"$in": run_name}},
-            {
-                "_id": 0,
-                "samples._id": 1
-            }
-        ))
+    if (species_summary.covers(run_name)
+            and species_summary.is_current(db, spe_field)):
+        species = species_summary.get_species_counts(
+            db, spe_field, run_name)
+    elif run_name is not None:
+        run = list(db.runs.find(*run_samples_query(run_name)))
         if run is None:
             run_samples = []
         else:
@@ -77,34 +109,10 @@ def get_species_list(run_name=None):
                     run_samples.append(sample)
 
         sample_ids = [s["_id"] for s in run_samples]
-        species = list(db.samples.aggregate([
-            {
-                "$match": {
-                    "_id": {"$in": sample_ids}
-                }
-            },
-            {
-                "$group": {
-                    "_id": "$" + spe_field,
-                    "count": {"$sum": 1}
-                }
-            },
-            {
-                "$sort": {"_id": 1}
-            }
-        ]))
+        species = list(db.samples.aggregate(
+            species_pipeline(spe_field, sample_ids)))
     else:
-        species = list(db.samples.aggregate([
-            {
-                "$group": {
-                    "_id": "$" + spe_field,
-                    "count": {"$sum": 1}
-                }
-            },
-            {
-                "$sort": {"_id": 1}
-            }
-        ]))
+        species = list(db.samples.aggregate(species_pipeline(spe_field)))
 
     species_options = [
         {"label": "{}".format(i['_id']),
@@ -117,13 +125,7 @@ def get_samples_id(run_name=None):
     db = connection['bifrost_upgrade_test']
 
     if run_name is not None:
-        run = list(db.runs.find(
-            {"name": {"$in": run_name}},
-            {
-                "_id": 0,
-                "samples._id": 1
-            }
-        ))
+        run = list(db.runs.find(*run_samples_query(run_name)))
         if run is None:
             run_samples = []
         else:
@@ -175,16 +177,111 @@ def get_filtered_samples(specie):
     return samples
 
 def get_sample_component(sample_names):
-    connection = pymongo.MongoClient()
+    connection = get_connection()
     db = connection["bifrost_upgrade_test"]
 
-    return list(db.sample_components.find({"sample.name": {"$in": sample_names}}, {"component": 1, "sample": 1, "summary": 1}))
+    return list(db.sample_components.find(
+        *sample_components_query(sample_names)))
 
 def get_survey(selected_survey):
-    connection = pymongo.MongoClient()
+    connection = get_connection()
     db = connection["bifrost_upgrade_test"]
 
-    return list(db.surveys.find({"_id": ObjectId(selected_survey)}))
+    surveys = list(db.surveys.find({"_id": ObjectId(selected_survey)}))
+    for survey in surveys:
+        if "case_keys" in survey:
+            found = db.cases.find({"case_key": {"$in": survey["case_keys"]}},
+                                  {"_id": 0})
+            survey["cases"] = survey_cases(survey["case_keys"], found)
+    return surveys
+
+
+SURVEY_BATCH_SIZE = 1000
+
+
+def case_key(case):
+    "Stable content hash of a survey case"
+    content = json.dumps(case, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def survey_key(cases, case_keys=None):
+    "Stable content hash of a survey, from the keys of its cases"
+    if case_keys is None:
+        case_keys = [case_key(case) for case in cases]
+    return hashlib.sha1("".join(case_keys).encode("utf-8")).hexdigest()
+
+
+def survey_cases(case_keys, found):
+    """
+    Return the cases of a survey in its order, from the documents of
+    db.cases found for its case_keys.
+    """
+    by_key = {}
+    for case in found:
+        by_key[case.pop("case_key")] = case
+    return [by_key[key] for key in case_keys if key in by_key]
+
+
+def get_survey_progress(key):
+    """
+    Return the {"done", "total"} case counts of a survey being saved, or
+    None if no survey with that key exists.
+    """
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    survey = db.surveys.find_one({"survey_key": key}, {"_id": 0, "ingest": 1})
+    if survey is None:
+        return None
+    return survey.get("ingest")
+
+
+def save_survey(cases, batch_size=SURVEY_BATCH_SIZE, progress=None):
+    """
+    Upsert a survey and its cases. Cases are keyed on their content hash
+    (case_key) and written with unordered bulk upserts of batch_size; the
+    survey document only lists their case_keys, so it stays well below the
+    16MB document limit.
+    Progress is stored on the survey document (see get_survey_progress)
+    and passed to progress(done, total) after every batch if given.
+    """
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    total = len(cases)
+    case_keys = [case_key(case) for case in cases]
+    key = survey_key(cases, case_keys)
+    now = datetime.utcnow()
+    db.surveys.update_one(
+        {"survey_key": key},
+        {"$setOnInsert": {"survey_key": key,
+                          "case_keys": case_keys,
+                          "metadata.created_at": now},
+         "$set": {"ingest": {"done": 0, "total": total},
+                  "metadata.updated_at": now}},
+        upsert=True)
+
+    done = 0
+    seen = set()
+    for start in range(0, total, batch_size):
+        batch = cases[start:start + batch_size]
+        updates = []
+        for case, key_case in zip(batch, case_keys[start:start + batch_size]):
+            if key_case in seen:
+                continue
+            seen.add(key_case)
+            updates.append(pymongo.UpdateOne(
+                {"case_key": key_case},
+                {"$setOnInsert": dict(case, case_key=key_case)},
+                upsert=True))
+        if len(updates):
+            db.cases.bulk_write(updates, ordered=False)
+        done += len(batch)
+        db.surveys.update_one({"survey_key": key},
+                              {"$set": {"ingest.done": done}})
+        if progress is not None:
+            progress(done, total)
+    invalidation.publish("surveys", "update")
+    return key
 
 
 def filter_qc(qc_list):
@@ -207,30 +304,27 @@ def filter_qc(qc_list):
             qc_query.append({"properties.stamper.summary.stamp.value": elem})
     return {"$match": {"$and": qc_query}}
 
-def filter(run_names=None,
-           species=None, species_source="species", group=None,
-           qc_list=None, samples=None, pagination=None,
-           sample_names=None,
-           projection=None):
+def filter_query(db, run_names=None,
+                 species=None, species_source="species", group=None,
+                 qc_list=None, samples=None,
+                 sample_names=None, after=None, where=None):
+    """
+    Build the samples match query used by filter(). after is a keyset page
+    token (see components.pagination) and where an extra match condition,
+    such as a translated table filter (see components.table_query).
+    samples=[] matches no sample, while None does not restrict the ids.
+    """
     if species_source == "provided":
         spe_field = "properties.provided_species"
     elif species_source == "detected":
         spe_field = "properties.detected_species"
     else:
         spe_field = "properties.species"
-    connection = get_connection()
-    db = connection['bifrost_upgrade_test']
     query = []
     sample_set = set()
     if sample_names is not None and len(sample_names) != 0:
-        sample_names_query = []
-        for s_n in sample_names:
-            if s_n.startswith("/") and s_n.endswith("/"):
-                sample_names_query.append(re.compile(s_n[1:-1]))
-            else:
-                sample_names_query.append(s_n)
-        query.append({"name": {"$in": sample_names_query}})
-    if samples is not None and len(samples) != 0:
+        query.append(name_search.names_query(db, sample_names))
+    if samples is not None:
         sample_set = {ObjectId(id) for id in samples}
         query.append({"_id": {"$in": list(sample_set)}})
     if run_names is not None and len(run_names) != 0:
@@ -246,8 +340,8 @@ def filter(run_names=None,
         else:
             run_sample_set = {s["_id"] for run in runs for s in run['samples']}
 
-        if len(sample_set):
-            inter = run_sample_set.intersect(sample_set)
+        if samples is not None:
+            inter = run_sample_set.intersection(sample_set)
             query.append({"_id": {"$in": list(inter)}})
         else:
             query.append({"_id": {"$in": list(run_sample_set)}})
@@ -277,16 +371,11 @@ def filter(run_names=None,
             query.append(
                 {"properties.sample_info.summary.group": {"$in": group}})
 
-    if pagination is not None:
-        p_limit = pagination['page_size']
-        p_skip = pagination['page_size'] * pagination['current_page']
-    else:
-        p_limit = 1000
-        p_skip = 0
-
-    skip_limit_steps = [
-        {"$skip": p_skip}, {"$limit": p_limit}
-    ]
+    after_query = paging.keyset_query(after)
+    if after_query is not None:
+        query.append(after_query)
+    if where is not None:
+        query.append(where)
 
     qc_query = filter_qc(qc_list)
 
@@ -300,7 +389,91 @@ def filter(run_names=None,
             match_query = {"$and": query}
         else:
             match_query = {"$and": query + qc_query["$match"]["$and"]}
+    return match_query
+
+
+FILTER_BATCH_SIZE = 1000
+
+
+def filter(run_names=None,
+           species=None, species_source="species", group=None,
+           qc_list=None, samples=None, pagination=None,
+           sample_names=None,
+           projection=None, where=None, sort=None):
+    """
+    sort is a pymongo sort for skip/limit pages, paging.SORT by default.
+    Keyset pages are always in paging.SORT order.
+    """
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    after = None
+    if pagination is not None:
+        p_limit = pagination['page_size']
+        if paging.is_keyset(pagination):
+            p_skip = 0
+            after = pagination['after']
+            projection = paging.keyset_projection(projection)
+        else:
+            p_skip = pagination['page_size'] * pagination['current_page']
+    else:
+        p_limit = 0
+        p_skip = 0
+
+    match_query = filter_query(
+        db, run_names=run_names, species=species,
+        species_source=species_source, group=group, qc_list=qc_list,
+        samples=samples, sample_names=sample_names, after=after,
+        where=where)
+    if sort is None or after is not None:
+        sort = paging.SORT
     query_result = list(db.samples.find(
-        match_query, projection).sort([('name', pymongo.ASCENDING)]).skip(p_skip).limit(p_limit))
+        match_query, projection).sort(sort).skip(p_skip).limit(p_limit))
 
     return query_result
+
+
+def count_filtered(run_names=None,
+                   species=None, species_source="species", group=None,
+                   qc_list=None, samples=None,
+                   sample_names=None, where=None):
+    """
+    Number of samples filter() returns without pagination, counted on the
+    server.
+    """
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    match_query = filter_query(
+        db, run_names=run_names, species=species,
+        species_source=species_source, group=group, qc_list=qc_list,
+        samples=samples, sample_names=sample_names, where=where)
+    return db.samples.count_documents(match_query)
+
+
+def filter_batches(run_names=None,
+                   species=None, species_source="species", group=None,
+                   qc_list=None, samples=None,
+                   sample_names=None,
+                   projection=None, batch_size=FILTER_BATCH_SIZE):
+    """
+    Generator version of filter() without pagination: yields lists of up to
+    batch_size samples, fetched from one cursor batch by batch.
+    """
+    connection = get_connection()
+    db = connection['bifrost_upgrade_test']
+    match_query = filter_query(
+        db, run_names=run_names, species=species,
+        species_source=species_source, group=group, qc_list=qc_list,
+        samples=samples, sample_names=sample_names)
+    cursor = db.samples.find(
+        match_query, projection, batch_size=batch_size).sort(paging.SORT)
+    batch = []
+    try:
+        for sample in cursor:
+            batch.append(sample)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if len(batch):
+            yield batch
+    finally:
+        cursor.close()
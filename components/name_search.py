@@ -0,0 +1,192 @@
+"""
+Sample name search that can use indexes.
+
+Sample names given to filter() as /pattern/ used to become unanchored
+regexes, which scan every name. Here
+    /^prefix/ or /^prefix.*/   becomes a range on the name index,
+    /text/ (plain text)        is looked up in the trigram index,
+    anything else              stays a regex.
+
+The trigram index is the name_trigrams field of samples (lowercased
+trigrams of the name, multikey indexed) plus the name_trigrams collection
+    {"_id": <trigram>, "count": <n samples>}
+used to look up the rarest trigram first, since only the first element of
+an $all is used for the index bounds. Samples written without the field,
+e.g. by the pipeline before the next rebuild_name_trigrams(), are still
+matched by their name.
+"""
+import re
+import itertools
+import pymongo
+
+import components.mongo_connection as mongo_connection
+
+COLLECTION = "name_trigrams"
+FIELD = "name_trigrams"
+
+REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+def trigrams(name):
+    name = name.lower()
+    return sorted({name[i:i + 3] for i in range(len(name) - 2)})
+
+
+def set_trigrams(sample):
+    "Set the trigram field of a sample before it is saved"
+    if isinstance(sample.get("name"), str):
+        sample[FIELD] = trigrams(sample["name"])
+    return sample
+
+
+def is_literal(text):
+    return not any(c in REGEX_METACHARACTERS for c in text)
+
+
+def is_built(db):
+    return db[COLLECTION].find_one({}, {"_id": 1}) is not None
+
+
+def prefix_range(prefix):
+    """
+    Range of the strings starting with prefix, which unlike a regex is
+    always answered from the index bounds.
+    """
+    upper = prefix
+    while upper and ord(upper[-1]) == 0x10FFFF:
+        upper = upper[:-1]
+    if not upper:
+        return {"$gte": prefix}
+    return {"$gte": prefix, "$lt": upper[:-1] + chr(ord(upper[-1]) + 1)}
+
+
+def by_rarity(db, grams):
+    counts = {doc["_id"]: doc["count"]
+              for doc in db[COLLECTION].find({"_id": {"$in": grams}})}
+    return sorted(grams, key=lambda gram: counts.get(gram, 0))
+
+
+def substring_query(db, text, flags=0):
+    """
+    Match names containing text. Uses the trigram index when it is built
+    and text is at least 3 characters long; db may be None to skip that.
+    Samples without trigrams are matched on the name alone.
+    """
+    query = {"name": re.compile(re.escape(text), flags)}
+    if db is not None and len(text) >= 3 and is_built(db):
+        query["$or"] = [{FIELD: {"$all": by_rarity(db, trigrams(text))}},
+                        {FIELD: {"$exists": False}}]
+    return query
+
+
+def case_insensitive_prefix(prefix):
+    """
+    Match names starting with prefix in any case, as one index range per
+    case variant of the prefix; meant for short prefixes.
+    """
+    variants = sorted({"".join(chars) for chars in itertools.product(
+        *[{c.lower(), c.upper()} for c in prefix])})
+    if len(variants) == 1:
+        return {"name": prefix_range(prefix)}
+    return {"$or": [{"name": prefix_range(variant)} for variant in variants]}
+
+
+def pattern_query(db, pattern):
+    "Query for one /pattern/ sample name, given without the slashes"
+    if pattern.startswith("^"):
+        prefix = pattern[1:]
+        if prefix.endswith(".*"):
+            prefix = prefix[:-2]
+        if prefix and is_literal(prefix):
+            return {"name": prefix_range(prefix)}
+    elif pattern and is_literal(pattern):
+        return substring_query(db, pattern)
+    return {"name": re.compile(pattern)}
+
+
+def names_query(db, sample_names):
+    """
+    Query matching any of sample_names, where names wrapped in slashes are
+    patterns.
+    """
+    names = []
+    clauses = []
+    for s_n in sample_names:
+        if len(s_n) > 1 and s_n.startswith("/") and s_n.endswith("/"):
+            clauses.append(pattern_query(db, s_n[1:-1]))
+        else:
+            names.append(s_n)
+    if names:
+        clauses.insert(0, {"name": {"$in": names}})
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$or": clauses}
+
+
+def search_query(db, text):
+    "The samples query of search()"
+    if len(text) < 3:
+        return case_insensitive_prefix(text)
+    return substring_query(db, text, re.IGNORECASE)
+
+
+def search(text, limit=20, db=None):
+    """
+    Search-as-you-type: return up to limit {"_id", "name"} of the samples
+    whose name contains text (case insensitive), sorted by name. Texts
+    shorter than a trigram match as a name prefix, in any case too.
+    """
+    if db is None:
+        db = mongo_connection.get_db()
+    return list(db.samples.find(search_query(db, text), {"name": 1}).sort(
+        "name", pymongo.ASCENDING).limit(limit))
+
+
+def update_name_trigrams(db, old_sample, new_sample):
+    """
+    Keep the trigram counts in step after writing new_sample over
+    old_sample (either may be None).
+    """
+    old = set(old_sample.get(FIELD, []) if old_sample else [])
+    new = set(new_sample.get(FIELD, []) if new_sample else [])
+    updates = [pymongo.UpdateOne({"_id": gram}, {"$inc": {"count": -1}})
+               for gram in old - new]
+    updates += [pymongo.UpdateOne({"_id": gram}, {"$inc": {"count": 1}},
+                                  upsert=True)
+                for gram in new - old]
+    if updates:
+        db[COLLECTION].bulk_write(updates, ordered=False)
+
+
+def rebuild_name_trigrams(db=None, batch_size=1000):
+    """
+    Set the trigram field of every sample and recount the trigrams. Needed
+    once, and after samples are written by processes that don't call
+    set_trigrams.
+    """
+    if db is None:
+        db = mongo_connection.get_db()
+    counts = {}
+    updates = []
+    for sample in db.samples.find({}, {"name": 1}):
+        if not isinstance(sample.get("name"), str):
+            continue
+        grams = trigrams(sample["name"])
+        for gram in grams:
+            counts[gram] = counts.get(gram, 0) + 1
+        updates.append(pymongo.UpdateOne({"_id": sample["_id"]},
+                                         {"$set": {FIELD: grams}}))
+        if len(updates) == batch_size:
+            db.samples.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        db.samples.bulk_write(updates, ordered=False)
+    db[COLLECTION].delete_many({})
+    if counts:
+        db[COLLECTION].insert_many(
+            [{"_id": gram, "count": n} for gram, n in counts.items()])
+    return len(counts)
+
+
+if __name__ == "__main__":
+    print("{} trigrams indexed.".format(rebuild_name_trigrams()))
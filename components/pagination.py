@@ -0,0 +1,58 @@
+import json
+import base64
+import pymongo
+from bson.objectid import ObjectId
+
+# Samples are always returned in (name, _id) order so that keyset pages are
+# stable even when several samples share a name.
+SORT = [("name", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+
+
+def encode_cursor(sample):
+    """
+    Build an opaque page token from the last sample (dict or DataFrame row)
+    of a page.
+    """
+    token = json.dumps({"n": sample["name"], "i": str(sample["_id"])})
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token):
+    values = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    return values["n"], ObjectId(values["i"])
+
+
+def is_keyset(pagination):
+    return pagination is not None and "after" in pagination
+
+
+def keyset_query(token):
+    """
+    Return the match condition selecting the samples after token, or None
+    for the first page.
+    """
+    if token is None:
+        return None
+    name, _id = decode_cursor(token)
+    return {"$or": [
+        {"name": {"$gt": name}},
+        {"name": name, "_id": {"$gt": _id}}
+    ]}
+
+
+def keyset_projection(projection):
+    """
+    Make sure an inclusion projection returns the fields the page token is
+    built from.
+    """
+    if projection is None:
+        return None
+    if isinstance(projection, dict):
+        if any(v for k, v in projection.items() if k != "_id"):
+            projection = dict(projection, name=1)
+            projection.pop("_id", None)
+        return projection
+    projection = list(projection)
+    if "name" not in projection:
+        projection.append("name")
+    return projection
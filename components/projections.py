@@ -0,0 +1,53 @@
+"""
+Minimal mongo projections per view, derived from the column definitions in
+global_vars, so each filter_all call only transfers the fields it shows.
+"""
+import components.global_vars as global_vars
+
+SPECIES_FIELDS = global_vars.SPECIES_FIELDS
+
+
+def column_ids(columns):
+    return [column["id"] for column in columns]
+
+
+def build_projection(fields):
+    """
+    Return an inclusion projection for fields, dropping paths already
+    covered by a parent path (mongo rejects such path collisions).
+    """
+    fields = sorted(set(fields))
+    kept = []
+    for field in fields:
+        if not any(field.startswith(parent + ".") for parent in kept):
+            kept.append(field)
+    projection = {field: 1 for field in kept}
+    projection["_id"] = 1
+    return projection
+
+
+VIEW_FIELDS = {
+    # Samples selected into sample-store / analysis-store
+    "sample_store": ["name"],
+    # Isolates tab table
+    "isolates": column_ids(global_vars.QC_COLUMNS),
+    # Analyses tab table
+    "analyses": column_ids(global_vars.COLUMNS),
+    # Sample report cards
+    "sample_card": global_vars.SAMPLE_CARD_FIELDS,
+    # Species dropdown of the aggregate view
+    "aggregate_species": SPECIES_FIELDS,
+    # Aggregate box plots and MLST sunburst
+    "aggregate": (["name", "properties.mlst.summary.strain"] +
+                  SPECIES_FIELDS +
+                  column_ids(global_vars.plot_values) +
+                  global_vars.value_from_test),
+}
+
+PROJECTIONS = {view: build_projection(fields)
+               for view, fields in VIEW_FIELDS.items()}
+
+
+def get_projection(view):
+    "Return a copy of the projection registered for view"
+    return dict(PROJECTIONS[view])
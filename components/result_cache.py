@@ -0,0 +1,280 @@
+"""
+Query-result cache shared by the worker processes of one host.
+
+Results are pickled into a sqlite file (RESULT_CACHE_PATH) and evicted
+least-recently-used once they add up to more than RESULT_CACHE_MAX_BYTES.
+Entries are dropped on sample and run invalidation events (see
+components.invalidation) and expire after RESULT_CACHE_TTL seconds.
+Hit/miss counts and the last use of entries are kept in memory and added
+to the same file at most every RESULT_CACHE_FLUSH_S seconds (and with
+every set()), so hits don't write to it and get_stats() covers all
+workers.
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+import components.invalidation as invalidation
+
+RESULT_CACHE_PATH = os.getenv(
+    "RESULT_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "beone_result_cache.sqlite"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 256 * 2**20))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 60 * 60 * 4))
+RESULT_CACHE_FLUSH_S = float(os.getenv("RESULT_CACHE_FLUSH_S", 10))
+
+MISSING = object()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0), ('evictions', 0),
+    ('version', 0);
+"""
+
+
+def normalize_arg(value):
+    """
+    Make equivalent filter arguments compare equal: id and name lists are
+    sorted sets, dicts are sorted by key.
+    """
+    if isinstance(value, dict):
+        return [[str(k), normalize_arg(v)] for k, v in sorted(
+            value.items(), key=lambda item: str(item[0]))]
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sorted({json.dumps(normalize_arg(v), sort_keys=True)
+                       for v in value})
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+
+def make_key(namespace, **kwargs):
+    normalized = json.dumps([namespace, normalize_arg(kwargs)], sort_keys=True)
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    With ttl None entries never expire and are only evicted for size.
+    """
+
+    def __init__(self, path=RESULT_CACHE_PATH, max_bytes=RESULT_CACHE_MAX_BYTES,
+                 ttl=RESULT_CACHE_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        # Counts and last uses not written yet, and the process they
+        # belong to, as a fork copies them.
+        self._pending_lock = threading.Lock()
+        self._pending_pid = None
+        self._pending_counts = {}
+        self._pending_used = {}
+        self._flushed = time.time()
+
+    def _connection(self):
+        # sqlite connections can not be shared between threads or processes.
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _count(self, connection, name, n=1):
+        connection.execute(
+            "UPDATE stats SET value = value + ? WHERE name = ?", (n, name))
+
+    def _record(self, name, key=None, now=None):
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                self._pending_pid = os.getpid()
+                self._pending_counts = {}
+                self._pending_used = {}
+            self._pending_counts[name] = self._pending_counts.get(name, 0) + 1
+            if key is not None:
+                self._pending_used[key] = now
+            due = time.time() - self._flushed >= RESULT_CACHE_FLUSH_S
+        if due:
+            self.flush()
+
+    def _take_pending(self):
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                return {}, {}
+            counts, used = self._pending_counts, self._pending_used
+            self._pending_counts, self._pending_used = {}, {}
+            self._flushed = time.time()
+            return counts, used
+
+    def _write_pending(self, connection, counts, used):
+        for name, n in counts.items():
+            self._count(connection, name, n)
+        connection.executemany(
+            "UPDATE entries SET last_used = MAX(last_used, ?) WHERE key = ?",
+            [(last_used, key) for key, last_used in used.items()])
+
+    def flush(self):
+        "Write the hit/miss counts and last uses kept by this process"
+        counts, used = self._take_pending()
+        if not counts and not used:
+            return
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_pending(connection, counts, used)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def get(self, key):
+        """
+        Return the cached value of key, or MISSING.
+        """
+        if self.max_bytes <= 0:
+            return MISSING
+        connection = self._connection()
+        now = time.time()
+        if self.ttl is None:
+            row = connection.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        else:
+            row = connection.execute(
+                "SELECT value FROM entries WHERE key = ? AND created > ?",
+                (key, now - self.ttl)).fetchone()
+        if row is None:
+            self._record("misses")
+            return MISSING
+        self._record("hits", key, now)
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        if self.max_bytes <= 0:
+            return
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        connection = self._connection()
+        now = time.time()
+        counts, used = self._take_pending()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_pending(connection, counts, used)
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now))
+            self._evict(connection, now)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _evict(self, connection, now):
+        if self.ttl is not None:
+            connection.execute("DELETE FROM entries WHERE created <= ?",
+                               (now - self.ttl,))
+        total = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in connection.execute(
+                "SELECT key, size FROM entries ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self._count(connection, "evictions", len(evicted))
+
+    def clear(self, event=None):
+        self._connection().execute("DELETE FROM entries")
+
+    def get_version(self):
+        """
+        Data version shared by all workers, for use in keys: bumping it
+        makes every older entry unreachable, and they age out by LRU.
+        """
+        return self._connection().execute(
+            "SELECT value FROM stats WHERE name = 'version'").fetchone()[0]
+
+    def bump_version(self, event=None):
+        self._count(self._connection(), "version")
+
+    def get_stats(self):
+        self.flush()
+        connection = self._connection()
+        stats = dict(connection.execute("SELECT name, value FROM stats"))
+        entries, size = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        stats.pop("version")
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["entries"] = entries
+        stats["bytes"] = size
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """
+    Return the process-wide ResultCache, subscribed to sample and run
+    invalidation events.
+    """
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                cache = ResultCache()
+                invalidation.subscribe(cache.clear, ["samples", "runs"])
+                _CACHE = cache
+    return _CACHE
+
+
+def get_stats():
+    return get_cache().get_stats()
+
+
+def main(argv):
+    """
+    python -m components.result_cache [stats|clear]
+    """
+    command = argv[0] if argv else "stats"
+    if command == "clear":
+        get_cache().clear()
+    elif command == "stats":
+        stats = get_stats()
+        print("{hits} hits, {misses} misses ({hit_rate:.1%}), {evictions} "
+              "evictions, {entries} entries, {bytes}/{max_bytes} bytes".format(
+                  **stats))
+    else:
+        sys.exit(main.__doc__)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
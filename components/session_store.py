@@ -0,0 +1,140 @@
+"""
+Server-side storage for the selections of the sample-store, analysis-store
+and survey-store dcc.Stores.
+
+The browser only keeps a handle
+    {"session": <token>, "version": <n>, "count": <n items>}
+while the selection itself is kept in documents of the session_store
+collection: a session document counting the versions
+    {"_id": <token>, "version": <n>, "updated_at": <date>}
+and the chunks of each version of the selection
+    {"session": <token>, "version": <n>, "chunk": <i>,
+     "sample_ids": <packed ObjectIds> or "records": [...],
+     "updated_at": <date>}
+each below SESSION_CHUNK_BYTES, so selections are not bound by the 16MB
+document limit. Sample ids are packed as binaries of 12 byte ObjectIds.
+A handle reads the version it was returned with; the previous version is
+kept for callbacks still holding it, older ones are deleted. Sessions
+expire SESSION_TTL seconds after their last write (TTL index, see
+components.indexes).
+"""
+import os
+import uuid
+from datetime import datetime
+import bson
+import pymongo
+from pymongo import ReturnDocument
+from bson.binary import Binary
+from bson.objectid import ObjectId
+
+import components.mongo_connection as mongo_connection
+import components.result_cache as result_cache
+
+COLLECTION = "session_store"
+SESSION_TTL = int(os.getenv("SESSION_TTL", 60 * 60 * 24 * 7))
+SESSION_CHUNK_BYTES = int(os.getenv("SESSION_CHUNK_BYTES", 8 * 1024 * 1024))
+
+
+def pack_ids(sample_ids):
+    return Binary(b"".join(ObjectId(i).binary for i in sample_ids))
+
+
+def unpack_ids(packed):
+    packed = bytes(packed)
+    return [ObjectId(packed[i:i + 12]) for i in range(0, len(packed), 12)]
+
+
+def _save(handle, field, chunks, count, db=None):
+    if db is None:
+        db = mongo_connection.get_db()
+    if handle is None or "session" not in handle:
+        token = uuid.uuid4().hex
+    else:
+        token = handle["session"]
+    now = datetime.utcnow()
+    doc = db[COLLECTION].find_one_and_update(
+        {"_id": token},
+        {"$set": {"updated_at": now}, "$inc": {"version": 1}},
+        projection={"version": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER)
+    version = doc["version"]
+    docs = [{"session": token, "version": version, "chunk": i, field: chunk,
+             "updated_at": now} for i, chunk in enumerate(chunks)]
+    if docs:
+        db[COLLECTION].insert_many(docs)
+    db[COLLECTION].delete_many({"session": token,
+                                "version": {"$lt": version - 1}})
+    return {"session": token, "version": version, "count": count}
+
+
+def _load(handle, field, db=None):
+    "Return the chunks of field stored for the version of handle"
+    if not handle or "session" not in handle:
+        return []
+    if db is None:
+        db = mongo_connection.get_db()
+    return [doc[field] for doc in db[COLLECTION].find(
+        {"session": handle["session"], "version": handle.get("version")},
+        {"_id": 0, field: 1}).sort("chunk", pymongo.ASCENDING)]
+
+
+def save_sample_ids(handle, sample_ids, db=None):
+    """
+    Store sample_ids under the session of handle (a new one if handle is
+    None) and return the new handle for the dcc.Store.
+    """
+    sample_ids = list(sample_ids)
+    per_chunk = max(SESSION_CHUNK_BYTES // 12, 1)
+    chunks = [pack_ids(sample_ids[start:start + per_chunk])
+              for start in range(0, len(sample_ids), per_chunk)]
+    return _save(handle, "sample_ids", chunks, len(sample_ids), db)
+
+
+def get_sample_ids(handle, db=None):
+    "Return the sample ObjectIds stored for handle ([] if there are none)"
+    return [sample_id for packed in _load(handle, "sample_ids", db)
+            for sample_id in unpack_ids(packed)]
+
+
+def save_records(handle, records, db=None):
+    records = list(records)
+    chunks = []
+    chunk, size = [], 0
+    for record in records:
+        record_size = len(bson.encode(record))
+        if chunk and size + record_size > SESSION_CHUNK_BYTES:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(record)
+        size += record_size
+    if chunk:
+        chunks.append(chunk)
+    return _save(handle, "records", chunks, len(records), db)
+
+
+def get_records(handle, db=None):
+    return [record for chunk in _load(handle, "records", db)
+            for record in chunk]
+
+
+def count(handle):
+    if not handle:
+        return 0
+    return handle.get("count", 0)
+
+
+def get_frame(handle, name, build):
+    """
+    Return the DataFrame build(sample_ids) derived from the samples of
+    handle, cached per session version in components.result_cache.
+    """
+    cache = result_cache.get_cache()
+    key = result_cache.make_key(
+        "session_frame", session=handle.get("session"),
+        version=handle.get("version"), name=name)
+    frame = cache.get(key)
+    if frame is result_cache.MISSING:
+        frame = build(get_sample_ids(handle))
+        cache.set(key, frame)
+    return frame
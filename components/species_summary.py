@@ -0,0 +1,233 @@
+"""
+Materialized species counts, so the species dropdowns don't need a $group
+over the whole samples collection.
+
+Documents in species_summary look like
+    {"field": <species field>, "run": <run name or None>,
+     "species": <value>, "count": <n>}
+where run None holds the counts over all samples, plus one state document
+    {"field": "_state", "updated_at": <datetime>}
+saying up to which metadata.updated_at of samples and runs the counts are
+known to be right. Samples and runs written later by other processes, like
+the pipeline, make the summary stale and the dropdowns fall back to a live
+$group until it is rebuilt. Whether it is current is cached per process
+until the next invalidation event on samples or runs.
+"""
+import threading
+from datetime import datetime
+import pymongo
+
+import components.mongo_connection as mongo_connection
+import components.global_vars as global_vars
+import components.invalidation as invalidation
+
+COLLECTION = "species_summary"
+STATE = {"field": "_state", "run": None, "species": None}
+COUNTS_PROJECTION = {"_id": 0, "species": 1, "count": 1}
+
+SPECIES_FIELDS = global_vars.SPECIES_FIELDS
+
+# The newest document of a collection, as find_one() arguments.
+NEWEST = ({"metadata.updated_at": {"$exists": True}},
+          {"_id": 1, "metadata.updated_at": 1})
+NEWEST_SORT = [("metadata.updated_at", pymongo.DESCENDING)]
+
+_current = {}
+_generation = 0
+_lock = threading.Lock()
+
+
+def get_from_path(sample, path):
+    value = sample
+    for field in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(field)
+    return value
+
+
+def forget(event=None):
+    "Drop the cached answers of is_current()"
+    global _generation
+    with _lock:
+        _generation += 1
+        _current.clear()
+
+
+invalidation.subscribe(forget, ["samples", "runs"])
+
+
+def cached_current(db_name):
+    """
+    Return the cached is_current() answer for db_name, or None, and the
+    generation to pass to remember_current().
+    """
+    with _lock:
+        return _current.get(db_name), _generation
+
+
+def remember_current(db_name, generation, current):
+    with _lock:
+        if generation == _generation:
+            _current[db_name] = current
+
+
+def state_is_current(state, newest):
+    """
+    Whether the summary state document is not older than the newest
+    documents of samples and runs (None for empty collections).
+    """
+    if state is None:
+        return False
+    return all(get_from_path(doc, "metadata.updated_at") <= state["updated_at"]
+               for doc in newest if doc is not None)
+
+
+def is_current(db, spe_field):
+    """
+    Whether the summary of spe_field is built and no sample or run was
+    written since it was last brought up to date.
+    """
+    if spe_field not in SPECIES_FIELDS:
+        return False
+    current, generation = cached_current(db.name)
+    if current is None:
+        newest = [db[collection].find_one(*NEWEST, sort=NEWEST_SORT)
+                  for collection in ("samples", "runs")]
+        current = state_is_current(db[COLLECTION].find_one(STATE), newest)
+        remember_current(db.name, generation, current)
+    return current
+
+
+def covers(run_names):
+    """
+    Whether the summary can count the samples of run_names: all samples or
+    a single run. A sample in several runs would be counted once per run in
+    their summed counts, so those need the live $group.
+    """
+    return run_names is None or len(run_names) <= 1
+
+
+def counts_query(spe_field, run_names=None):
+    if run_names is None:
+        query = {"field": spe_field, "run": None}
+    else:
+        query = {"field": spe_field, "run": {"$in": list(run_names)}}
+    query["count"] = {"$gt": 0}
+    return query
+
+
+def merge_counts(docs):
+    """
+    Sum summary documents per species into [{"_id": species, "count": n}]
+    sorted by species, like the species_pipeline() aggregation.
+    """
+    counts = {}
+    for doc in docs:
+        counts[doc["species"]] = counts.get(doc["species"], 0) + doc["count"]
+    return [{"_id": species, "count": counts[species]}
+            for species in sorted(counts, key=lambda s: (s is not None, s))]
+
+
+def get_species_counts(db, spe_field, run_names=None):
+    """
+    Return the species counts of spe_field, over all samples or summed over
+    run_names, which is only exact for what covers().
+    """
+    return merge_counts(db[COLLECTION].find(
+        counts_query(spe_field, run_names), COUNTS_PROJECTION))
+
+
+def species_updates(sample, spe_fields, run_names, inc):
+    updates = []
+    for spe_field in spe_fields:
+        species = get_from_path(sample, spe_field)
+        for run in [None] + list(run_names):
+            updates.append(pymongo.UpdateOne(
+                {"field": spe_field, "run": run, "species": species},
+                {"$inc": {"count": inc}},
+                upsert=True))
+    return updates
+
+
+def update_species_summary(db, old_sample, new_sample, run_names=()):
+    """
+    Apply the count changes of writing new_sample over old_sample (either
+    may be None for inserts and deletes).
+    """
+    spe_fields = SPECIES_FIELDS
+    if old_sample is not None and new_sample is not None:
+        spe_fields = [spe_field for spe_field in SPECIES_FIELDS
+                      if get_from_path(old_sample, spe_field) !=
+                      get_from_path(new_sample, spe_field)]
+    updates = []
+    if old_sample is not None:
+        updates += species_updates(old_sample, spe_fields, run_names, -1)
+    if new_sample is not None:
+        updates += species_updates(new_sample, spe_fields, run_names, 1)
+    if updates:
+        db[COLLECTION].bulk_write(updates, ordered=False)
+    updated_at = get_from_path(new_sample or {}, "metadata.updated_at")
+    if updated_at is not None:
+        advance_state(db, updated_at, new_sample["_id"])
+
+
+def advance_state(db, updated_at, sample_id):
+    """
+    Move the state up to updated_at after the counts of sample_id were
+    applied, unless other samples or runs were written since the state,
+    which the counts don't include.
+    """
+    state = db[COLLECTION].find_one(STATE)
+    if state is None:
+        return
+    since = {"metadata.updated_at": {"$gt": state["updated_at"]}}
+    if db.samples.find_one(dict(since, _id={"$ne": sample_id}), {"_id": 1}):
+        return
+    if db.runs.find_one(since, {"_id": 1}):
+        return
+    db[COLLECTION].update_one(dict(STATE, updated_at=state["updated_at"]),
+                              {"$max": {"updated_at": updated_at}})
+
+
+def rebuild_species_summary(db=None):
+    """
+    Recompute the whole summary from samples and runs. Needed once, and
+    after samples are written by processes that don't call
+    update_species_summary.
+    """
+    if db is None:
+        db = mongo_connection.get_db()
+    # Writes made while counting are newer than the state, so they leave
+    # the summary stale rather than missing from it.
+    newest = [db[collection].find_one(*NEWEST, sort=NEWEST_SORT)
+              for collection in ("samples", "runs")]
+    updated_at = max([doc["metadata"]["updated_at"]
+                      for doc in newest if doc is not None],
+                     default=datetime.min)
+    docs = []
+    for spe_field in SPECIES_FIELDS:
+        grouped = db.samples.aggregate([
+            {"$group": {"_id": "$" + spe_field, "count": {"$sum": 1}}}
+        ])
+        docs += [{"field": spe_field, "run": None,
+                  "species": g["_id"], "count": g["count"]} for g in grouped]
+        for run in db.runs.find({}, {"name": 1, "samples._id": 1}):
+            sample_ids = [s["_id"] for s in run.get("samples", [])]
+            grouped = db.samples.aggregate([
+                {"$match": {"_id": {"$in": sample_ids}}},
+                {"$group": {"_id": "$" + spe_field, "count": {"$sum": 1}}}
+            ])
+            docs += [{"field": spe_field, "run": run["name"],
+                      "species": g["_id"], "count": g["count"]}
+                     for g in grouped]
+    docs.append(dict(STATE, count=0, updated_at=updated_at))
+    db[COLLECTION].delete_many({})
+    if docs:
+        db[COLLECTION].insert_many(docs)
+    forget()
+    return len(docs)
+
+
+if __name__ == "__main__":
+    print("{} species counts written.".format(rebuild_species_summary()))
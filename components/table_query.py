@@ -0,0 +1,203 @@
+"""
+Server-side filtering, sorting and selection for DataTables with
+filter_action, sort_action and page_action set to "custom".
+
+The filter row of a DataTable sends a filter_query such as
+
+    {sample_sheet.run_name} contains "200101" && {sample_sheet.SampleType} = "x"
+
+which filter_condition() translates into a mongo match on the table columns.
+Selections across pages are kept as a small model of row ids instead of
+the row indices of a page:
+
+    {"all": False, "ids": [...]}   the ids are the selected rows
+    {"all": True, "ids": [...]}    every row matching the filters but the ids
+
+so selecting all rows does not need them on the client. The model is only
+meaningful for the filters it was made with and is reset when they change.
+"""
+import re
+from datetime import timedelta
+import pymongo
+
+# Comparison operators of the filter row, by name and by symbol.
+COMPARISONS = {
+    "ge": "$gte", ">=": "$gte",
+    "le": "$lte", "<=": "$lte",
+    "gt": "$gt", ">": "$gt",
+    "lt": "$lt", "<": "$lt",
+}
+
+_PART = re.compile(r"^\{(?P<column>[^}]+)\}\s+(?P<operator>\S+)\s+(?P<value>.*)$")
+QUOTES = "\"'`"
+
+
+def split_parts(filter_query):
+    """
+    Split a filter_query on the " && " between its parts, but not on one
+    inside a quoted operand (one starting with a quote).
+    """
+    parts = []
+    start = 0
+    quote = None
+    i = 0
+    while i < len(filter_query):
+        c = filter_query[i]
+        if quote is not None:
+            if c == "\\":
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in QUOTES and (i == 0 or filter_query[i - 1].isspace()):
+            quote = c
+        elif filter_query.startswith(" && ", i):
+            parts.append(filter_query[start:i])
+            start = i + len(" && ")
+            i = start
+            continue
+        i += 1
+    parts.append(filter_query[start:])
+    return parts
+
+
+def parse_value(text):
+    """
+    Return the value of a filter operand: the unquoted string, or a number
+    for unquoted numeric operands.
+    """
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in QUOTES:
+        return re.sub(r"\\(.)", r"\1", text[1:-1])
+    for number in (int, float):
+        try:
+            return number(text)
+        except ValueError:
+            pass
+    return text
+
+
+def condition(column, operator, value):
+    numeric = isinstance(value, (int, float))
+    if operator in ("eq", "="):
+        # Numbers typed in the filter row also match numeric strings.
+        return {column: {"$in": [value, str(value)]} if numeric else value}
+    if operator in ("ne", "!="):
+        return {column: {"$nin": [value, str(value)]} if numeric
+                else {"$ne": value}}
+    if operator in ("contains", "datestartswith"):
+        pattern = re.escape(str(value))
+        if operator == "datestartswith":
+            pattern = "^" + pattern
+        return {column: {"$regex": pattern}}
+    if operator in COMPARISONS:
+        return {column: {COMPARISONS[operator]: value}}
+    return None
+
+
+def filter_condition(filter_query, columns):
+    """
+    Translate a DataTable filter_query into a mongo match on the given
+    column ids, or None when there is nothing to filter on. Parts naming
+    other fields or operators are ignored.
+    """
+    if not filter_query:
+        return None
+    conditions = []
+    for part in split_parts(filter_query):
+        match = _PART.match(part.strip())
+        if match is None or match.group("column") not in columns:
+            continue
+        result = condition(match.group("column"),
+                           match.group("operator").lower(),
+                           parse_value(match.group("value")))
+        if result is not None:
+            conditions.append(result)
+    if len(conditions) == 0:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def date_condition(field, start_date=None, end_date=None):
+    """
+    Match field between two datetimes (inclusive of the end day), whether
+    it is stored as a date or as a string starting with YYYY-MM-DD. Unlike
+    pd.to_datetime, other date formats stored as strings are not parsed
+    and don't match.
+    """
+    if start_date is None and end_date is None:
+        return None
+    as_date, as_string = {}, {}
+    if start_date is not None:
+        as_date["$gte"] = start_date
+        as_string["$gte"] = start_date.strftime("%Y-%m-%d")
+    if end_date is not None:
+        as_date["$lt"] = end_date + timedelta(days=1)
+        as_string["$lt"] = (end_date + timedelta(days=1)).strftime("%Y-%m-%d")
+    return {"$or": [{field: as_date}, {field: as_string}]}
+
+
+def combine(*conditions):
+    conditions = [c for c in conditions if c]
+    if len(conditions) == 0:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def sort_spec(sort_by, columns):
+    """
+    Translate a DataTable sort_by into a pymongo sort, ending on _id so
+    that pages are stable. None keeps the default sample order.
+    """
+    sort = [(s["column_id"],
+             pymongo.DESCENDING if s.get("direction") == "desc"
+             else pymongo.ASCENDING)
+            for s in sort_by or [] if s.get("column_id") in columns]
+    if len(sort) == 0:
+        return None
+    return sort + [("_id", pymongo.ASCENDING)]
+
+
+# Selection across pages
+
+def empty_selection():
+    return {"all": False, "ids": []}
+
+
+def select_all():
+    return {"all": True, "ids": []}
+
+
+def is_selected(selection, row_id):
+    selection = selection or empty_selection()
+    return (row_id in selection["ids"]) != selection["all"]
+
+
+def update_page_selection(selection, page_ids, selected_ids):
+    """
+    Return selection with the rows of the page set to the rows selected in
+    it.
+    """
+    selection = selection or empty_selection()
+    page_ids = set(page_ids or [])
+    selected_ids = set(selected_ids or []) & page_ids
+    ids = set(selection["ids"]) - page_ids
+    if selection["all"]:
+        ids |= page_ids - selected_ids
+    else:
+        ids |= selected_ids
+    return dict(selection, ids=sorted(ids))
+
+
+def selection_count(selection, matching):
+    """
+    Number of selected rows, given the number of rows matching the
+    filters.
+    """
+    selection = selection or empty_selection()
+    if selection["all"]:
+        return max(matching - len(selection["ids"]), 0)
+    return len(selection["ids"])
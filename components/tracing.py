@@ -0,0 +1,452 @@
+"""
+Span-based tracing of dashboard requests.
+
+With TRACE_EXPORT set, every HTTP request is a trace whose spans follow a
+callback down to its data access and back:
+
+    http POST /_dash-update-component
+      callback render_sample_report
+        render_sample_report          (the callback function)
+          components.import_data.count_filtered
+            mongo count samples
+          pandas / figure             (callback_metrics.phase blocks)
+        encode                        (JSON serialization of the response)
+
+The trace id is taken from a W3C traceparent request header when there is
+one and is returned in the traceparent and X-Trace-Id response headers.
+Finished traces are exported from a background thread:
+
+    TRACE_EXPORT=file   one JSON line per trace in TRACE_FILE
+    TRACE_EXPORT=otlp   OTLP/HTTP JSON to TRACE_OTLP_ENDPOINT
+
+Show the slowest traces of a trace file with
+python -m components.tracing [TRACE_FILE] [n].
+"""
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import tempfile
+import threading
+import functools
+import contextlib
+import urllib.request
+import flask
+from pymongo import monitoring
+from dash.exceptions import PreventUpdate
+
+from components.command_stats import calling_function
+
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACE_FILE = os.getenv(
+    "TRACE_FILE", os.path.join(tempfile.gettempdir(), "beone_traces.jsonl"))
+TRACE_OTLP_ENDPOINT = os.getenv(
+    "TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "beone")
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def new_id(n_bytes):
+    return os.urandom(n_bytes).hex()
+
+
+def current_span():
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def _new_span(name, trace_id, parent_id, attributes):
+    return {
+        "trace_id": trace_id,
+        "span_id": new_id(8),
+        "parent_id": parent_id,
+        "name": name,
+        "start_ns": time.time_ns(),
+        "end_ns": None,
+        "attributes": dict(attributes),
+        "error": None,
+    }
+
+
+def _finish(span):
+    trace = getattr(_local, "trace", None)
+    if trace is not None and trace["trace_id"] == span["trace_id"]:
+        trace["spans"].append(span)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Record the block as a child of the current span. A no-op outside a
+    trace, so it can be left in code that also runs untraced.
+    """
+    parent = current_span()
+    if parent is None:
+        yield None
+        return
+    child = _new_span(name, parent["trace_id"], parent["span_id"], attributes)
+    _local.stack.append(child)
+    try:
+        yield child
+    except PreventUpdate:
+        raise
+    except BaseException as e:
+        child["error"] = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        _local.stack.pop()
+        child["end_ns"] = time.time_ns()
+        _finish(child)
+
+
+def traced(function):
+    "Decorator recording each call of function as a span"
+    name = "{}.{}".format(function.__module__, function.__name__)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if current_span() is None:
+            return function(*args, **kwargs)
+        with span(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def start_trace(name, traceparent=None, **attributes):
+    """
+    Start a trace in this thread, continuing the one in a W3C traceparent
+    header if given. Returns the root span.
+    """
+    trace_id, parent_id = new_id(16), None
+    if traceparent:
+        parts = traceparent.strip().split("-")
+        if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+            trace_id, parent_id = parts[1], parts[2]
+    root = _new_span(name, trace_id, parent_id, attributes)
+    _local.trace = {"trace_id": trace_id, "spans": []}
+    _local.stack = [root]
+    return root
+
+
+def end_trace(error=None):
+    """
+    Finish the trace of this thread and queue it for export.
+    """
+    trace = getattr(_local, "trace", None)
+    stack = getattr(_local, "stack", None)
+    _local.trace = None
+    _local.stack = None
+    if trace is None or not stack:
+        return
+    root = stack[0]
+    root["end_ns"] = time.time_ns()
+    if error is not None:
+        root["error"] = "{}: {}".format(type(error).__name__, error)
+    trace["spans"].append(root)
+    if TRACE_EXPORT:
+        export(trace["spans"])
+
+
+def traceparent(span):
+    return "00-{}-{}-01".format(span["trace_id"], span["span_id"])
+
+
+@contextlib.contextmanager
+def continue_trace(name, parent, **attributes):
+    """
+    Record the block as a trace of its own continuing the traceparent
+    parent, for work handed to another thread. A no-op without a parent.
+    """
+    if not parent:
+        yield None
+        return
+    root = start_trace(name, parent, **attributes)
+    error = None
+    try:
+        yield root
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        end_trace(error)
+
+
+class CommandTracer(monitoring.CommandListener):
+    """
+    Records mongo commands as spans of the trace of the thread sending them.
+    Motor commands run on the event loop thread and are not traced.
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        parent = current_span()
+        if parent is None:
+            return
+        command = event.command
+        attributes = {
+            "db.system": "mongodb",
+            "db.name": event.database_name,
+            "db.operation": event.command_name,
+            "db.collection": str(command.get(event.command_name, "")),
+            "code.function": calling_function(),
+        }
+        self._pending[(event.connection_id, event.request_id)] = _new_span(
+            "mongo {} {}".format(event.command_name,
+                                 attributes["db.collection"]),
+            parent["trace_id"], parent["span_id"], attributes)
+
+    def _end(self, event, error=None):
+        child = self._pending.pop((event.connection_id, event.request_id), None)
+        if child is None:
+            return
+        child["end_ns"] = child["start_ns"] + event.duration_micros * 1000
+        child["error"] = error
+        _finish(child)
+
+    def succeeded(self, event):
+        self._end(event)
+
+    def failed(self, event):
+        self._end(event, str(event.failure))
+
+
+COMMAND_TRACER = CommandTracer()
+
+
+def instrument(app):
+    """
+    Trace every callback registered on app from now on: a span for the
+    callback, one for its function and one for the JSON encoding of its
+    response. Call it before the first @app.callback.
+    """
+    if not TRACE_EXPORT:
+        return
+    if app.callback_map:
+        raise RuntimeError(
+            "tracing.instrument(app) must be called before the first "
+            "@app.callback, {} callbacks are registered already".format(
+                len(app.callback_map)))
+    register = app.callback
+
+    @functools.wraps(register)
+    def callback(*args, **kwargs):
+        decorate = register(*args, **kwargs)
+
+        def wrap(function):
+            # Dash wraps the function in one that also encodes the
+            # response; give it the traced function so the two are timed
+            # apart.
+            add_context = decorate(_trace_function(function))
+            for entry in app.callback_map.values():
+                if entry["callback"] is add_context:
+                    entry["callback"] = _trace_callback(function.__name__,
+                                                        add_context)
+                    return add_context
+            raise RuntimeError(
+                "Callback {} was not found in app.callback_map, it cannot "
+                "be traced".format(function.__name__))
+        return wrap
+    app.callback = callback
+
+
+def _trace_function(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            if current_span() is None:
+                return function(*args, **kwargs)
+            with span(function.__name__):
+                return function(*args, **kwargs)
+        finally:
+            _local.function_end_ns = time.time_ns()
+    return wrapper
+
+
+def _trace_callback(name, add_context):
+    @functools.wraps(add_context)
+    def wrapper(*args, **kwargs):
+        if current_span() is None:
+            return add_context(*args, **kwargs)
+        _local.function_end_ns = None
+        with span("callback " + name, callback=name) as callback_span:
+            response = add_context(*args, **kwargs)
+            if _local.function_end_ns is not None:
+                encode = _new_span("encode", callback_span["trace_id"],
+                                   callback_span["span_id"],
+                                   {"bytes": len(response)})
+                encode["start_ns"] = _local.function_end_ns
+                encode["end_ns"] = time.time_ns()
+                _finish(encode)
+            return response
+    return wrapper
+
+
+def init_app(server):
+    """
+    Trace the requests of the Flask server when TRACE_EXPORT is set.
+    """
+    if not TRACE_EXPORT:
+        return
+
+    @server.before_request
+    def start_request_trace():
+        request = flask.request
+        root = start_trace(
+            "http {} {}".format(request.method, request.path),
+            request.headers.get("traceparent"),
+            **{"http.method": request.method, "http.target": request.path,
+               "http.request_bytes": request.content_length or 0})
+        flask.g.trace_root = root
+
+    @server.after_request
+    def add_trace_headers(response):
+        root = flask.g.get("trace_root")
+        if root is not None:
+            root["attributes"]["http.status_code"] = response.status_code
+            response.headers["traceparent"] = traceparent(root)
+            response.headers["X-Trace-Id"] = root["trace_id"]
+        return response
+
+    @server.teardown_request
+    def end_request_trace(error=None):
+        if flask.g.get("trace_root") is not None:
+            end_trace(error)
+
+
+# Export
+
+_queue = queue.Queue(maxsize=1000)
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def export(spans):
+    """
+    Queue a finished trace for the exporter thread; traces are dropped when
+    the exporter falls behind rather than slowing requests down.
+    """
+    global _exporter
+    if _exporter is None or _exporter[1] != os.getpid():
+        with _exporter_lock:
+            if _exporter is None or _exporter[1] != os.getpid():
+                thread = threading.Thread(target=_export_loop,
+                                          name="trace-exporter", daemon=True)
+                thread.start()
+                _exporter = (thread, os.getpid())
+    try:
+        _queue.put_nowait(spans)
+    except queue.Full:
+        pass
+
+
+def _export_loop():
+    while True:
+        traces = [_queue.get()]
+        while not _queue.empty() and len(traces) < 100:
+            traces.append(_queue.get_nowait())
+        try:
+            if TRACE_EXPORT == "otlp":
+                write_otlp(traces)
+            else:
+                write_file(traces)
+        except Exception:
+            log.exception("Could not export %d traces", len(traces))
+
+
+def write_file(traces, path=None):
+    with open(path or TRACE_FILE, "a") as trace_file:
+        for spans in traces:
+            trace_file.write(json.dumps(spans, default=str) + "\n")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_spans(spans):
+    result = []
+    for s in spans:
+        otlp_span = {
+            "traceId": s["trace_id"],
+            "spanId": s["span_id"],
+            "name": s["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(s["start_ns"]),
+            "endTimeUnixNano": str(s["end_ns"]),
+            "attributes": [{"key": k, "value": _otlp_value(v)}
+                           for k, v in s["attributes"].items()],
+        }
+        if s["parent_id"]:
+            otlp_span["parentSpanId"] = s["parent_id"]
+        if s["error"]:
+            otlp_span["status"] = {"code": 2, "message": s["error"]}
+        result.append(otlp_span)
+    return result
+
+
+def write_otlp(traces, endpoint=None):
+    body = {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": __name__},
+            "spans": [s for spans in traces for s in otlp_spans(spans)],
+        }],
+    }]}
+    request = urllib.request.Request(
+        endpoint or TRACE_OTLP_ENDPOINT, data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"}, method="POST")
+    urllib.request.urlopen(request, timeout=10).close()
+
+
+# Reading trace files
+
+def format_trace(spans):
+    """
+    Return the spans of a trace as an indented tree with their durations.
+    """
+    children = {}
+    ids = set(s["span_id"] for s in spans)
+    for s in sorted(spans, key=lambda s: s["start_ns"]):
+        parent = s["parent_id"] if s["parent_id"] in ids else None
+        children.setdefault(parent, []).append(s)
+    lines = []
+
+    def add(s, depth):
+        lines.append("{:>10.1f}ms {}{}{}".format(
+            (s["end_ns"] - s["start_ns"]) / 1e6, "  " * depth, s["name"],
+            "  !! " + s["error"] if s["error"] else ""))
+        for child in children.get(s["span_id"], []):
+            add(child, depth + 1)
+    for root in children.get(None, []):
+        add(root, 0)
+    return "\n".join(lines)
+
+
+def main(path=TRACE_FILE, n=5):
+    with open(path) as trace_file:
+        traces = [json.loads(line) for line in trace_file if line.strip()]
+
+    def duration(spans):
+        return max(s["end_ns"] for s in spans) - min(s["start_ns"] for s in spans)
+    for spans in sorted(traces, key=duration, reverse=True)[:int(n)]:
+        print("trace {}".format(spans[0]["trace_id"]))
+        print(format_trace(spans))
+        print()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,107 @@
+"""
+Benchmark of components.flatten against json_normalize on synthetic bifrost
+samples.
+
+    python -m tests.bench_flatten [n_samples]
+"""
+import sys
+import time
+import random
+import pandas as pd
+from bson.objectid import ObjectId
+
+from components import flatten
+from components.projections import get_projection
+
+SPECIES = ["Escherichia coli", "Salmonella enterica", "Staphylococcus aureus",
+           "Listeria monocytogenes", None]
+
+
+def synthetic_sample(n):
+    species = random.choice(SPECIES)
+    return {
+        "_id": ObjectId(),
+        "name": "sample_{:06d}".format(n),
+        "sample_sheet": {
+            "sample_name": "sample_{:06d}".format(n),
+            "run_name": "run_{}".format(n // 96),
+            "provided_species": species,
+            "SequenceRunDate": "2020-01-{:02d}".format(n % 28 + 1),
+        },
+        "properties": {
+            "species": species,
+            "detected_species": species,
+            "denovo_assembly": {"summary": {
+                "bin_length_at_1x": random.randint(1500000, 6000000),
+                "bin_length_at_10x": random.randint(1500000, 6000000),
+                "bin_coverage_at_1x": random.uniform(0, 200),
+                "bin_contigs_at_1x": random.randint(0, 700),
+                "filtered_reads_num": random.randint(1000, 8000000),
+            }},
+            "species_detection": {"summary": {
+                "detected_species": species,
+                "percent_unclassified": random.random() / 4,
+            }},
+            "mlst": {"summary": {"strain": [random.randint(1, 500)]}},
+            "stamper": {"summary": {
+                "test__denovo_assembly__genome_size_difference_1x_10x": "pass:size:1",
+                "test__species_detection__main_species_level": "pass:level:0.9",
+            }},
+        },
+        "report": {
+            entry: {"data": [{"gene": "g{}".format(i), "identity": 99.0}
+                             for i in range(20)]}
+            for entry in ("resistance", "mlst", "plasmid", "virulence")
+        },
+    }
+
+
+def project(doc, projection):
+    """
+    Apply an inclusion projection locally, as mongo would before sending.
+    """
+    result = {}
+    for path in projection:
+        keys = path.split(".")
+        value = doc
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                value = flatten.MISSING
+                break
+            value = value[key]
+        if value is flatten.MISSING:
+            continue
+        target = result
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = value
+    return result
+
+
+def timed(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(n_samples=10000):
+    random.seed(0)
+    docs = [synthetic_sample(n) for n in range(n_samples)]
+    for view in ("aggregate", "sample_card"):
+        projection = get_projection(view)
+        projected = [project(doc, projection) for doc in docs]
+        t_normalize, expected = timed(
+            lambda: pd.io.json.json_normalize(projected))
+        t_flatten, result = timed(
+            lambda: flatten.normalize(projected, projection))
+        assert set(expected.columns) == set(result.columns), view
+        print("{:12s} {} samples: json_normalize {:.3f}s, flatten {:.3f}s ({:.1f}x)".format(
+            view, n_samples, t_normalize, t_flatten, t_normalize / t_flatten))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,86 @@
+"""
+Boot-time benchmark of the dashboard: imports app in fresh interpreters and
+builds the layout, with pymongo's MongoClient replaced by one that records
+its creation, and an unreachable database behind it.
+
+    python -m tests.bench_startup [runs]
+
+Exits non-zero if the import takes longer than BENCH_MAX_IMPORT_S seconds,
+if a mongo client is created (so no command can be sent either), or if one
+of the lazily loaded modules gets imported.
+"""
+import os
+import sys
+import json
+import subprocess
+
+MAX_IMPORT_S = float(os.getenv("BENCH_MAX_IMPORT_S", 3.0))
+LAZY_MODULES = ["react_phylo", "bifrostapi", "plotly.graph_objs",
+                "plotly.graph_objects"]
+UNREACHABLE_DB = "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=1000"
+
+CHILD = """
+import sys
+import json
+import time
+import traceback
+import pymongo
+import pymongo.mongo_client
+
+created = []
+
+
+class RecordingClient(pymongo.MongoClient):
+    def __init__(self, *args, **kwargs):
+        created.append("".join(traceback.format_stack(limit=6)[:-1]))
+        super().__init__(*args, **kwargs)
+
+
+pymongo.MongoClient = pymongo.mongo_client.MongoClient = RecordingClient
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+import plotly
+layout = json.dumps(app.app.layout, cls=plotly.utils.PlotlyJSONEncoder)
+built = time.perf_counter()
+print(json.dumps({
+    "import_s": imported - start,
+    "layout_s": built - imported,
+    "layout_bytes": len(layout),
+    "clients": created,
+    "lazy_loaded": [m for m in %r if m in sys.modules],
+}))
+""" % (LAZY_MODULES,)
+
+
+def run_once(root):
+    env = dict(os.environ, LOCAL_DB_KEY=UNREACHABLE_DB)
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD], cwd=root, env=env,
+        stdout=subprocess.PIPE, check=True, timeout=120).stdout
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main(runs=5):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = [run_once(root) for _ in range(runs)]
+    best_import = min(r["import_s"] for r in results)
+    best_layout = min(r["layout_s"] for r in results)
+    print("import app: {:.3f}s (best of {}), layout: {:.3f}s, {} bytes".format(
+        best_import, runs, best_layout, results[0]["layout_bytes"]))
+    failures = []
+    if best_import > MAX_IMPORT_S:
+        failures.append("import takes more than {}s".format(MAX_IMPORT_S))
+    for r in results:
+        for stack in r["clients"]:
+            failures.append("mongo client created at startup:\n" + stack)
+        if r["lazy_loaded"]:
+            failures.append("imported at startup: {}".format(
+                ", ".join(r["lazy_loaded"])))
+    for failure in sorted(set(failures)):
+        print("FAIL: {}".format(failure))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[int(a) for a in sys.argv[1:]]))
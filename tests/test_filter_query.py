@@ -0,0 +1,35 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from components import mongo_interface
+from bifrost import bifrost_mongo_interface
+
+
+@pytest.fixture
+def db(monkeypatch):
+    client = mongomock.MongoClient()
+    for module in (mongo_interface, bifrost_mongo_interface):
+        monkeypatch.setattr(module, "get_connection", lambda: client)
+    db = client["bifrost_upgrade_test"]
+    ids = db.samples.insert_many(
+        [{"name": "s{}".format(i)} for i in range(5)]).inserted_ids
+    db.runs.insert_one({"name": "run", "samples": [{"_id": i} for i in ids]})
+    return db, ids
+
+
+@pytest.mark.parametrize("module", [mongo_interface, bifrost_mongo_interface])
+def test_empty_samples_match_nothing(db, module):
+    assert module.filter(samples=[]) == []
+    assert module.count_filtered(samples=[]) == 0
+    assert list(module.filter_batches(samples=[])) == []
+    assert module.filter(run_names=["run"], samples=[]) == []
+
+
+@pytest.mark.parametrize("module", [mongo_interface, bifrost_mongo_interface])
+def test_samples_restrict_ids(db, module):
+    db, ids = db
+    assert module.count_filtered() == 5
+    assert module.count_filtered(samples=[str(ids[0])]) == 1
+    assert [s["_id"] for s in module.filter(
+        run_names=["run"], samples=[str(i) for i in ids[:2]])] == ids[:2]
@@ -0,0 +1,105 @@
+from datetime import datetime
+
+import pymongo
+
+from components import table_query
+
+COLUMNS = ["sample_sheet.run_name", "sample_sheet.BatchNo", "name"]
+
+
+def test_filter_condition_empty():
+    assert table_query.filter_condition(None, COLUMNS) is None
+    assert table_query.filter_condition("", COLUMNS) is None
+
+
+def test_filter_condition_operators():
+    assert table_query.filter_condition(
+        '{sample_sheet.run_name} contains "run.1"', COLUMNS) == {
+            "sample_sheet.run_name": {"$regex": r"run\.1"}}
+    assert table_query.filter_condition(
+        "{sample_sheet.BatchNo} >= 10", COLUMNS) == {
+            "sample_sheet.BatchNo": {"$gte": 10}}
+    assert table_query.filter_condition(
+        "{sample_sheet.BatchNo} = 3", COLUMNS) == {
+            "sample_sheet.BatchNo": {"$in": [3, "3"]}}
+    assert table_query.filter_condition(
+        "{name} ne 'x'", COLUMNS) == {"name": {"$ne": "x"}}
+    assert table_query.filter_condition(
+        '{name} datestartswith "2020"', COLUMNS) == {
+            "name": {"$regex": "^2020"}}
+
+
+def test_filter_condition_combines_and_ignores_unknown():
+    assert table_query.filter_condition(
+        '{name} = "a" && {other} = "b" && {sample_sheet.BatchNo} lt 5',
+        COLUMNS) == {"$and": [{"name": "a"},
+                              {"sample_sheet.BatchNo": {"$lt": 5}}]}
+    assert table_query.filter_condition(
+        '{name} like "a"', COLUMNS) is None
+
+
+def test_filter_condition_quoted_separator():
+    assert table_query.split_parts('{name} = "a && b" && {name} ne "c"') == [
+        '{name} = "a && b"', '{name} ne "c"']
+    assert table_query.filter_condition(
+        '{name} contains "a && b"', COLUMNS) == {
+            "name": {"$regex": "a\\ \\&\\&\\ b"}}
+    assert table_query.filter_condition(
+        r'{name} = "say \" && x" && {sample_sheet.BatchNo} > 1',
+        COLUMNS) == {"$and": [{"name": 'say " && x'},
+                              {"sample_sheet.BatchNo": {"$gt": 1}}]}
+
+
+def test_filter_condition_apostrophe_in_unquoted_value():
+    assert table_query.filter_condition(
+        "{name} contains O'Brien && {sample_sheet.BatchNo} > 1",
+        COLUMNS) == {"$and": [{"name": {"$regex": "O'Brien"}},
+                              {"sample_sheet.BatchNo": {"$gt": 1}}]}
+
+
+def test_date_condition():
+    assert table_query.date_condition("date") is None
+    assert table_query.date_condition(
+        "date", datetime(2020, 1, 1), datetime(2020, 1, 31)) == {"$or": [
+            {"date": {"$gte": datetime(2020, 1, 1),
+                      "$lt": datetime(2020, 2, 1)}},
+            {"date": {"$gte": "2020-01-01", "$lt": "2020-02-01"}}]}
+
+
+def test_sort_spec():
+    assert table_query.sort_spec(None, COLUMNS) is None
+    assert table_query.sort_spec(
+        [{"column_id": "name", "direction": "desc"},
+         {"column_id": "other", "direction": "asc"}], COLUMNS) == [
+            ("name", pymongo.DESCENDING), ("_id", pymongo.ASCENDING)]
+
+
+def test_update_page_selection():
+    selection = table_query.update_page_selection(None, ["a", "b"], ["a"])
+    assert selection == {"all": False, "ids": ["a"]}
+    # Rows of other pages are kept, rows of this page replaced.
+    selection = table_query.update_page_selection(
+        selection, ["c", "d"], ["d", "x"])
+    assert selection == {"all": False, "ids": ["a", "d"]}
+    selection = table_query.update_page_selection(selection, ["a", "b"], [])
+    assert selection == {"all": False, "ids": ["d"]}
+
+
+def test_update_page_selection_all():
+    selection = table_query.update_page_selection(
+        table_query.select_all(), ["a", "b", "c"], ["a", "c"])
+    assert selection == {"all": True, "ids": ["b"]}
+    assert not table_query.is_selected(selection, "b")
+    assert table_query.is_selected(selection, "z")
+    selection = table_query.update_page_selection(
+        selection, ["a", "b", "c"], ["a", "b", "c"])
+    assert selection == {"all": True, "ids": []}
+
+
+def test_selection_count():
+    assert table_query.selection_count(None, 10) == 0
+    assert table_query.selection_count(
+        {"all": False, "ids": ["a", "b"]}, 10) == 2
+    assert table_query.selection_count(table_query.select_all(), 10) == 10
+    assert table_query.selection_count({"all": True, "ids": ["a"]}, 10) == 9
+    assert table_query.selection_count({"all": True, "ids": ["a"]}, 0) == 0